@@ -0,0 +1,569 @@
+import array
+import best
+import blocks
+import collections
+import counter
+import doc
+import itertools
+import optparse
+import os
+import output
+import overlap
+import random
+import shards
+import shutil
+import subprocess
+import sys
+import tempfile
+import tfidf
+import threading
+import time
+
+
+def _synthetic_corpus(directory, number_documents, number_queries,
+    vocabulary_size=50000, seed=0):
+  """Writes a synthetic docs.txt and qrys.txt into directory.
+
+  Words are drawn from a Zipf-like distribution over the vocabulary, so that
+  (as in real text) a few words are very common and most are rare. Returns
+  the (query file, document file) names."""
+
+  generator = random.Random(seed)
+  words = ["w%s" % i for i in xrange(vocabulary_size)]
+
+  def random_word():
+    # Approximately Zipfian: the rank is exponential in a uniform variable.
+    return words[int(vocabulary_size ** generator.random()) - 1]
+
+  document_filename = os.path.join(directory, "docs.txt")
+  with open(document_filename, "w") as f:
+    for i in xrange(number_documents):
+      length = generator.randint(20, 300)
+      text = " ".join([random_word() for _ in xrange(length)])
+      f.write("%s %s\n" % (i, text))
+
+  query_filename = os.path.join(directory, "qrys.txt")
+  with open(query_filename, "w") as f:
+    for i in xrange(number_queries):
+      length = generator.randint(2, 8)
+      text = " ".join([random_word() for _ in xrange(length)])
+      f.write("%s %s\n" % (i, text))
+
+  return (query_filename, document_filename)
+
+
+def _time(function, repeat=3):
+  """Returns the best of 'repeat' wall-clock timings of function(), in
+  seconds."""
+
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def _report(name, seconds, baseline=None, unit=None, count=None):
+  """Prints a single benchmark result line."""
+
+  line = "  %-30s %9.4fs" % (name, seconds)
+  if count is not None:
+    line += "  %12.0f %s/s" % (count / seconds, unit)
+  if baseline is not None:
+    line += "  (%.2fx)" % (baseline / seconds)
+  print line
+
+
+def _counter_overlap(query, inverted_index):
+  """The original Counter-based _calculate_overlap, as a baseline."""
+
+  document_overlaps = counter.Counter()
+  for word in query.words_counter:
+    document_overlaps.update(inverted_index[word])
+
+  return [(query, d, score) for (d, score) in document_overlaps.most_common()]
+
+
+def benchmark_overlap(options):
+  """Word overlap: Counter.update, postings/bitmaps, and the matrix engine."""
+
+  (queries_set, documents_set) = _load_sets(options)
+  queries = queries_set.documents
+
+  # Build the postings and bitmaps up-front, as a long-running index would.
+  for query in queries:
+    for word in query.words_counter:
+      if documents_set.postings(word):
+        documents_set.bitmap(word)
+
+  baseline = _time(lambda: [_counter_overlap(query,
+      documents_set.inverted_index) for query in queries])
+  _report("Counter (all)", baseline)
+
+  _report("postings (all)", _time(lambda: [overlap._calculate_overlap(query,
+      documents_set) for query in queries]), baseline)
+  _report("postings (top 1000)", _time(lambda: [overlap._calculate_overlap(
+      query, documents_set, 1000) for query in queries]), baseline)
+
+  if overlap.sparse is not None:
+    _report("matrix (all)", _time(lambda: overlap._calculate_overlaps_matrix(
+        queries_set, documents_set)), baseline)
+    _report("matrix (top 1000)", _time(lambda:
+        overlap._calculate_overlaps_matrix(queries_set, documents_set, 1000)),
+        baseline)
+
+
+def benchmark_tfidf(options):
+  """tf.idf: the per-pair loop against the sparse matrix engine."""
+
+  if tfidf.sparse is None:
+    print "  (skipped: the matrix engine needs numpy and scipy)"
+    return
+
+  (queries_set, documents_set) = _load_sets(options)
+  queries = queries_set.documents
+  tf_idf = tfidf.TfIdf()
+
+  baseline = _time(lambda: [output._rank(tf_idf._tfidf(query, documents_set),
+      None) for query in queries])
+  _report("loop (all)", baseline)
+  _report("matrix (all)", _time(lambda: tf_idf._tfidf_matrix(queries_set,
+      documents_set)), baseline)
+
+  baseline = _time(lambda: [output._rank(tf_idf._tfidf(query, documents_set),
+      10) for query in queries])
+  _report("loop (top 10)", baseline)
+  _report("matrix (top 10)", _time(lambda: tf_idf._tfidf_matrix(queries_set,
+      documents_set, 10)), baseline)
+
+  # The largest difference from the loop's similarities.
+  difference = 0.0
+  for (query, results) in zip(queries, tf_idf._tfidf_matrix(queries_set,
+      documents_set)):
+    expected = dict((document, score)
+        for (_, document, score) in tf_idf._tfidf(query, documents_set))
+    for (_, document, score) in results:
+      difference = max(difference, abs(score - expected.pop(document)))
+    assert not expected
+  print "  max difference from loop: %g" % difference
+
+
+def benchmark_counter(options):
+  """counter.Counter against Python 2.7's collections.Counter."""
+
+  if not hasattr(collections, "Counter"):
+    print "  (skipped: collections.Counter needs Python 2.7)"
+    return
+
+  (queries_set, documents_set) = _load_sets(options)
+  documents = [list(document.words_counter.elements())
+      for document in documents_set.documents[:1000]]
+  counters = [(counter.Counter(words), collections.Counter(words))
+      for words in documents]
+
+  def compare(name, function):
+    baseline = _time(lambda: function(collections.Counter, 1))
+    _report("%s (2.7)" % name, baseline)
+    _report(name, _time(lambda: function(counter.Counter, 0)), baseline)
+
+  compare("count documents", lambda Counter, _: [Counter(words)
+      for words in documents])
+
+  def update(Counter, _):
+    total = Counter()
+    for words in documents:
+      total.update(words)
+  compare("update one counter", update)
+
+  # + copies the whole total each time, so fewer counters are added.
+  def add(Counter, i):
+    total = Counter()
+    for pair in counters[:200]:
+      total += pair[i]
+  compare("+= counters", add)
+
+  totals = (counter.Counter(), collections.Counter())
+  for pair in counters:
+    for i in (0, 1):
+      totals[i].update(pair[i])
+
+  # Taking the first few of the full ranking, as detector.py does.
+  def first_ten(Counter, i):
+    for _ in xrange(20):
+      if i == 0:
+        ranking = totals[i].iter_most_common()
+      else:
+        ranking = totals[i].most_common()
+      list(itertools.islice(ranking, 10))
+  compare("first 10 of most_common()", first_ten)
+
+
+def _percentile(values, percent):
+  """Returns the value at a percentile of a list of numbers."""
+
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _query_latencies(tf_idf, queries, documents_set, seconds):
+  """Runs tf.idf queries for 'seconds', returning each query's latency."""
+
+  latencies = []
+  end = time.time() + seconds
+  while time.time() < end:
+    for query in queries:
+      start = time.time()
+      tf_idf._tfidf(query, documents_set)
+      latencies.append(time.time() - start)
+  return latencies
+
+
+def benchmark_ingestion(options):
+  """tf.idf query latency with and without documents being added."""
+
+  (queries_set, documents_set) = _load_sets(options)
+  queries = queries_set.documents
+  tf_idf = tfidf.TfIdf()
+
+  # Copies of the existing documents (with new ids) are added in batches.
+  batch_size = 100
+  batches = []
+  next_id = max([document.id for document in documents_set.documents]) + 1
+  for start in xrange(0, documents_set.number_documents, batch_size):
+    batch = []
+    for document in documents_set.documents[start:start + batch_size]:
+      batch.append(doc.document_from_dict(next_id,
+          dict(document.words_counter)))
+      next_id += 1
+    batches.append(batch)
+
+  def report(name, latencies):
+    print "  %-30s p50 %7.2fms  p99 %7.2fms  (%s queries)" % (name,
+        _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000,
+        len(latencies))
+
+  tf_idf._tfidf(queries[0], documents_set)
+  report("idle", _query_latencies(tf_idf, queries, documents_set, 5))
+
+  def ingest():
+    for batch in batches:
+      documents_set.add_documents(batch)
+      time.sleep(0.001)
+
+  start = time.time()
+  ingester = threading.Thread(target=ingest)
+  ingester.start()
+  latencies = _query_latencies(tf_idf, queries, documents_set, 5)
+  ingester.join()
+  documents_set.wait_for_merges()
+  ingest_seconds = time.time() - start
+  report("ingesting", latencies)
+
+  _report("ingest (with queries)", ingest_seconds,
+      unit="documents", count=sum([len(batch) for batch in batches]))
+  print "  %s segments after merging" % (
+      len(documents_set.inverted_index.segments))
+
+  tf_idf._tfidf(queries[0], documents_set)
+  report("idle (after ingest)", _query_latencies(tf_idf, queries,
+      documents_set, 5))
+
+
+def _synthetic_postings(number_documents, number_terms, seed=0):
+  """Generates (positions, tfs) arrays for number_terms synthetic terms.
+
+  The document frequencies are Zipfian (the term of rank r is in 1 / (10r) of
+  the documents), and each term's positions are spread uniformly over
+  number_documents documents."""
+
+  generator = random.Random(seed)
+  for rank in xrange(1, number_terms + 1):
+    df = max(1, number_documents / (10 * rank))
+    positions = array.array('i', sorted(generator.sample(
+        xrange(number_documents), df)))
+    tfs = array.array('i', [1 + int(generator.expovariate(1.0))
+        for _ in xrange(df)])
+    yield (positions, tfs)
+
+
+def _benchmark_synthetic_postings(options):
+  """Times the block postings of synthetic terms against plain arrays."""
+
+  print "Generating postings for %s terms over %s documents." % (
+      options.number_terms, options.postings_documents)
+  postings = list(_synthetic_postings(options.postings_documents,
+      options.number_terms))
+  number_postings = sum([len(positions) for (positions, _) in postings])
+
+  start = time.time()
+  compressed = [blocks.BlockPostings(positions, tfs)
+      for (positions, tfs) in postings]
+  _report("encode", time.time() - start, unit="postings",
+      count=number_postings)
+
+  array_bytes = sum([len(positions) * positions.itemsize * 2
+      for (positions, _) in postings])
+  block_bytes = sum([block_postings.size() for block_postings in compressed])
+  print "  %-30s %9.1fMB  (%.2f bytes/posting)" % ("arrays",
+      array_bytes / float(1 << 20), float(array_bytes) / number_postings)
+  print "  %-30s %9.1fMB  (%.2f bytes/posting, %.1fx smaller)" % (
+      "blocks", block_bytes / float(1 << 20),
+      float(block_bytes) / number_postings, float(array_bytes) / block_bytes)
+
+  def read_arrays():
+    for (positions, tfs) in postings:
+      for _ in itertools.izip(positions, tfs):
+        pass
+
+  baseline = _time(read_arrays, 1)
+  _report("read arrays", baseline, unit="postings", count=number_postings)
+  _report("decode blocks", _time(lambda: [block_postings.decode_all()
+      for block_postings in compressed], 1), baseline, unit="postings",
+      count=number_postings)
+
+  # Look up 1000 random documents in every term, decoding only their blocks.
+  generator = random.Random(1)
+  targets = sorted([generator.randrange(options.postings_documents)
+      for _ in xrange(1000)])
+
+  def skip():
+    for block_postings in compressed:
+      for j in set([block_postings.find_block(target)
+          for target in targets]):
+        if j < block_postings.number_blocks():
+          block_postings.decode_block(j)
+
+  _report("skip to 1000 documents", _time(skip, 1), unit="lookups",
+      count=len(targets) * len(compressed))
+
+
+def benchmark_postings(options):
+  """Block postings: size, decoding, skipping and block-max pruning."""
+
+  # The synthetic postings are dropped before the corpus is loaded.
+  _benchmark_synthetic_postings(options)
+
+  (queries_set, documents_set) = _load_sets(options)
+  queries = queries_set.documents
+  tf_idf = tfidf.TfIdf()
+  for query in queries:
+    for word in query.words_counter:
+      documents_set.block_postings(word)
+
+  baseline = _time(lambda: [output._rank(tf_idf._tfidf(query, documents_set),
+      10) for query in queries])
+  _report("tf.idf top 10 (all)", baseline)
+  _report("tf.idf top 10 (block-max)", _time(lambda: [tf_idf._top_tfidf(
+      query, documents_set, 10) for query in queries]), baseline)
+
+
+def _peak_memory(statement):
+  """Runs a statement in a new interpreter, returning its peak memory in MB
+  and the time it took."""
+
+  script = "import ingest\n%s\nprint ingest.peak_memory()" % statement
+  start = time.time()
+  output = subprocess.check_output([sys.executable, "-c", script],
+      cwd=os.path.dirname(os.path.abspath(__file__)))
+  return (float(output.split()[-1]), time.time() - start)
+
+
+def benchmark_streaming(options):
+  """Peak memory of loading a DocumentSet vs streaming it to a disk index."""
+
+  if options.use_data:
+    data_file = os.path.abspath("data/docs.txt")
+  else:
+    print "Generating %s documents." % options.number_documents
+    (_, data_file) = _synthetic_corpus(options.directory,
+        options.number_documents, 1)
+  index_directory = os.path.join(options.directory, "index")
+  corpus_mb = os.path.getsize(data_file) / float(1 << 20)
+
+  def report(name, (memory, seconds)):
+    print "  %-30s %9.4fs  peak %7.1fMB  (corpus %.1fMB)" % (name, seconds,
+        memory, corpus_mb)
+
+  report("baseline interpreter", _peak_memory(""))
+  report("DocumentSet", _peak_memory("import doc; doc.DocumentSet(%r)" %
+      data_file))
+  for run_postings in (1 << 18, 1 << 21):
+    report("build_index (runs of %s)" % run_postings, _peak_memory(
+        "ingest.build_index(%r, %r, %s)" % (data_file, index_directory,
+        run_postings)))
+
+
+class _Words(object):
+  """A stand-in for ingest.Vocabulary that leaves words as strings, as
+  DocumentSets did before they interned them."""
+
+  class _Terms(object):
+    def __getitem__(self, word):
+      return word
+
+  terms = _Terms()
+
+  def intern_all(self, words):
+    return words
+
+
+def benchmark_vocabulary(options):
+  """Term ids against string keys: memory, loading and scoring."""
+
+  (query_file, data_file) = _corpus_files(options)
+  data_file = os.path.abspath(data_file)
+
+  def report(name, (memory, seconds)):
+    print "  %-30s %9.4fs  peak %7.1fMB" % (name, seconds, memory)
+
+  report("load (strings)", _peak_memory("import benchmark, doc; "
+      "doc.DocumentSet(%r, benchmark._Words())" % data_file))
+  report("load (term ids)", _peak_memory("import doc; doc.DocumentSet(%r)" %
+      data_file))
+
+  (queries_set, documents_set) = _load_sets(options)
+  words = _Words()
+  string_sets = (doc.DocumentSet(query_file, words),
+      doc.DocumentSet(data_file, words))
+
+  tf_idf = tfidf.TfIdf()
+  baseline = _time(lambda: [tf_idf._tfidf(query, string_sets[1])
+      for query in string_sets[0].documents])
+  _report("tf.idf (strings)", baseline)
+  _report("tf.idf (term ids)", _time(lambda: [tf_idf._tfidf(query,
+      documents_set) for query in queries_set.documents]), baseline)
+
+  prf = best.PseudoRelevanceFeedback(None, None, None)
+  baseline = _time(lambda: prf.rank(string_sets[0], string_sets[1]))
+  _report("PRF (strings)", baseline)
+  _report("PRF (term ids)", _time(lambda: prf.rank(queries_set,
+      documents_set)), baseline)
+
+
+def benchmark_shards(options):
+  """tf.idf (top 10) on one DocumentSet vs split into shards."""
+
+  (_, data_file) = _corpus_files(options)
+  (queries_set, documents_set) = _load_sets(options)
+  tf_idf = tfidf.TfIdf()
+
+  baseline = _time(lambda: [output._rank(tf_idf._tfidf(query, documents_set),
+      10) for query in queries_set.documents])
+  _report("tf.idf (1 set)", baseline)
+
+  for number_shards in (2, 4):
+    start = time.time()
+    index = shards.ShardedIndex(data_file, number_shards)
+    try:
+      _report("start %s shards" % number_shards, time.time() - start)
+      for engine in ("loop", "blocks"):
+        _report("tf.idf (%s shards, %s)" % (number_shards, engine),
+            _time(lambda: list(index.rank_tfidf(queries_set, tf_idf.k, 10,
+            engine))), baseline)
+    finally:
+      index.close()
+
+
+_BENCHMARKS = [
+  ("overlap", benchmark_overlap),
+  ("postings", benchmark_postings),
+  ("tfidf", benchmark_tfidf),
+  ("counter", benchmark_counter),
+  ("vocabulary", benchmark_vocabulary),
+  ("shards", benchmark_shards),
+  ("streaming", benchmark_streaming),
+  # Adds documents to the shared sets, so should stay last.
+  ("ingestion", benchmark_ingestion),
+]
+
+# The (queries_set, documents_set) shared by the benchmarks, and the files
+# they are loaded from.
+_sets = None
+_files = None
+
+
+def _corpus_files(options):
+  """Returns the (query file, document file) names, generating them if
+  necessary."""
+
+  global _files
+  if _files is None:
+    if options.use_data:
+      _files = ("data/qrys.txt", "data/docs.txt")
+    else:
+      print "Generating %s documents and %s queries." % (
+          options.number_documents, options.number_queries)
+      _files = _synthetic_corpus(options.directory, options.number_documents,
+          options.number_queries)
+  return _files
+
+
+def _load_sets(options):
+  """Loads the query and document sets, generating them if necessary."""
+
+  global _sets
+  if _sets is None:
+    (query_file, data_file) = _corpus_files(options)
+    _sets = (doc.DocumentSet(query_file), doc.DocumentSet(data_file))
+  return _sets
+
+
+def main():
+  """Runs the named benchmarks (or all of them), printing the timings."""
+
+  parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+  parser.add_option("--data",
+      action="store_true",
+      dest="use_data",
+      default=False,
+      help="Use data/qrys.txt and data/docs.txt instead of a synthetic "
+           "corpus.")
+  parser.add_option("-d", "--documents",
+      type="int",
+      action="store",
+      dest="number_documents",
+      default=20000,
+      help="The number of documents in the synthetic corpus.")
+  parser.add_option("-q", "--queries",
+      type="int",
+      action="store",
+      dest="number_queries",
+      default=50,
+      help="The number of queries in the synthetic corpus.")
+  parser.add_option("--postings-documents",
+      type="int",
+      action="store",
+      dest="postings_documents",
+      default=10000000,
+      help="The number of documents the synthetic postings are over.")
+  parser.add_option("--terms",
+      type="int",
+      action="store",
+      dest="number_terms",
+      default=100,
+      help="The number of terms to generate synthetic postings for.")
+  (options, args) = parser.parse_args()
+
+  names = [name for (name, _) in _BENCHMARKS]
+  for name in args:
+    if name not in names:
+      parser.error("Unknown benchmark %s (choose from %s)." %
+          (name, ", ".join(names)))
+
+  options.directory = tempfile.mkdtemp()
+  try:
+    for (name, benchmark) in _BENCHMARKS:
+      if args and name not in args:
+        continue
+
+      print "%s: %s" % (name, benchmark.__doc__)
+      benchmark(options)
+  finally:
+    shutil.rmtree(options.directory)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,7 +1,11 @@
-import counter
+import cache
 import doc
+import heapq
+import itertools
 import optparse
 import output
+import profiling
+import shards
 import tfidf
 
 
@@ -15,50 +19,204 @@ class PseudoRelevanceFeedback(object):
   _N_D = 19
   _N_W = 38
 
-  def __init__(self, k, n_d, n_w):
+  # The memory (in bytes) of the pass-1 rankings and mega document scores
+  # kept between queries. A long-running server sees an endless stream of new
+  # queries, so the least recently used are dropped.
+  _RANKING_BYTES = 16 << 20
+  _WORD_SCORE_BYTES = 32 << 20
+
+  # Only the top documents of a pass-1 ranking are kept (or n_d, if more).
+  _RANKING_DEPTH = 100
+
+  def __init__(self, k, n_d, n_w, score_cache=None):
     self.k = k or PseudoRelevanceFeedback._K
     self.n_d = n_d or PseudoRelevanceFeedback._N_D
     self.n_w = n_w or PseudoRelevanceFeedback._N_W
 
-    self.tf_idf = tfidf.TfIdf(self.k)
+    # With a cache.ScoreCache, the expanded queries of the second pass reuse
+    # the scores of the terms they share.
+    self.tf_idf = tfidf.TfIdf(self.k, score_cache)
+
+    # The pass-1 ranking of a query only depends on k, and the scored words of
+    # its 'mega document' only on k and n_d. Both are cached so that changing
+    # n_d or n_w between runs doesn't redo them. They are keyed by the query's
+    # words (see _query_key), as each query is a new Document, and are only
+    # valid for the document set (and version of it) they were built from.
+    self._cached_set = None
+    self._cached_version = None
+    self._rankings = cache.LRUCache(PseudoRelevanceFeedback._RANKING_BYTES)
+    self._word_scores = cache.LRUCache(
+        PseudoRelevanceFeedback._WORD_SCORE_BYTES)
 
-  def calculate_similarity(self, query_file, data_file, filename):
+  def calculate_similarity(self, query_file, data_file, filename, top_n=None,
+      number_shards=None):
     """Calculate the similarity between a query file and a data file.
 
-    The results are written to a file named "filename"."""
+    The results are written to a file named "filename", ranked and limited to
+    the top_n best documents per query (if top_n is given). With
+    number_shards, the data file is split into shards which are scored in
+    parallel (see shards.py)."""
 
     queries_set = doc.DocumentSet(query_file)
+
+    if number_shards is not None:
+      index = shards.ShardedIndex(data_file, number_shards)
+      try:
+        # The results are already ranked.
+        output.write_output_file(filename, itertools.chain.from_iterable(
+            index.rank_prf(queries_set, self, top_n)))
+      finally:
+        index.close()
+      return
+
     documents_set = doc.DocumentSet(data_file)
 
+    writer = output.ResultWriter(filename, top_n)
+    try:
+      for results in self.rank_queries(queries_set, documents_set):
+        writer.put(results)
+    finally:
+      writer.close()
+
+  def rank(self, queries_set, documents_set):
+    """Runs PRF for every query in a set against a set of documents.
+
+    The results are returned as a list of (query, document, similarity)
+    triples."""
+
     results = []
+    for query_results in self.rank_queries(queries_set, documents_set):
+      results.extend(query_results)
+    return results
+
+  def rank_queries(self, queries_set, documents_set):
+    """Runs PRF for every query in a set against a set of documents.
+
+    A list of (query, document, similarity) triples is generated for each
+    query in turn."""
+
     for query in queries_set.documents:
-      # Compute the initial tfidfs.
-      initial_tfidfs = self.tf_idf._tfidf(query, documents_set)
+      yield self.rank_query(query, documents_set)
+
+  @profiling.timed("prf")
+  def rank_query(self, query, documents_set):
+    """Runs PRF for a single query against a set of documents.
+
+    The results are returned as a list of (query, document, similarity)
+    triples."""
+
+    if self._cached_set is not documents_set or \
+        self._cached_version != documents_set.version:
+      self._cached_set = documents_set
+      self._cached_version = documents_set.version
+      self._rankings.clear()
+      self._word_scores.clear()
+
+    expansion_word_scores = self._expansion_word_scores(query, documents_set)
+    new_query = self._expanded_query(query, expansion_word_scores,
+        documents_set.vocabulary)
+
+    # Use these new words as the next query, and return the tf.idf scores.
+    with profiling.timer("prf: second pass"):
+      return self.tf_idf._tfidf(new_query, documents_set)
+
+  def _expanded_query(self, query, expansion_word_scores, vocabulary):
+    """Returns the second-pass query: the top n_w scoring words (via tf.idf)
+    from the mega document, each weighted by its score."""
+
+    with profiling.timer("prf: select words"):
+      profiling.count("heap operations", len(expansion_word_scores))
+      word_scores = self._top_words(expansion_word_scores, vocabulary)
+    word_scores = [(word, -score) for (score, word) in word_scores]
+    return doc.document_from_dict(query.id, dict(word_scores))
+
+  def _top_words(self, word_scores, vocabulary):
+    """Returns the n_w best of a list of (-score, word id) pairs.
+
+    Words with equal scores are taken in the order of the words themselves
+    (not their ids), so that the same words are picked whatever ids they
+    were given."""
 
-      # Select the top n_d scoring documents.
-      initial_tfidfs = sorted([(-s, d) for (_, d, s) in initial_tfidfs])
-      initial_tfidfs = [(d, -s) for (s, d) in initial_tfidfs[:self.n_d]]
-      selected_docs = [document for (document, _) in initial_tfidfs]
+    top = heapq.nsmallest(self.n_w, word_scores)
+    if len(top) < self.n_w:
+      return top
 
-      # Combine the top documents into a 'mega document'.
-      summed_counter = counter.Counter(query.words_counter)
-      for document in selected_docs:
-        summed_counter += document.words_counter
-      mega_document = doc.document_from_dict(None, dict(summed_counter))
+    # Only the words tied with the last one taken can be in the wrong order.
+    last = top[-1][0]
+    better = [pair for pair in top if pair[0] < last]
+    tied = sorted([(vocabulary.terms[word], word) for (score, word)
+        in word_scores if score == last])
+    return better + [(last, word)
+        for (_, word) in tied[:self.n_w - len(better)]]
 
-      # Select the top n_w scoring words (via tf.idf) from the megadocument.
-      word_scores = []
-      for word in sorted(list(mega_document.words_counter)):
-        score = self.tf_idf._document_tfidf(word, mega_document, documents_set)
-        word_scores.append((-score, word))
-      word_scores = sorted(word_scores)[:self.n_w]
-      word_scores = [(word, -score) for (score, word) in word_scores]
+  def _query_key(self, query):
+    """Returns the cache key of a query: its (word id, count) pairs, in
+    order, so that the same words in a new Document share its entries."""
 
-      # Use these new words as the next query, and return the tf.idf scores.
-      new_query = doc.document_from_dict(query.id, dict(word_scores))
-      results.extend(self.tf_idf._tfidf(new_query, documents_set))
+    return tuple(sorted(query.words_counter.iteritems()))
 
-    output.write_output_file(filename, results)
+  @profiling.timed("prf: initial ranking")
+  def _initial_ranking(self, query, documents_set):
+    """Returns the top of the pass-1 tf.idf ranking of a query (at least its
+    n_d best documents), best document first.
+
+    The ranking is a list of (-similarity, document) pairs."""
+
+    key = self._query_key(query)
+    cached = self._rankings.get(key)
+    if cached is not None and cached[0] >= self.n_d:
+      return cached[1]
+
+    depth = max(self.n_d, PseudoRelevanceFeedback._RANKING_DEPTH)
+    initial_tfidfs = self.tf_idf._tfidf(query, documents_set)
+    ranking = heapq.nsmallest(depth,
+        [(-s, d) for (_, d, s) in initial_tfidfs])
+    self._rankings.put(key, (depth, ranking), cache.pairs_size(ranking))
+    return ranking
+
+  @profiling.timed("prf: expansion")
+  def _expansion_word_scores(self, query, documents_set):
+    """Scores every word in the 'mega document' of a query's top n_d documents.
+
+    The scores are returned as an (unsorted) list of (-score, word) pairs."""
+
+    key = (self._query_key(query), self.n_d)
+    word_scores = self._word_scores.get(key)
+    if word_scores is not None:
+      return word_scores
+
+    # Select the top n_d scoring documents.
+    ranking = self._initial_ranking(query, documents_set)
+    selected_docs = [document for (_, document) in ranking[:self.n_d]]
+
+    word_scores = self._mega_document_scores(query, selected_docs,
+        documents_set)
+    self._word_scores.put(key, word_scores, cache.pairs_size(word_scores))
+    return word_scores
+
+  def _mega_document_scores(self, query, selected_docs, documents_set):
+    """Scores every word in the 'mega document' of a query and its selected
+    documents, as an (unsorted) list of (-score, word) pairs.
+
+    Only the idfs and average length of documents_set are used, so it can be
+    anything providing those (such as a shards.ShardedIndex)."""
+
+    # Combine the top documents into a 'mega document'. This is done in-place,
+    # rather than by adding Counters, to avoid a new Counter per document.
+    summed_words = dict(query.words_counter)
+    for document in selected_docs:
+      for (word, count) in document.words_counter.iteritems():
+        summed_words[word] = summed_words.get(word, 0) + count
+
+    # Every word shares the mega document's length, so its tf.idf only needs
+    # the word's tf and the precomputed idf.
+    squasher = self.tf_idf._squasher(sum(summed_words.itervalues()),
+        documents_set)
+    word_scores = []
+    for (word, tf_d) in summed_words.iteritems():
+      score = (tf_d / (tf_d + squasher)) * documents_set.idf(word)
+      word_scores.append((-score, word))
+    return word_scores
 
 
 def main():
@@ -85,13 +243,43 @@ def main():
       dest="n_w",
       default=None,
       help="The maximum number of words PRF takes from each document.")
+  parser.add_option("-n", "--top-documents",
+      type="int",
+      action="store",
+      dest="top_n",
+      default=None,
+      help="The maximum number of documents to output for each query.")
+  parser.add_option("--cache",
+      action="store_true",
+      dest="use_cache",
+      default=False,
+      help="Cache the scores of each term, and report the hit rate.")
+  parser.add_option("-s", "--shards",
+      type="int",
+      action="store",
+      dest="number_shards",
+      default=None,
+      help="Split the documents into this many shards, each scored by its "
+           "own process.")
+  profiling.add_options(parser)
   (options, args) = parser.parse_args()
 
+  if options.number_shards is not None and options.use_cache:
+    parser.error("Sharded scores can't be cached.")
+
   query_file = "data/qrys.txt"
   data_file = "data/docs.txt"
 
-  prf = PseudoRelevanceFeedback(options.k, options.n_d, options.n_w)
-  prf.calculate_similarity(query_file, data_file, "best.top")
+  score_cache = None
+  if options.use_cache:
+    score_cache = cache.ScoreCache()
+
+  prf = PseudoRelevanceFeedback(options.k, options.n_d, options.n_w,
+      score_cache)
+  profiling.run(lambda: prf.calculate_similarity(query_file, data_file,
+      "best.top", options.top_n, options.number_shards), options)
+  if score_cache is not None:
+    print score_cache.report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+import array
+import bisect
+
+# The number of postings in each block.
+BLOCK_SIZE = 128
+
+# Maps each byte to its low 7 bits, for decoding single-byte numbers.
+_LOW_BITS = bytes(bytearray([byte & 127 for byte in xrange(256)]))
+
+
+def encode(numbers, data):
+  """Appends the variable-byte encoding of non-negative ints to a bytearray.
+
+  Each number is written 7 bits at a time, lowest first, and the high bit is
+  set on its last byte."""
+
+  for number in numbers:
+    while number >= 128:
+      data.append(number & 127)
+      number >>= 7
+    data.append(number | 128)
+
+
+def decode(data):
+  """Decodes a (bytearray) string of variable-byte encoded ints to a list."""
+
+  numbers = []
+  number = 0
+  shift = 0
+  for byte in data:
+    if byte & 128:
+      numbers.append(number | ((byte & 127) << shift))
+      number = 0
+      shift = 0
+    else:
+      number |= byte << shift
+      shift += 7
+  return numbers
+
+
+class BlockPostings(object):
+  """A compressed postings list, of (position, tf) pairs sorted by position.
+
+  The postings are split into blocks of BLOCK_SIZE. Each block holds its
+  position gaps and then its tfs, variable-byte encoded, and the gaps are
+  from the last position of the previous block - so a block can be decoded on
+  its own. For each block, the index keeps:
+
+    * its last position, which acts as a skip pointer: bisecting these finds
+      the only block that can hold a position, without decoding the others.
+    * its maximum tf.
+    * its maximum tf / document length (if the lengths are given), which
+      bounds the block's tf.idf scores for any k - see max_impact."""
+
+  def __init__(self, positions, tfs, lengths=None):
+    self.length = len(positions)
+    self.data = bytearray()
+
+    self.last_positions = array.array('i')
+    self.offsets = array.array('i', [0])
+    self.max_tfs = array.array('i')
+    self.max_impacts = array.array('d')
+
+    previous = -1
+    for start in xrange(0, self.length, BLOCK_SIZE):
+      block_positions = positions[start:start + BLOCK_SIZE]
+      block_tfs = tfs[start:start + BLOCK_SIZE]
+
+      gaps = []
+      for position in block_positions:
+        gaps.append(position - previous)
+        previous = position
+      encode(gaps, self.data)
+      encode(block_tfs, self.data)
+
+      self.last_positions.append(previous)
+      self.offsets.append(len(self.data))
+      self.max_tfs.append(max(block_tfs))
+      if lengths is not None:
+        self.max_impacts.append(max([float(tf) / length for (tf, length) in
+            zip(block_tfs, lengths[start:start + BLOCK_SIZE])]))
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    """Generates the positions, decoding a block at a time."""
+
+    for i in xrange(len(self.last_positions)):
+      for position in self.decode_block(i)[0]:
+        yield position
+
+  def number_blocks(self):
+    return len(self.last_positions)
+
+  def size(self):
+    """Returns the size of the postings in bytes (not counting overheads)."""
+
+    return len(self.data) + sum([len(values) * values.itemsize
+        for values in (self.last_positions, self.offsets, self.max_tfs,
+        self.max_impacts)])
+
+  def find_block(self, position):
+    """Returns the index of the block that would hold a position (which may
+    be number_blocks(), if it is after the last posting)."""
+
+    return bisect.bisect_left(self.last_positions, position)
+
+  def decode_block(self, i):
+    """Decodes block i, returning (positions, tfs) lists."""
+
+    data = self.data[self.offsets[i]:self.offsets[i + 1]]
+    count = min(BLOCK_SIZE, self.length - i * BLOCK_SIZE)
+    if len(data) == 2 * count:
+      # Every number fits in a byte, so just clear the high bits.
+      numbers = list(data.translate(_LOW_BITS))
+    else:
+      numbers = decode(data)
+
+    position = self.last_positions[i - 1] if i else -1
+    positions = []
+    for gap in numbers[:count]:
+      position += gap
+      positions.append(position)
+    return (positions, numbers[count:])
+
+  def decode_all(self):
+    """Decodes every block, returning (positions, tfs) lists."""
+
+    positions = []
+    tfs = []
+    for i in xrange(len(self.last_positions)):
+      (block_positions, block_tfs) = self.decode_block(i)
+      positions.extend(block_positions)
+      tfs.extend(block_tfs)
+    return (positions, tfs)
+
+  def max_impact(self, i, squash):
+    """Bounds tf / (tf + squash * length) over the documents in block i.
+
+    As tf / (tf + squash * length) = r / (r + squash) for r = tf / length,
+    which increases with r, it is at most the block's max_impacts value put
+    through the same formula. For tf.idf, squash is k / avg|D|."""
+
+    impact = self.max_impacts[i]
+    return impact / (impact + squash)
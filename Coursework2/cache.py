@@ -0,0 +1,156 @@
+import sys
+
+# Rough sizes (in bytes) of the cached values, used to bound the caches'
+# memory: a list costs _LIST_BYTES, plus _PAIR_BYTES for each (document,
+# score) pair in it. Documents are shared with the index, so aren't counted.
+_LIST_BYTES = sys.getsizeof([])
+_PAIR_BYTES = sys.getsizeof((None, None)) + sys.getsizeof(0.0) + \
+    sys.getsizeof(None)
+
+
+def pairs_size(pairs):
+  """Estimates the memory used by a list of (document, score) pairs."""
+
+  return _LIST_BYTES + len(pairs) * _PAIR_BYTES
+
+
+class LRUCache(object):
+  """A least-recently-used cache, bounded by the memory of its values.
+
+  Each value is put in with its size (in bytes); once the total size is over
+  max_bytes, the least recently used values are evicted. Not thread-safe."""
+
+  # The fields of an entry in the doubly-linked recency list.
+  _PREVIOUS, _NEXT, _KEY, _VALUE, _SIZE = range(5)
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    # key -> entry. The entries form a circular list around the root, from
+    # the least to the most recently used.
+    self._entries = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, 0]
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    """Returns the value for a key (marking it as recently used)."""
+
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return default
+
+    self.hits += 1
+    self._unlink(entry)
+    self._link(entry)
+    return entry[LRUCache._VALUE]
+
+  def put(self, key, value, size):
+    """Caches a value, evicting older values if the cache is full.
+
+    Values bigger than the whole cache are not cached."""
+
+    if key in self._entries:
+      self._remove(self._entries[key])
+    if size > self.max_bytes:
+      return
+
+    entry = [None, None, key, value, size]
+    self._entries[key] = entry
+    self._link(entry)
+    self.size += size
+
+    while self.size > self.max_bytes:
+      self._remove(self._root[LRUCache._NEXT])
+      self.evictions += 1
+
+  def clear(self):
+    """Empties the cache (but keeps the hit and miss counts)."""
+
+    self._entries = {}
+    self._root[:] = [self._root, self._root, None, None, 0]
+    self.size = 0
+
+  def hit_rate(self):
+    """Returns the fraction of lookups that were hits."""
+
+    lookups = self.hits + self.misses
+    if not lookups:
+      return 0.0
+    return float(self.hits) / lookups
+
+  def _link(self, entry):
+    """Links an entry in as the most recently used."""
+
+    last = self._root[LRUCache._PREVIOUS]
+    entry[LRUCache._PREVIOUS] = last
+    entry[LRUCache._NEXT] = self._root
+    last[LRUCache._NEXT] = entry
+    self._root[LRUCache._PREVIOUS] = entry
+
+  def _unlink(self, entry):
+    entry[LRUCache._PREVIOUS][LRUCache._NEXT] = entry[LRUCache._NEXT]
+    entry[LRUCache._NEXT][LRUCache._PREVIOUS] = entry[LRUCache._PREVIOUS]
+
+  def _remove(self, entry):
+    self._unlink(entry)
+    del self._entries[entry[LRUCache._KEY]]
+    self.size -= entry[LRUCache._SIZE]
+
+
+class ScoreCache(object):
+  """A two-level cache of retrieval scores for a document set.
+
+  The first level ('terms') holds, for each (k, term), the term's tf.idf
+  contribution to every document containing it - so queries sharing terms
+  only score each shared term once. The second level ('queries') holds whole
+  ranked query results. Both are only valid for one version of one document
+  set, and are emptied once documents are added to it (see validate)."""
+
+  def __init__(self, term_bytes=64 << 20, query_bytes=16 << 20):
+    self.terms = LRUCache(term_bytes)
+    self.queries = LRUCache(query_bytes)
+
+    self._documents_set = None
+    self._version = None
+
+  def validate(self, documents_set):
+    """Empties the caches if they are for a different set or version."""
+
+    if self._documents_set is not documents_set or \
+        self._version != documents_set.version:
+      self.terms.clear()
+      self.queries.clear()
+      self._documents_set = documents_set
+      self._version = documents_set.version
+
+  def stats(self):
+    """Returns a dictionary of the hit rates and sizes of both levels."""
+
+    stats = {}
+    for (name, level) in (("terms", self.terms), ("queries", self.queries)):
+      stats[name] = {"hit_rate": level.hit_rate(),
+          "hits": level.hits,
+          "misses": level.misses,
+          "evictions": level.evictions,
+          "entries": len(level),
+          "bytes": level.size}
+    return stats
+
+  def report(self):
+    """Returns a one-line summary of the term cache's hit rate (the query
+    cache is only used by server.py, whose /stats has both)."""
+
+    return "term cache %.1f%% hits (%s entries)" % (
+        self.terms.hit_rate() * 100, len(self.terms))
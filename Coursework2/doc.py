@@ -1,29 +1,224 @@
+import array
+import binascii
+import blocks
 import collections
 from counter import Counter
+import ingest
+import math
+import profiling
+import segments
+import threading
+
+# The vocabulary shared by every DocumentSet not given its own, so that query
+# and document sets agree on the id of each word.
+VOCABULARY = ingest.Vocabulary()
 
 
 class DocumentSet(object):
-  """Represents a set of documents (or queries!)"""
+  """Represents a set of documents (or queries!)
 
-  def __init__(self, document_filename):
-    with open(document_filename, 'r') as f:
-      lines = f.readlines()
+  Words are interned to integer ids by the set's vocabulary (see
+  ingest.Vocabulary) as they are loaded, and everything from the documents'
+  words_counters to the inverted index is keyed by these ids. The word with
+  id i is self.vocabulary.terms[i]."""
 
-    self.documents = []
-    self.inverted_index = collections.defaultdict(set)
-    for line in lines:
-      parts = line.split()
-      document_id = int(parts.pop(0))
+  @profiling.timed("load documents")
+  def __init__(self, document_filename, vocabulary=None):
+    if vocabulary is None:
+      vocabulary = VOCABULARY
+    self.vocabulary = vocabulary
+    intern_all = vocabulary.intern_all
 
-      document = Document(document_id, parts)
+    # The file is streamed in chunks, rather than read whole.
+    self.documents = []
+    inverted_index = collections.defaultdict(set)
+    for (document_id, parts) in ingest.read_documents(document_filename):
+      document = Document(document_id, intern_all(parts))
       self.documents.append(document)
-      for word in parts:
-        self.inverted_index[word].add(document)
+      for word in document.words_counter:
+        inverted_index[word].add(document)
+
+    # The documents in the file form the first segment of the index. Any
+    # documents added later go into new segments (see add_documents).
+    self.inverted_index = segments.SegmentedIndex(
+        [segments.Segment(list(self.documents), inverted_index)])
 
     self.number_documents = len(self.documents)
 
-    total_length = sum([document.length for document in self.documents])
-    self.avg_length = float(total_length) / self.number_documents
+    self._total_length = sum([document.length for document in self.documents])
+    self.avg_length = float(self._total_length) / self.number_documents
+    profiling.count("documents loaded", self.number_documents)
+
+    # Incremented whenever documents are added, so that anything cached from
+    # the set can tell when it is out of date.
+    self.version = 0
+
+    # Held while documents are added, or segments are swapped by the merger.
+    self.lock = threading.RLock()
+    self._merger = None
+
+    # Only built on first use, as the query sets never need them. The idfs
+    # are stored as (version, {word -> idf}), and are filled in as words are
+    # looked up. The bitmaps and block postings are stored as
+    # {word -> (df, bitmap or blocks)}.
+    self._idfs = None
+    self._postings = None
+    self._bitmaps = {}
+    self._block_postings = {}
+
+  def add_documents(self, documents):
+    """Adds new Documents to the set, without rebuilding the index.
+
+    The documents are indexed into a new (small) segment, and the set's
+    statistics are updated straight away. A background thread merges the
+    segments logarithmically, so lookups stay fast.
+
+    Queries are never blocked: one running while documents are added sees the
+    index from either before or after the addition."""
+
+    documents = list(documents)
+    if not documents:
+      return
+
+    segment = segments.Segment(documents)
+
+    with self.lock:
+      # The postings only ever grow at the end, so can be updated in place.
+      if self._postings is not None:
+        for (i, document) in enumerate(documents):
+          position = len(self.documents) + i
+          for word in document.words_counter:
+            if word not in self._postings:
+              self._postings[word] = array.array('i')
+            self._postings[word].append(position)
+
+      self.documents.extend(documents)
+      self.inverted_index = segments.SegmentedIndex(
+          self.inverted_index.segments + (segment,))
+
+      self.number_documents = len(self.documents)
+      self._total_length += sum([document.length for document in documents])
+      self.avg_length = float(self._total_length) / self.number_documents
+
+      # Last, so that anything cached at the new version is up to date.
+      self.version += 1
+
+      if self._merger is None:
+        self._merger = segments.SegmentMerger(self)
+      self._merger.notify()
+
+  def wait_for_merges(self):
+    """Waits for the background merging of added segments to finish."""
+
+    if self._merger is not None:
+      self._merger.wait()
+
+  def _replace_segments(self, old_segments, merged_segment):
+    """Swaps segments for the segment they were merged into.
+
+    Called by the merger, with the lock held. As the documents are the same,
+    the version is not changed."""
+
+    remaining = [segment for segment in self.inverted_index.segments
+        if segment not in old_segments]
+    self.inverted_index = segments.SegmentedIndex(
+        [merged_segment] + remaining)
+
+  def idf(self, word):
+    """Returns log(|C| / df_w), or 0 for words not in the set.
+
+    idfs are cached until documents are added to the set."""
+
+    version = self.version
+    if self._idfs is None or self._idfs[0] != version:
+      self._idfs = (version, {})
+    idfs = self._idfs[1]
+
+    if word not in idfs:
+      df = len(self.inverted_index[word])
+      if df:
+        idfs[word] = math.log(float(self.number_documents) / df)
+      else:
+        idfs[word] = 0.0
+
+    return idfs[word]
+
+  def postings(self, word):
+    """Returns the sorted positions (in self.documents) of the documents
+    containing a word, as an array of ints."""
+
+    if self._postings is None:
+      with self.lock:
+        if self._postings is None:
+          self._postings = self._build_postings()
+
+    return self._postings.get(word, _NO_POSTINGS)
+
+  @profiling.timed("build postings")
+  def _build_postings(self):
+    """Builds the postings of every word in the set."""
+
+    positions = dict((document, i)
+        for (i, document) in enumerate(self.documents))
+
+    postings = {}
+    for (word, documents) in self.inverted_index.iteritems():
+      postings[word] = array.array('i',
+          sorted([positions[document] for document in documents]))
+    return postings
+
+  def bitmap(self, word):
+    """Returns the postings of a word as a bitmap, with bit i set if
+    self.documents[i] contains it.
+
+    The bitmap is a (long) int, so that bitmaps can be combined with the
+    bitwise operators. Bitmaps are built on first use and cached - as postings
+    only grow, a bitmap is valid for as long as the number of postings is the
+    same."""
+
+    postings = self.postings(word)
+    df = len(postings)
+
+    cached = self._bitmaps.get(word)
+    if cached is not None and cached[0] == df:
+      return cached[1]
+
+    bits = bytearray(((postings[df - 1] if df else 0) + 8) / 8)
+    for position in postings[:df]:
+      bits[position >> 3] |= 1 << (position & 7)
+
+    # The first byte holds the lowest bits, so reverse it for int().
+    bits.reverse()
+    bitmap = int(binascii.hexlify(str(bits)) or '0', 16)
+
+    self._bitmaps[word] = (df, bitmap)
+    return bitmap
+
+  def block_postings(self, word):
+    """Returns the postings of a word as a blocks.BlockPostings, holding the
+    tf of each document as well as its position.
+
+    Like bitmaps, these are built on first use and cached for as long as the
+    number of postings is the same."""
+
+    positions = self.postings(word)
+    df = len(positions)
+
+    cached = self._block_postings.get(word)
+    if cached is not None and cached[0] == df:
+      return cached[1]
+
+    documents = [self.documents[position] for position in positions[:df]]
+    block_postings = blocks.BlockPostings(positions[:df],
+        [document.words_counter[word] for document in documents],
+        [document.length for document in documents])
+
+    self._block_postings[word] = (df, block_postings)
+    return block_postings
+
+
+# Returned by DocumentSet.postings for words that are not in the set.
+_NO_POSTINGS = array.array('i')
 
 
 class Document(object):
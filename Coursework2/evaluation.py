@@ -0,0 +1,269 @@
+import collections
+import math
+import optparse
+import re
+import subprocess
+import sys
+
+
+# The metrics for a single query, or the mean metrics over all queries.
+# precision is a dictionary of cutoff -> precision at that cutoff.
+Evaluation = collections.namedtuple("Evaluation",
+    ["average_precision", "precision", "r_precision", "ndcg"])
+
+
+class Evaluator(object):
+  """Evaluates retrieval results against a TREC relevance ('truth') file.
+
+  This replaces calling out to trec_eval: the relevance file is read once, and
+  results are scored straight from memory. The ranking follows trec_eval -
+  documents are ordered by decreasing similarity (ties broken by decreasing
+  document id), and only the first max_documents of each query are used."""
+
+  # The precision cutoffs reported by trec_eval.
+  PRECISION_CUTOFFS = (5, 10, 15, 20, 30, 100, 200, 500, 1000)
+
+  def __init__(self, truth_filename, max_documents=1000):
+    self.max_documents = max_documents
+
+    # A dictionary of query id -> set of relevant document ids, and of query
+    # id -> {document id -> relevance} for the graded nDCG. Ids are kept as
+    # strings, as trec_eval does.
+    self.relevant = collections.defaultdict(set)
+    self.relevance = collections.defaultdict(dict)
+    with open(truth_filename, 'r') as f:
+      for line in f:
+        parts = line.split()
+        if not parts:
+          continue
+
+        (query_id, _, document_id, relevance) = parts[:4]
+        if int(relevance) > 0:
+          self.relevant[query_id].add(document_id)
+          self.relevance[query_id][document_id] = int(relevance)
+
+  def rankings(self, results):
+    """Orders a list of (query, document, similarity) triples.
+
+    A dictionary of query id -> ranked list of document ids is returned."""
+
+    scored = collections.defaultdict(list)
+    for (q, d, similarity) in results:
+      scored[str(q.id)].append((similarity, str(d.id)))
+
+    return self._rank(scored)
+
+  def read_rankings(self, filename):
+    """Reads and orders the results in a .top file, as trec_eval would."""
+
+    scored = collections.defaultdict(list)
+    with open(filename, 'r') as f:
+      for line in f:
+        parts = line.split()
+        if not parts:
+          continue
+
+        scored[parts[0]].append((float(parts[4]), parts[2]))
+
+    return self._rank(scored)
+
+  def _rank(self, scored):
+    """Turns query id -> [(similarity, document id)] into ranked lists."""
+
+    rankings = {}
+    for (query_id, documents) in scored.iteritems():
+      documents.sort(reverse=True)
+      rankings[query_id] = [d for (_, d) in documents[:self.max_documents]]
+    return rankings
+
+  def evaluate_queries(self, rankings):
+    """Evaluates every query in the truth file.
+
+    A dictionary of query id -> Evaluation is returned. As with trec_eval -c,
+    queries without any results are still evaluated (and score 0)."""
+
+    evaluations = {}
+    for query_id in self.relevant:
+      evaluations[query_id] = self.evaluate_query(query_id,
+          rankings.get(query_id, []))
+    return evaluations
+
+  def evaluate(self, rankings):
+    """Evaluates a set of rankings, returning the mean Evaluation."""
+
+    evaluations = self.evaluate_queries(rankings).values()
+    number_queries = float(len(evaluations))
+
+    precision = {}
+    for cutoff in Evaluator.PRECISION_CUTOFFS:
+      precision[cutoff] = sum([e.precision[cutoff] for e in evaluations]) / \
+          number_queries
+
+    return Evaluation(
+        sum([e.average_precision for e in evaluations]) / number_queries,
+        precision,
+        sum([e.r_precision for e in evaluations]) / number_queries,
+        sum([e.ndcg for e in evaluations]) / number_queries)
+
+  def evaluate_query(self, query_id, ranking):
+    """Evaluates the ranked list of document ids for a single query."""
+
+    relevant = self.relevant[query_id]
+
+    precision = {}
+    for cutoff in Evaluator.PRECISION_CUTOFFS:
+      precision[cutoff] = _precision(ranking, relevant, cutoff)
+
+    return Evaluation(
+        _average_precision(ranking, relevant),
+        precision,
+        _precision(ranking, relevant, len(relevant)),
+        _ndcg(ranking, self.relevance[query_id]))
+
+  def mean_average_precision(self, results):
+    """Calculates the MAP of a list of (query, document, similarity) triples.
+
+    As with trec_eval -c, the mean is over every query in the truth file, so
+    queries without any results count as 0."""
+
+    rankings = self.rankings(results)
+
+    total = 0.0
+    for (query_id, relevant) in self.relevant.iteritems():
+      total += _average_precision(rankings.get(query_id, []), relevant)
+    return total / len(self.relevant)
+
+  def precision(self, results, at):
+    """Calculates the mean precision at rank 'at' over all queries."""
+
+    rankings = self.rankings(results)
+
+    total = 0.0
+    for (query_id, relevant) in self.relevant.iteritems():
+      total += _precision(rankings.get(query_id, []), relevant, at)
+    return total / len(self.relevant)
+
+
+def _average_precision(ranking, relevant):
+  """Calculates the (non-interpolated) average precision of one ranking."""
+
+  hits = 0
+  total = 0.0
+  for (i, document_id) in enumerate(ranking):
+    if document_id in relevant:
+      hits += 1
+      total += float(hits) / (i + 1)
+
+  return total / len(relevant)
+
+
+def _precision(ranking, relevant, at):
+  """Calculates the precision of the first 'at' documents of one ranking.
+
+  Like trec_eval, missing documents count as non-relevant."""
+
+  hits = len([d for d in ranking[:at] if d in relevant])
+  return float(hits) / at
+
+
+def _ndcg(ranking, relevance):
+  """Calculates the nDCG of one ranking, using the graded relevances."""
+
+  dcg = 0.0
+  for (i, document_id) in enumerate(ranking):
+    if document_id in relevance:
+      dcg += relevance[document_id] / math.log(i + 2, 2)
+
+  ideal_dcg = 0.0
+  ideal_gains = sorted(relevance.values(), reverse=True)
+  for (i, gain) in enumerate(ideal_gains):
+    ideal_dcg += gain / math.log(i + 2, 2)
+
+  return dcg / ideal_dcg
+
+
+def _run_trec_eval(trec_eval, truth_filename, filename, max_documents):
+  """Runs trec_eval over a .top file, returning the metrics it reports.
+
+  Only the metrics both trec_eval -o and Evaluation have are returned, as a
+  dictionary of metric name -> value."""
+
+  text = subprocess.Popen([trec_eval, "-o", "-c", "-M%s" % max_documents,
+      truth_filename, filename], stdout=subprocess.PIPE).communicate()[0]
+
+  metrics = {}
+  metrics["map"] = float(re.search(
+      r"non-interpolated\) for all rel docs.*\n\s+([0-9.]+)", text).group(1))
+  for (cutoff, value) in re.findall(r"At\s+(\d+) docs:\s+([0-9.]+)", text):
+    metrics["P%s" % cutoff] = float(value)
+  metrics["R-prec"] = float(re.search(r"Exact:\s+([0-9.]+)", text).group(1))
+
+  return metrics
+
+
+def _as_metrics(evaluation):
+  """Flattens an Evaluation into a dictionary of metric name -> value."""
+
+  metrics = {"map": evaluation.average_precision,
+      "R-prec": evaluation.r_precision,
+      "ndcg": evaluation.ndcg}
+  for (cutoff, value) in evaluation.precision.iteritems():
+    metrics["P%s" % cutoff] = value
+  return metrics
+
+
+def main():
+  """Evaluates .top files, optionally checking the results against trec_eval.
+
+  With --trec-eval, exits with a non-zero status if any metric differs from
+  trec_eval's (which are rounded to 4 decimal places)."""
+
+  parser = optparse.OptionParser(usage="%prog [options] file.top [...]")
+  parser.add_option("-t", "--truth",
+      action="store",
+      dest="truth_filename",
+      default="truth.rel",
+      help="The relevance file to evaluate against.")
+  parser.add_option("-M",
+      type="int",
+      action="store",
+      dest="max_documents",
+      default=1000,
+      help="The maximum number of documents used per query.")
+  parser.add_option("--trec-eval",
+      action="store",
+      dest="trec_eval",
+      default=None,
+      help="The trec_eval binary to check the results against.")
+  (options, args) = parser.parse_args()
+
+  evaluator = Evaluator(options.truth_filename, options.max_documents)
+
+  mismatches = 0
+  for filename in args:
+    ours = _as_metrics(evaluator.evaluate(evaluator.read_rankings(filename)))
+
+    theirs = {}
+    if options.trec_eval:
+      theirs = _run_trec_eval(options.trec_eval, options.truth_filename,
+          filename, options.max_documents)
+
+    print filename
+    for metric in sorted(ours):
+      if metric not in theirs:
+        print "  %-8s %.4f" % (metric, ours[metric])
+        continue
+
+      # trec_eval rounds to 4 decimal places.
+      matches = abs(ours[metric] - theirs[metric]) <= 0.00005 + 1e-9
+      if not matches:
+        mismatches += 1
+      print "  %-8s %.4f %.4f %s" % (metric, ours[metric], theirs[metric],
+          "ok" if matches else "MISMATCH")
+
+  if mismatches:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,281 @@
+import array
+import heapq
+import optparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+# The number of bytes read from a document file at a time.
+_CHUNK_SIZE = 4 << 20
+
+# The number of postings held in memory before they are written out as a sorted
+# run. Each posting costs roughly 8 bytes in its array, so the default run
+# takes about 16MB.
+_RUN_POSTINGS = 2 << 20
+
+# The buffer size used to read each run file, when merging.
+_READ_BUFFER = 1 << 18
+
+# The files an index directory holds.
+TERMS_FILENAME = "terms.txt"
+POSTINGS_FILENAME = "postings.bin"
+DOCUMENTS_FILENAME = "documents.txt"
+
+
+def read_documents(filename, chunk_size=_CHUNK_SIZE):
+  """Reads a document (or query) file, yielding (id, list of words) for each
+  line.
+
+  The file is read in large chunks rather than all at once, so only one chunk
+  (and the line being split) is in memory at a time. Blank lines are
+  skipped."""
+
+  with open(filename, 'r') as f:
+    remainder = ''
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+
+      lines = (remainder + chunk).split('\n')
+      # The last line may carry on into the next chunk.
+      remainder = lines.pop()
+      for line in lines:
+        parts = line.split()
+        if parts:
+          yield (int(parts[0]), parts[1:])
+
+    parts = remainder.split()
+    if parts:
+      yield (int(parts[0]), parts[1:])
+
+
+class Vocabulary(object):
+  """Interns terms to small integer ids, in the order they are first seen."""
+
+  def __init__(self):
+    self.ids = {}
+    self.terms = []
+
+  def __len__(self):
+    return len(self.terms)
+
+  def intern(self, term):
+    """Returns the id of a term, giving it the next id if it is new."""
+
+    term_id = self.ids.get(term)
+    if term_id is None:
+      term_id = len(self.terms)
+      self.ids[term] = term_id
+      self.terms.append(term)
+    return term_id
+
+  def intern_all(self, terms):
+    """Returns the ids of a list of terms, giving new terms new ids."""
+
+    ids = self.ids
+    try:
+      return [ids[term] for term in terms]
+    except KeyError:
+      return [self.intern(term) for term in terms]
+
+
+class _RunWriter(object):
+  """Collects postings in memory, writing them out as sorted runs.
+
+  Documents arrive in order, so each term's postings are already sorted by
+  document: a run only has to be sorted by term id. A run is written as, for
+  each term, [term id, number of postings, position, tf, position, tf, ...],
+  as a flat array of ints."""
+
+  def __init__(self, directory, run_postings=_RUN_POSTINGS):
+    self.directory = directory
+    self.run_postings = run_postings
+    self.filenames = []
+
+    self._postings = {}
+    self._size = 0
+
+  def add(self, position, term_counts):
+    """Adds the postings of one document, given as {term id -> tf}."""
+
+    postings = self._postings
+    for (term_id, tf) in term_counts.iteritems():
+      term_postings = postings.get(term_id)
+      if term_postings is None:
+        term_postings = postings[term_id] = array.array('i')
+      term_postings.append(position)
+      term_postings.append(tf)
+
+    self._size += len(term_counts)
+    if self._size >= self.run_postings:
+      self.flush()
+
+  def flush(self):
+    """Writes the postings in memory out as a run."""
+
+    if not self._postings:
+      return
+
+    filename = os.path.join(self.directory, "run%05d.bin" %
+        len(self.filenames))
+    with open(filename, 'wb') as f:
+      for term_id in sorted(self._postings):
+        term_postings = self._postings[term_id]
+        array.array('i', [term_id, len(term_postings) / 2]).tofile(f)
+        term_postings.tofile(f)
+
+    self.filenames.append(filename)
+    self._postings = {}
+    self._size = 0
+
+
+def _read_run(filename, run_number):
+  """Yields (term id, run number, postings) for each term in a run."""
+
+  with open(filename, 'rb', _READ_BUFFER) as f:
+    while True:
+      header = array.array('i')
+      try:
+        header.fromfile(f, 2)
+      except EOFError:
+        return
+
+      postings = array.array('i')
+      postings.fromfile(f, header[1] * 2)
+      yield (header[0], run_number, postings)
+
+
+def _merge_runs(filenames):
+  """Merges sorted runs, yielding (term id, postings) in term id order.
+
+  A term's postings from earlier runs come first, so they stay sorted by
+  document. Only one term from each run is in memory at a time."""
+
+  runs = [_read_run(filename, i) for (i, filename) in enumerate(filenames)]
+
+  term_postings = None
+  last_term_id = None
+  for (term_id, _, postings) in heapq.merge(*runs):
+    if term_id != last_term_id:
+      if term_postings is not None:
+        yield (last_term_id, term_postings)
+      term_postings = postings
+      last_term_id = term_id
+    else:
+      term_postings.extend(postings)
+
+  if term_postings is not None:
+    yield (last_term_id, term_postings)
+
+
+def build_index(document_filename, index_directory, run_postings=_RUN_POSTINGS,
+    chunk_size=_CHUNK_SIZE):
+  """Indexes a document file into index_directory, without holding the
+  documents or the whole index in memory.
+
+  Documents are streamed from the file, their terms interned to ids, and
+  their postings written out as sorted runs of at most run_postings postings,
+  which are then merged into the final postings file. Only the vocabulary
+  and one run are ever held in memory. The index directory holds:
+
+    * documents.txt: the id and length of each document, by position.
+    * terms.txt: each term with its document frequency and the offset of its
+      postings, by term id.
+    * postings.bin: each term's (position, tf) pairs, as ints.
+
+  Nothing reads the index back: doc.DocumentSet and the engines build their
+  own index in memory, so the on-disk format is only there to measure
+  indexing time and peak memory (here and in benchmark.py).
+
+  Returns a dictionary of statistics about the indexing."""
+
+  if not os.path.isdir(index_directory):
+    os.makedirs(index_directory)
+  run_directory = tempfile.mkdtemp(dir=index_directory)
+
+  vocabulary = Vocabulary()
+  intern = vocabulary.intern
+  runs = _RunWriter(run_directory, run_postings)
+
+  number_documents = 0
+  total_length = 0
+  try:
+    with open(os.path.join(index_directory, DOCUMENTS_FILENAME), 'w') as f:
+      for (document_id, words) in read_documents(document_filename,
+          chunk_size):
+        term_counts = {}
+        for word in words:
+          term_id = intern(word)
+          term_counts[term_id] = term_counts.get(term_id, 0) + 1
+
+        runs.add(number_documents, term_counts)
+        f.write("%s %s\n" % (document_id, len(words)))
+
+        number_documents += 1
+        total_length += len(words)
+    runs.flush()
+
+    terms_filename = os.path.join(index_directory, TERMS_FILENAME)
+    postings_filename = os.path.join(index_directory, POSTINGS_FILENAME)
+    with open(terms_filename, 'w') as terms_file:
+      with open(postings_filename, 'wb') as postings_file:
+        offset = 0
+        for (term_id, postings) in _merge_runs(runs.filenames):
+          postings.tofile(postings_file)
+          terms_file.write("%s %s %s\n" % (vocabulary.terms[term_id],
+              len(postings) / 2, offset))
+          offset += len(postings)
+  finally:
+    shutil.rmtree(run_directory)
+
+  return {"documents": number_documents,
+      "terms": len(vocabulary),
+      "runs": len(runs.filenames),
+      "postings": offset / 2,
+      "avg_length": float(total_length) / max(number_documents, 1)}
+
+
+def peak_memory():
+  """Returns the peak resident set size of this process, in MB."""
+
+  # ru_maxrss is in kilobytes on Linux (but bytes on OS X).
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+  """Indexes a document file to a directory, reporting time and peak memory."""
+
+  parser = optparse.OptionParser(
+      usage="%prog [options] document_file index_directory")
+  parser.add_option("-r", "--run-postings",
+      type="int",
+      action="store",
+      dest="run_postings",
+      default=_RUN_POSTINGS,
+      help="The number of postings to hold in memory before writing a run.")
+  parser.add_option("--chunk-mb",
+      type="int",
+      action="store",
+      dest="chunk_mb",
+      default=_CHUNK_SIZE >> 20,
+      help="The size (in MB) of the chunks the document file is read in.")
+  (options, args) = parser.parse_args()
+
+  if len(args) != 2:
+    parser.error("Expected a document file and an index directory.")
+
+  start = time.time()
+  statistics = build_index(args[0], args[1], options.run_postings,
+      options.chunk_mb << 20)
+
+  print "Indexed %s documents (%s terms, %s postings) from %s runs in %.1fs." \
+      % (statistics["documents"], statistics["terms"], statistics["postings"],
+      statistics["runs"], time.time() - start)
+  print "Peak memory: %.1fMB" % peak_memory()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,154 @@
+import benchmark
+import itertools
+import optparse
+import threading
+import time
+import urllib
+import urllib2
+
+
+def _read_queries(query_file):
+  """Reads the words of each query in a query file."""
+
+  queries = []
+  with open(query_file, "r") as f:
+    for line in f:
+      words = line.split()[1:]
+      if words:
+        queries.append(words)
+  return queries
+
+
+def _run_client(url, method, top_n, queries, start, end, unique, sent, lock,
+    cold, warm, errors):
+  """Sends queries (round-robin, from 'start') until the time 'end'.
+
+  A query's latency goes in 'cold' the first time any client sends it, and
+  in 'warm' after that, when the server may answer it from its cache."""
+
+  i = start
+  while time.time() < end:
+    words = queries[i % len(queries)]
+    i += 1
+
+    if unique is not None:
+      # No document has this word, so the scores don't change, but the
+      # query gets a key of its own in the server's query cache.
+      words = words + ["loadtest%s" % next(unique)]
+      first = True
+    else:
+      with lock:
+        first = tuple(words) not in sent
+        sent.add(tuple(words))
+
+    parameters = urllib.urlencode({"method": method, "q": " ".join(words),
+        "n": top_n})
+
+    request_start = time.time()
+    try:
+      urllib2.urlopen("%s/search?%s" % (url, parameters)).read()
+    except (urllib2.URLError, IOError):
+      errors.append(1)
+      continue
+    (cold if first else warm).append(time.time() - request_start)
+
+
+def _report(name, latencies):
+  """Prints the percentiles of a list of latencies."""
+
+  if latencies:
+    print "  %s: %s queries, p50 %.2fms, p99 %.2fms" % (name, len(latencies),
+        benchmark._percentile(latencies, 50) * 1000,
+        benchmark._percentile(latencies, 99) * 1000)
+
+
+def main():
+  """Sends queries to a running server.py, and reports latency and QPS.
+
+  The first time each query is sent is only cold if the server hasn't seen it
+  since it started; --unique-queries makes every query miss the server's
+  query cache (though the scores of its terms may still be cached)."""
+
+  parser = optparse.OptionParser()
+  parser.add_option("--url",
+      action="store",
+      dest="url",
+      default="http://127.0.0.1:8000",
+      help="The server to query.")
+  parser.add_option("-m", "--method",
+      type="choice",
+      choices=["tfidf", "overlap", "prf"],
+      action="store",
+      dest="method",
+      default="tfidf",
+      help="The retrieval method to query with.")
+  parser.add_option("-c", "--concurrency",
+      type="int",
+      action="store",
+      dest="concurrency",
+      default=8,
+      help="The number of clients sending queries at once.")
+  parser.add_option("-t", "--time",
+      type="float",
+      action="store",
+      dest="seconds",
+      default=10,
+      help="How long (in seconds) to send queries for.")
+  parser.add_option("-n", "--top-documents",
+      type="int",
+      action="store",
+      dest="top_n",
+      default=10,
+      help="The number of documents to ask for per query.")
+  parser.add_option("--queries",
+      action="store",
+      dest="query_file",
+      default="data/qrys.txt",
+      help="The file of queries to send.")
+  parser.add_option("--unique-queries",
+      action="store_true",
+      dest="unique",
+      default=False,
+      help="Make every query miss the server's query cache.")
+  (options, args) = parser.parse_args()
+
+  queries = _read_queries(options.query_file)
+
+  # list.append is thread-safe, so the clients can share the lists. The set
+  # of queries sent so far needs the lock.
+  cold = []
+  warm = []
+  errors = []
+  sent = set()
+  lock = threading.Lock()
+  unique = itertools.count() if options.unique else None
+
+  start = time.time()
+  end = start + options.seconds
+  clients = []
+  for i in xrange(options.concurrency):
+    client = threading.Thread(target=_run_client, args=(options.url,
+        options.method, options.top_n, queries,
+        i * len(queries) / options.concurrency, end, unique, sent, lock, cold,
+        warm, errors))
+    client.start()
+    clients.append(client)
+  for client in clients:
+    client.join()
+  elapsed = time.time() - start
+
+  latencies = cold + warm
+  if not latencies:
+    print "No queries succeeded (%s errors)." % len(errors)
+    return
+
+  print "%s queries in %.1fs (%s errors, %s clients)" % (len(latencies),
+      elapsed, len(errors), options.concurrency)
+  print "  QPS: %.1f" % (len(latencies) / elapsed)
+  _report("all", latencies)
+  _report("cold", cold)
+  _report("warm", warm)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,10 +1,124 @@
+import gzip
+import heapq
+import operator
+import profiling
+import Queue
+import sys
+import threading
+
+_FORMAT_STRING = "%s 0 %s 0 %s 0\n"
+
+# Lines are formatted and written this many at a time, through a buffer of
+# _BUFFER_SIZE bytes.
+_BATCH_SIZE = 8192
+_BUFFER_SIZE = 1 << 20
+
+
+@profiling.timed("write output")
 def write_output_file(name, results):
   """Writes a set of results to an output file.
 
   The results must be in the form of a list of triples
   (query, document, similarity)."""
-  format_string = "%s 0 %s 0 %s 0\n"
 
-  with open(name, 'w') as f:
-    for (q, d, similarity) in results:
-      f.write(format_string % (q.id, d.id, similarity))
\ No newline at end of file
+  with _open(name) as f:
+    _write_batched(f, results)
+
+
+def write_ranked_output_file(name, query_results, top_n=None):
+  """Writes a set of results to an output file, ranked per query.
+
+  query_results should be an iterable (e.g. a generator) giving, for each
+  query in turn, an iterable of (query, document, similarity) triples. Each
+  query's results are written in decreasing order of similarity, and only the
+  top_n best are kept (or all of them, if top_n is None).
+
+  If name ends in '.gz', the file is gzip compressed."""
+
+  with _open(name) as f:
+    for results in query_results:
+      with profiling.timer("rank results"):
+        ranked = _rank(results, top_n)
+      with profiling.timer("write results"):
+        _write_batched(f, ranked)
+
+
+def _rank(results, top_n):
+  """Ranks a single query's results, truncating them to top_n."""
+
+  similarity = operator.itemgetter(2)
+  if top_n is None:
+    return sorted(results, key=similarity, reverse=True)
+  return heapq.nlargest(top_n, results, key=similarity)
+
+
+def _open(name):
+  """Opens an output file for writing, compressing it if it ends in '.gz'."""
+
+  if name.endswith(".gz"):
+    return gzip.GzipFile(name, "wb")
+  return open(name, "w", _BUFFER_SIZE)
+
+
+def _write_batched(f, results):
+  """Formats and writes results _BATCH_SIZE lines at a time."""
+
+  lines = []
+  for (q, d, similarity) in results:
+    lines.append(_FORMAT_STRING % (q.id, d.id, similarity))
+    if len(lines) >= _BATCH_SIZE:
+      f.write("".join(lines))
+      lines = []
+
+  if lines:
+    f.write("".join(lines))
+
+
+class ResultWriter(object):
+  """Writes ranked results to a file from a background thread.
+
+  This lets scoring and writing overlap: each call to put() hands over one
+  query's results, which are ranked and written by write_ranked_output_file.
+  At most max_pending queries are queued, after which put() blocks until the
+  writer catches up."""
+
+  # Marks the end of the results on the queue.
+  _DONE = object()
+
+  def __init__(self, name, top_n=None, max_pending=16):
+    self._queue = Queue.Queue(max_pending)
+    self._error = None
+
+    self._thread = threading.Thread(target=self._run, args=(name, top_n))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def put(self, results):
+    """Queues one query's (query, document, similarity) triples."""
+
+    self._raise_error()
+    self._queue.put(results)
+
+  def close(self):
+    """Waits for all queued results to be written."""
+
+    self._queue.put(ResultWriter._DONE)
+    self._thread.join()
+    self._raise_error()
+
+  def _run(self, name, top_n):
+    try:
+      write_ranked_output_file(name, iter(self._queue.get, ResultWriter._DONE),
+          top_n)
+    except Exception:
+      self._error = sys.exc_info()
+
+      # Keep emptying the queue, so that put() and close() don't block.
+      while self._queue.get() is not ResultWriter._DONE:
+        pass
+
+  def _raise_error(self):
+    """Re-raises any error from the writer thread in the calling thread."""
+
+    if self._error is not None:
+      raise self._error[0], self._error[1], self._error[2]
\ No newline at end of file
@@ -1,23 +1,180 @@
 import doc
-import counter
+import heapq
 import itertools
+import optparse
 import output
 
-def _calculate_overlap(query, inverted_index):
+# numpy and scipy are only needed for the 'matrix' engine.
+try:
+  import numpy
+  from scipy import sparse
+except ImportError:
+  numpy = None
+  sparse = None
+
+# Merging postings costs around log(#words) per posting, whereas counting with
+# bitmaps costs a few passes over #documents bits per word. Postings are merged
+# when there are fewer than 1 in _MERGE_RATIO documents in them.
+_MERGE_RATIO = 16
+
+
+def _calculate_overlap(query, documents_set, top_k=None):
   """Calculate the overlaps between a query and all documents.
 
-  An inverted index is used so that only the documents containing
-  the query words are examined."""
+  The results are ordered by decreasing overlap (ties in document order), and
+  only the top_k are returned if top_k is given.
+
+  Only the documents containing the query words are examined. For sparse
+  words, their sorted postings are merged document-at-a-time; otherwise each
+  word's postings bitmap is added into a bit-sliced counter. That is, if the
+  query was "bob marley" and we had {"bob" -> [d1, d4, d6], "marley" -> [d2,
+  d4, d5]}, the result would be [d4:2, d1:1, d2:1, d5:1, d6:1]."""
+
+  words = [word for word in query.words_counter
+      if documents_set.postings(word)]
+  number_postings = sum([len(documents_set.postings(word)) for word in words])
+
+  if number_postings * _MERGE_RATIO < documents_set.number_documents:
+    overlaps = _merge_overlaps(
+        [documents_set.postings(word) for word in words])
+  else:
+    overlaps = _bitmap_overlaps([documents_set.bitmap(word) for word in words])
+
+  documents = documents_set.documents
+  return [(query, documents[position], score)
+      for (position, score) in itertools.islice(overlaps, top_k)]
+
+
+def _calculate_block_overlap(query, documents_set, top_k=None):
+  """_calculate_overlap, merging the words' compressed block postings.
+
+  Each word's blocks are decoded one at a time as the merge reaches them, so
+  only the compressed postings are kept in memory."""
+
+  block_postings = [documents_set.block_postings(word)
+      for word in query.words_counter if documents_set.postings(word)]
+
+  documents = documents_set.documents
+  return [(query, documents[position], score)
+      for (position, score) in itertools.islice(
+      _merge_overlaps(block_postings), top_k)]
+
+
+def _merge_overlaps(postings):
+  """Counts overlaps by a k-way merge of sorted postings.
+
+  Generates (position, overlap) pairs, by decreasing overlap."""
+
+  # As the merge is in document order, each bucket is too.
+  buckets = [[] for _ in xrange(len(postings) + 1)]
+  for (position, group) in itertools.groupby(heapq.merge(*postings)):
+    buckets[len(list(group))].append(position)
+
+  for overlap in xrange(len(postings), 0, -1):
+    for position in buckets[overlap]:
+      yield (position, overlap)
+
+
+def _bitmap_overlaps(bitmaps):
+  """Counts overlaps by adding postings bitmaps into a bit-sliced counter.
+
+  Bit i of planes[j] is bit j of the overlap of document i, so each bitmap is
+  added with a ripple-carry over the planes. Generates (position, overlap)
+  pairs, by decreasing overlap."""
 
-  # Counts the number of each document in the inverted index for each
-  # word in the query. That is, if the query was "bob marley" and we
-  # had {"bob" -> [d1, d4, d6], "marley" -> [d2, d4, d5]}, the result
-  # would be a counter of {d1:1, d2:1, d4:2, d5:1, d6:1}.
-  document_overlaps = counter.Counter()
-  for word in query.words_counter:
-    document_overlaps.update(inverted_index[word])
+  planes = []
+  for bitmap in bitmaps:
+    carry = bitmap
+    for (j, plane) in enumerate(planes):
+      if not carry:
+        break
+      (planes[j], carry) = (plane ^ carry, plane & carry)
+    if carry:
+      planes.append(carry)
 
-  return [(query, d, score) for (d, score) in document_overlaps.most_common()]
+  highest_overlap = min(len(bitmaps), (1 << len(planes)) - 1)
+  for overlap in xrange(highest_overlap, 0, -1):
+    # Select the documents whose planes spell out this overlap.
+    selected = -1
+    for (j, plane) in enumerate(planes):
+      if (overlap >> j) & 1:
+        selected &= plane
+      else:
+        selected &= ~plane
+
+    for position in _set_bits(selected):
+      yield (position, overlap)
+
+
+def _set_bits(bitmap):
+  """Generates the positions of the set bits in a bitmap, lowest first."""
+
+  # Reversed, so that the lowest bit comes first (and without the '0b').
+  binary = bin(bitmap)[:1:-1]
+  position = binary.find('1')
+  while position >= 0:
+    yield position
+    position = binary.find('1', position + 1)
+
+
+def _calculate_overlaps_matrix(queries_set, documents_set, top_k=None):
+  """Calculates the overlaps of every query at once, using numpy and scipy.
+
+  The overlaps are the product of a (query x word) and a (word x document)
+  sparse matrix. The results are ordered as in _calculate_overlap, and are
+  returned as a list of lists of (query, document, overlap) triples, one list
+  per query."""
+
+  # The word x document matrix.
+  word_ids = {}
+  rows = []
+  columns = []
+  for (word, documents) in documents_set.inverted_index.iteritems():
+    if not documents:
+      continue
+
+    postings = documents_set.postings(word)
+    rows.extend([len(word_ids)] * len(postings))
+    columns.extend(postings)
+    word_ids[word] = len(word_ids)
+  word_documents = sparse.csr_matrix(
+      (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+      shape=(len(word_ids), documents_set.number_documents))
+
+  # The query x word matrix.
+  rows = []
+  columns = []
+  for (i, query) in enumerate(queries_set.documents):
+    for word in query.words_counter:
+      if word in word_ids:
+        rows.append(i)
+        columns.append(word_ids[word])
+  query_words = sparse.csr_matrix(
+      (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+      shape=(queries_set.number_documents, len(word_ids)))
+
+  overlaps = query_words * word_documents
+
+  documents = documents_set.documents
+  results = []
+  for (i, query) in enumerate(queries_set.documents):
+    start = overlaps.indptr[i]
+    end = overlaps.indptr[i + 1]
+    positions = overlaps.indices[start:end]
+    scores = overlaps.data[start:end]
+
+    if top_k is not None and top_k < len(scores):
+      # Only sort the candidates that could make the top k.
+      kth_score = numpy.partition(scores, len(scores) - top_k)[-top_k]
+      candidates = scores >= kth_score
+      positions = positions[candidates]
+      scores = scores[candidates]
+
+    order = numpy.lexsort((positions, -scores))[:top_k]
+    results.append([(query, documents[position], int(score))
+        for (position, score) in zip(positions[order], scores[order])])
+
+  return results
 
 
 def main():
@@ -25,17 +182,46 @@ def main():
 
   The results are written out to the file 'overlap.top'."""
 
+  parser = optparse.OptionParser()
+  parser.add_option("-n", "--top-documents",
+      type="int",
+      action="store",
+      dest="top_n",
+      default=None,
+      help="The maximum number of documents to output for each query.")
+  parser.add_option("--engine",
+      type="choice",
+      choices=["postings", "blocks", "matrix"],
+      action="store",
+      dest="engine",
+      default="postings",
+      help="How to score the queries: one at a time from the postings (or "
+           "compressed block postings), or all at once as a sparse matrix "
+           "product (needs numpy and scipy).")
+  (options, args) = parser.parse_args()
+
+  if options.engine == "matrix" and sparse is None:
+    parser.error("The matrix engine needs numpy and scipy.")
+
   query_file = 'data/qrys.txt'
   data_file = 'data/docs.txt'
-  
+
   queries_set = doc.DocumentSet(query_file)
   documents_set = doc.DocumentSet(data_file)
 
-  results = []
-  for query in queries_set.documents:
-    results.extend(_calculate_overlap(query, documents_set.inverted_index))
+  if options.engine == "matrix":
+    results = itertools.chain.from_iterable(_calculate_overlaps_matrix(
+        queries_set, documents_set, options.top_n))
+  elif options.engine == "blocks":
+    results = itertools.chain.from_iterable(
+        _calculate_block_overlap(query, documents_set, options.top_n)
+        for query in queries_set.documents)
+  else:
+    results = itertools.chain.from_iterable(
+        _calculate_overlap(query, documents_set, options.top_n)
+        for query in queries_set.documents)
 
-  # Output the overlaps.
+  # Output the overlaps, which are already ranked.
   output.write_output_file('overlap.top', results)
 
 
@@ -0,0 +1,192 @@
+import collections
+import cProfile
+import functools
+import threading
+import time
+
+# Whether timers and counters are recorded. When False (the default), timed
+# functions cost one extra call and check, and timer() and count() do nothing.
+_enabled = False
+
+# (name, ...) path of nested timers -> [calls, total seconds].
+_timers = {}
+# name -> total.
+_counters = collections.defaultdict(int)
+
+_lock = threading.Lock()
+# Each thread has its own stack of running timer names.
+_local = threading.local()
+_start = None
+
+
+def enable():
+  """Starts recording, clearing anything recorded before."""
+
+  global _enabled, _start
+  _timers.clear()
+  _counters.clear()
+  _start = time.time()
+  _enabled = True
+
+
+def disable():
+  global _enabled
+  _enabled = False
+
+
+class _Timer(object):
+  """Times a 'with' block, nested inside any timers already running."""
+
+  __slots__ = ("name", "path", "start")
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+      stack = _local.stack = []
+    stack.append(self.name)
+    self.path = tuple(stack)
+    self.start = time.time()
+
+  def __exit__(self, *exception):
+    elapsed = time.time() - self.start
+    _local.stack.pop()
+    with _lock:
+      totals = _timers.get(self.path)
+      if totals is None:
+        totals = _timers[self.path] = [0, 0.0]
+      totals[0] += 1
+      totals[1] += elapsed
+
+
+class _NullTimer(object):
+  """Used in place of a _Timer while recording is disabled."""
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exception):
+    pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+  """Returns a context manager timing a block as the stage 'name'."""
+
+  if not _enabled:
+    return _NULL_TIMER
+  return _Timer(name)
+
+
+def timed(name):
+  """A decorator timing every call of a function as the stage 'name'."""
+
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return function(*args, **kwargs)
+      with _Timer(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def count(name, n=1):
+  """Adds n to the counter 'name'."""
+
+  if _enabled:
+    with _lock:
+      _counters[name] += n
+
+
+def report():
+  """Returns the recorded timers (as a tree of stages) and counters."""
+
+  wall = time.time() - _start
+  lines = ["Profile (%.3fs wall):" % wall,
+      "  %-40s %8s %9s %9s %6s" % ("stage", "calls", "total", "self",
+      "%wall")]
+
+  children = collections.defaultdict(list)
+  for path in _timers:
+    children[path[:-1]].append(path)
+
+  def add_lines(parent):
+    for path in sorted(children[parent], key=lambda path: -_timers[path][1]):
+      (calls, total) = _timers[path]
+      own = total - sum([_timers[child][1] for child in children[path]])
+      lines.append("  %-40s %8s %8.3fs %8.3fs %5.1f%%" % (
+          "  " * (len(path) - 1) + path[-1], calls, total, own,
+          100 * total / wall))
+      add_lines(path)
+
+  add_lines(())
+
+  if _counters:
+    lines.append("  %-40s %8s" % ("counter", "total"))
+    for name in sorted(_counters):
+      lines.append("  %-40s %8s" % (name, _counters[name]))
+  return "\n".join(lines)
+
+
+def write_folded(filename):
+  """Writes the timers as folded stacks ('a;b;c microseconds' lines), which
+  flamegraph.pl and speedscope can draw as a flame graph."""
+
+  with open(filename, "w") as f:
+    for (path, (_, total)) in sorted(_timers.iteritems()):
+      children = [child_total for (child, (_, child_total))
+          in _timers.iteritems() if child[:-1] == path]
+      own = total - sum(children)
+      f.write("%s %d\n" % (";".join(path), max(0, own * 1e6)))
+
+
+def add_options(parser):
+  """Adds the --profile options to an optparse parser."""
+
+  parser.add_option("--profile",
+      action="store_true",
+      dest="profile",
+      default=False,
+      help="Print the time spent in each stage, and the counters.")
+  parser.add_option("--profile-output",
+      action="store",
+      dest="profile_output",
+      default=None,
+      help="Also write a cProfile trace of the main thread to this file.")
+  parser.add_option("--profile-folded",
+      action="store",
+      dest="profile_folded",
+      default=None,
+      help="Also write the stages as folded stacks, for flame graphs, to "
+           "this file.")
+
+
+def run(function, options):
+  """Calls function(), profiling it as the options from add_options ask."""
+
+  if not (options.profile or options.profile_output or
+      options.profile_folded):
+    return function()
+
+  profiler = None
+  if options.profile_output:
+    profiler = cProfile.Profile()
+
+  enable()
+  try:
+    with _Timer("total"):
+      if profiler is not None:
+        return profiler.runcall(function)
+      return function()
+  finally:
+    disable()
+    if profiler is not None:
+      profiler.dump_stats(options.profile_output)
+    if options.profile_folded:
+      write_folded(options.profile_folded)
+    print report()
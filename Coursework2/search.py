@@ -1,64 +1,161 @@
 import best
-import errno
-import os
-import re
-import subprocess
+import doc
+import evaluation
 import multiprocessing
+import optparse
+import os
+import signal
 
 # Naughty to do this, but it's a one-off script.
 truth_rel = "truth.rel"
 query_file = "data/qrys.txt"
 data_file = "data/docs.txt"
-regex = "[ ]{9}([01]\.[0-9]{4})"
-search_dir = "search"
+csv_filename = "search.csv"
+
+# How long to wait on a single (k, n_d) pair, in seconds.
+_TIMEOUT = 24 * 60 * 60
+
+# Loaded once in each worker process by _initialize_worker.
+_queries_set = None
+_documents_set = None
+_evaluator = None
+
+# One PRF per k in each worker, so that the pass-1 rankings are shared by
+# every (n_d, n_w) the worker tries for that k.
+_prfs = {}
+
+
+def _initialize_worker():
+  global _queries_set, _documents_set, _evaluator
+
+  # Leave Ctrl-C to the parent, which tears the pool down.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  _queries_set = doc.DocumentSet(query_file)
+  _documents_set = doc.DocumentSet(data_file)
+  _evaluator = evaluation.Evaluator(truth_rel)
 
 
-def run_a_search(k, results):
-  k = float(k) / 10
-  for n_d in xrange(15, 31):
-    n_w_base = (n_d * 2) - 10
-    n_w_ceiling = (n_d * 2) + 10
-    for n_w in xrange(n_w_base, n_w_ceiling):
-      print "Trying (k = %s, n_d = %s, n_w = %s)..." % (k, n_d, n_w)
-      file = "%s_%s_%s.top" % (k, n_d, n_w)
-      output_path = os.path.join(search_dir, file)
+def _n_w_range(n_d):
+  return xrange((n_d * 2) - 10, (n_d * 2) + 10)
 
-      prf = best.PseudoRelevanceFeedback(k, n_d, n_w)
-      prf.calculate_similarity(query_file, data_file, output_path)
 
-      text = subprocess.Popen(["./trec_eval", "-o", "-c", "-M1000",
-          truth_rel, output_path], stdout=subprocess.PIPE).stdout.read()
-      value = float(re.search(regex, text).group(1))
-      results.append((k, n_d, n_w, value))
+def run_a_search(parameters):
+  """Tries every n_w for a single (k, n_d) pair.
 
-      os.remove(output_path)
+  Returns a list of (k, n_d, n_w, MAP) tuples. The PRF pass-1 ranking and
+  'mega document' scores are computed once, and shared by every n_w."""
 
+  (k, n_d) = parameters
+  if k not in _prfs:
+    _prfs[k] = best.PseudoRelevanceFeedback(k, None, None)
+  prf = _prfs[k]
+  prf.n_d = n_d
 
-def run_search():
-  threads = []
   results = []
-  for k in xrange(1, 31):
-    run_a_search(k, results)
+  for n_w in _n_w_range(n_d):
+    prf.n_w = n_w
+    value = _evaluator.mean_average_precision(
+        prf.rank(_queries_set, _documents_set))
+    results.append((k, n_d, n_w, round(value, 4)))
+
+  return results
+
+
+def _read_results():
+  """Reads any results already written to the csv by an earlier run."""
+
+  results = []
+  if not os.path.exists(csv_filename):
+    return results
+
+  with open(csv_filename, "r") as f:
+    for line in f:
+      parts = line.strip().split(",")
+      if len(parts) != 4:
+        continue
+      results.append((float(parts[0]), int(parts[1]), int(parts[2]),
+          float(parts[3])))
+
+  return results
+
+
+def _write_results(results):
+  """Writes the results to the csv, sorted and with a blank line between each
+  value of k (for gnuplot)."""
 
-  csv_filename = "search.csv"
   with open(csv_filename, "w") as f:
     old_doc = 0
-    for result in results:
+    for result in sorted(results):
       if result[0] != old_doc:
         f.write("\n")
         old_doc = result[0]
       f.write(",".join(map (str, result)))
       f.write("\n")
 
-def main():
-  # Make the directory if it doesnt exist.
+
+def run_search(processes=None, fresh=False):
+  """Searches the (k, n_d, n_w) space, spread over a pool of processes.
+
+  Results are appended to the csv as they come in, so a search that is killed
+  can be resumed - any (k, n_d) pair already in the csv is skipped. With
+  'fresh', the csv is emptied first and every pair is tried again."""
+
+  results = [] if fresh else _read_results()
+  done = set((k, n_d, n_w) for (k, n_d, n_w, _) in results)
+
+  pending = []
+  for k in xrange(1, 31):
+    k = float(k) / 10
+    for n_d in xrange(15, 31):
+      if any((k, n_d, n_w) not in done for n_w in _n_w_range(n_d)):
+        pending.append((k, n_d))
+
+  print "%s (k, n_d) pairs to try." % len(pending)
+
+  pool = multiprocessing.Pool(processes, _initialize_worker)
   try:
-    os.mkdir(search_dir)
-  except OSError as exc:
-    if exc.errno != errno.EEXIST:
-      raise
-  
-  run_search()
-    
+    with open(csv_filename, "w" if fresh else "a") as f:
+      # The pairs are handed out in order, so each worker tends to stay on the
+      # same k (and so reuse its pass-1 rankings).
+      search_iterator = pool.imap_unordered(run_a_search, pending)
+      for _ in xrange(len(pending)):
+        # Waiting with a timeout lets Ctrl-C through in Python 2.
+        search_results = search_iterator.next(_TIMEOUT)
+        for result in search_results:
+          if result[:3] in done:
+            continue
+          print "(k = %s, n_d = %s, n_w = %s): %s" % result
+          f.write(",".join(map (str, result)))
+          f.write("\n")
+          results.append(result)
+        f.flush()
+  finally:
+    pool.terminate()
+
+  _write_results(results)
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [-p PROCESSES] [--fresh]",
+      description="Searches the PRF parameters for the best MAP, writing "
+      "the results to search.csv. The (k, n_d) pairs already in search.csv "
+      "are skipped, so a search that was killed carries on where it stopped; "
+      "use --fresh to run the whole search again.")
+  parser.add_option("-p", "--processes",
+      type="int",
+      action="store",
+      dest="processes",
+      default=None,
+      help="The number of processes to search with (default: one per CPU).")
+  parser.add_option("--fresh",
+      action="store_true",
+      dest="fresh",
+      default=False,
+      help="Discard the results in search.csv and try every pair again.")
+  (options, args) = parser.parse_args()
+
+  run_search(options.processes, options.fresh)
+
 if __name__ == "__main__":
   main()
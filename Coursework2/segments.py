@@ -0,0 +1,155 @@
+import collections
+import math
+import threading
+
+# Segments are merged once there are _FANOUT of them at the same level, where
+# a segment of n documents is at level log_FANOUT(n). This keeps the number of
+# segments logarithmic in the number of documents.
+_FANOUT = 4
+
+# Returned for words that are not in the index.
+_NO_DOCUMENTS = frozenset()
+
+
+class Segment(object):
+  """An inverted index over a batch of documents.
+
+  Segments are never changed once built - new documents go into new segments,
+  and segments are combined by merging them into a new one."""
+
+  def __init__(self, documents, inverted_index=None):
+    self.documents = documents
+
+    if inverted_index is None:
+      inverted_index = collections.defaultdict(set)
+      for document in documents:
+        for word in document.words_counter:
+          inverted_index[word].add(document)
+    self.inverted_index = inverted_index
+
+    self.level = int(math.log(max(len(documents), 1), _FANOUT))
+
+  @staticmethod
+  def merge(segments):
+    """Merges a list of segments into a single new segment."""
+
+    documents = []
+    inverted_index = collections.defaultdict(set)
+    for segment in segments:
+      documents.extend(segment.documents)
+      for (word, word_documents) in segment.inverted_index.iteritems():
+        inverted_index[word].update(word_documents)
+
+    return Segment(documents, inverted_index)
+
+
+class SegmentedIndex(object):
+  """A read-only inverted index over a tuple of segments.
+
+  This behaves like the word -> set of documents dictionary it replaces: the
+  sets of all segments are combined for each word, and unknown words give an
+  empty set."""
+
+  def __init__(self, segments):
+    self.segments = tuple(segments)
+
+  def __getitem__(self, word):
+    if len(self.segments) == 1:
+      return self.segments[0].inverted_index.get(word, _NO_DOCUMENTS)
+
+    documents = [segment.inverted_index[word] for segment in self.segments
+        if word in segment.inverted_index]
+    if not documents:
+      return _NO_DOCUMENTS
+    if len(documents) == 1:
+      return documents[0]
+    return frozenset().union(*documents)
+
+  def __contains__(self, word):
+    for segment in self.segments:
+      if word in segment.inverted_index:
+        return True
+    return False
+
+  def __iter__(self):
+    if len(self.segments) == 1:
+      return iter(self.segments[0].inverted_index)
+
+    seen = set()
+    for segment in self.segments:
+      seen.update(segment.inverted_index)
+    return iter(seen)
+
+  def get(self, word, default=None):
+    if word in self:
+      return self[word]
+    return default
+
+  def iteritems(self):
+    for word in self:
+      yield (word, self[word])
+
+
+class SegmentMerger(object):
+  """Merges the segments of a DocumentSet in a background thread.
+
+  Whenever _FANOUT segments are at the same level, they are merged into one
+  (at a higher level), as in a log-structured merge tree. The merge itself is
+  done without holding the document set's lock, so neither queries nor new
+  documents wait for it - only the final swap of the merged segment into the
+  index is locked."""
+
+  def __init__(self, documents_set):
+    self._documents_set = documents_set
+    self._wake = threading.Condition(documents_set.lock)
+    self._merging = False
+
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def notify(self):
+    """Tells the merger that a segment has been added.
+
+    Must be called with the document set's lock held."""
+
+    self._wake.notify()
+
+  def wait(self):
+    """Waits until there is nothing left to merge."""
+
+    with self._wake:
+      while self._merging or \
+          _merge_candidates(self._documents_set.inverted_index.segments):
+        self._wake.wait()
+
+  def _run(self):
+    while True:
+      with self._wake:
+        self._merging = False
+        self._wake.notify_all()
+
+        candidates = _merge_candidates(
+            self._documents_set.inverted_index.segments)
+        while not candidates:
+          self._wake.wait()
+          candidates = _merge_candidates(
+              self._documents_set.inverted_index.segments)
+        self._merging = True
+
+      merged = Segment.merge(candidates)
+
+      with self._wake:
+        self._documents_set._replace_segments(candidates, merged)
+
+
+def _merge_candidates(segments):
+  """Returns _FANOUT segments from the same level, or None."""
+
+  levels = collections.defaultdict(list)
+  for segment in segments:
+    levels[segment.level].append(segment)
+    if len(levels[segment.level]) == _FANOUT:
+      return levels[segment.level]
+
+  return None
@@ -0,0 +1,288 @@
+import BaseHTTPServer
+import best
+import cache
+import doc
+import heapq
+import json
+import operator
+import optparse
+import overlap
+import Queue
+import SocketServer
+import sys
+import threading
+import tfidf
+import time
+import urlparse
+
+
+class QueryEngine(object):
+  """Answers tf.idf, overlap and PRF queries against a loaded document set.
+
+  Scores are kept in a two-level cache.ScoreCache: tf.idf and PRF share the
+  per-term scores, and whole results are keyed by the normalized query - so
+  the same words in any order (with the same method and number of results)
+  are only scored once, until documents are added to the set."""
+
+  METHODS = ("tfidf", "overlap", "prf")
+
+  def __init__(self, documents_set, k=None, n_d=None, n_w=None,
+      cache_bytes=64 << 20):
+    self.documents_set = documents_set
+
+    # Three quarters of the memory goes to the term scores, as they are
+    # reused by many different queries.
+    self.cache = cache.ScoreCache(cache_bytes * 3 / 4, cache_bytes / 4)
+    self.tf_idf = tfidf.TfIdf(k, self.cache)
+    self.prf = best.PseudoRelevanceFeedback(k, n_d, n_w, self.cache)
+
+  def search(self, method, words, top_n=10):
+    """Runs a query, given as a list of words.
+
+    Returns a list of (document id, similarity) pairs, best first."""
+
+    if method not in QueryEngine.METHODS:
+      raise ValueError("Unknown method '%s'." % method)
+
+    self.cache.validate(self.documents_set)
+    key = (method, normalize(words), top_n)
+    answer = self.cache.queries.get(key)
+    if answer is not None:
+      return answer
+
+    # Words the set has never seen can't score, and aren't interned, so
+    # queries can't grow the vocabulary.
+    ids = self.documents_set.vocabulary.ids
+    query = doc.Document(None, [ids[word] for word in words if word in ids])
+    if method == "tfidf":
+      results = self.tf_idf._tfidf(query, self.documents_set)
+    elif method == "overlap":
+      results = overlap._calculate_overlap(query, self.documents_set, top_n)
+    else:
+      results = self.prf.rank_query(query, self.documents_set)
+
+    ranked = heapq.nlargest(top_n, results, key=operator.itemgetter(2))
+    answer = [(d.id, similarity) for (_, d, similarity) in ranked]
+
+    self.cache.queries.put(key, answer, cache.pairs_size(answer))
+    return answer
+
+
+def normalize(words):
+  """Normalizes a query, so that the order of its words doesn't matter."""
+
+  return tuple(sorted(words))
+
+
+class _Request(object):
+  """A query waiting to be run by the MicroBatcher."""
+
+  def __init__(self, method, words, top_n):
+    self.method = method
+    self.words = words
+    self.top_n = top_n
+    self.key = (method, normalize(words), top_n)
+
+    self.done = threading.Event()
+    self.results = None
+    self.error = None
+
+
+class MicroBatcher(object):
+  """Runs concurrent queries in small batches, on a single thread.
+
+  The first query of a batch waits up to 'window' seconds for others to join
+  it (up to max_batch queries). Each batch is run back-to-back by one thread,
+  rather than many request threads fighting over the interpreter, and
+  identical queries within a batch are only run once."""
+
+  def __init__(self, engine, window=0.002, max_batch=64):
+    self.engine = engine
+    self.window = window
+    self.max_batch = max_batch
+
+    self.batches = 0
+    self.queries = 0
+
+    self._queue = Queue.Queue()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def search(self, method, words, top_n=10):
+    """Queues a query and waits for its results (see QueryEngine.search)."""
+
+    request = _Request(method, words, top_n)
+    self._queue.put(request)
+    request.done.wait()
+
+    if request.error is not None:
+      raise request.error
+    return request.results
+
+  def _run(self):
+    while True:
+      batch = [self._queue.get()]
+      deadline = time.time() + self.window
+      while len(batch) < self.max_batch:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self._queue.get(True, remaining))
+        except Queue.Empty:
+          break
+
+      self._run_batch(batch)
+
+  def _run_batch(self, batch):
+    self.batches += 1
+    self.queries += len(batch)
+
+    answers = {}
+    for request in batch:
+      if request.key not in answers:
+        try:
+          answers[request.key] = (self.engine.search(request.method,
+              request.words, request.top_n), None)
+        except Exception:
+          answers[request.key] = (None, sys.exc_info()[1])
+
+      (request.results, request.error) = answers[request.key]
+      request.done.set()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handles GET /search?method=...&q=...&n=... and GET /stats."""
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    parameters = urlparse.parse_qs(url.query)
+
+    if url.path == "/stats":
+      self._respond(200, self.server.stats())
+      return
+
+    if url.path != "/search":
+      self._respond(404, {"error": "Unknown path '%s'." % url.path})
+      return
+
+    method = parameters.get("method", ["tfidf"])[0]
+    words = parameters.get("q", [""])[0].split()
+    try:
+      top_n = int(parameters.get("n", ["10"])[0])
+    except ValueError:
+      top_n = -1
+    if top_n < 0:
+      self._respond(400, {"error": "n must be a non-negative integer."})
+      return
+
+    try:
+      results = self.server.batcher.search(method, words, top_n)
+    except ValueError as e:
+      self._respond(400, {"error": str(e)})
+      return
+    except Exception as e:
+      self._respond(500, {"error": "%s: %s" % (type(e).__name__, e)})
+      return
+
+    self._respond(200, {"method": method, "query": words,
+        "results": results})
+
+  def _respond(self, status, body):
+    text = json.dumps(body)
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(text)))
+    self.end_headers()
+    self.wfile.write(text)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An HTTP server answering queries through a MicroBatcher."""
+
+  daemon_threads = True
+  request_queue_size = 128
+
+  def __init__(self, address, batcher, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.batcher = batcher
+    self.verbose = verbose
+
+  def stats(self):
+    engine = self.batcher.engine
+    return {"documents": engine.documents_set.number_documents,
+        "cache": engine.cache.stats(),
+        "batches": self.batcher.batches,
+        "queries": self.batcher.queries}
+
+
+def main():
+  """Loads docs.txt once, then answers queries over HTTP until killed."""
+
+  parser = optparse.OptionParser()
+  parser.add_option("--host",
+      action="store",
+      dest="host",
+      default="127.0.0.1",
+      help="The address to listen on.")
+  parser.add_option("-p", "--port",
+      type="int",
+      action="store",
+      dest="port",
+      default=8000,
+      help="The port to listen on.")
+  parser.add_option("-k",
+      type="float",
+      action="store",
+      dest="k",
+      default=None,
+      help="The value of the constant used in tf.idf.")
+  parser.add_option("--batch-window",
+      type="float",
+      action="store",
+      dest="window",
+      default=2,
+      help="How long (in ms) a query waits for others to batch with.")
+  parser.add_option("--max-batch",
+      type="int",
+      action="store",
+      dest="max_batch",
+      default=64,
+      help="The maximum number of queries in a batch.")
+  parser.add_option("--cache-mb",
+      type="int",
+      action="store",
+      dest="cache_mb",
+      default=64,
+      help="The memory (in MB) to use for caching scores and results.")
+  parser.add_option("-v", "--verbose",
+      action="store_true",
+      dest="verbose",
+      default=False,
+      help="Log every request.")
+  (options, args) = parser.parse_args()
+
+  data_file = "data/docs.txt"
+
+  print "Loading %s." % data_file
+  documents_set = doc.DocumentSet(data_file)
+
+  engine = QueryEngine(documents_set, k=options.k,
+      cache_bytes=options.cache_mb << 20)
+  batcher = MicroBatcher(engine, options.window / 1000.0, options.max_batch)
+  server = QueryServer((options.host, options.port), batcher, options.verbose)
+
+  print "Listening on http://%s:%s/search" % (options.host, options.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,380 @@
+import array
+import doc
+import gc
+import heapq
+import ingest
+import itertools
+import math
+import multiprocessing
+import os
+import profiling
+import shutil
+import signal
+import tempfile
+import tfidf
+import traceback
+
+# The number of queries scattered to the shards at a time. Each shard scores
+# a whole batch before replying, so larger batches mean fewer round trips but
+# more results held in memory at once.
+_BATCH_QUERIES = 16
+
+# The number of bytes copied at a time when splitting a document file.
+_COPY_SIZE = 1 << 20
+
+
+def split(document_filename, directory, number_shards):
+  """Splits a document file into (at most) number_shards shard files in
+  directory, returning their names.
+
+  Each shard is a contiguous run of lines of about the same size, so the
+  shards together hold the documents in their original order. Shards that
+  would be empty (for tiny files) are left out."""
+
+  size = os.path.getsize(document_filename)
+  filenames = []
+  with open(document_filename, 'r') as f:
+    for i in xrange(number_shards):
+      end = size * (i + 1) / number_shards
+      filename = os.path.join(directory, "shard%03d.txt" % i)
+      with open(filename, 'w') as shard_file:
+        while f.tell() < end:
+          shard_file.write(f.read(min(_COPY_SIZE, end - f.tell())))
+        # Finish the line the shard ends in.
+        shard_file.write(f.readline())
+
+      if os.path.getsize(filename):
+        filenames.append(filename)
+      else:
+        os.remove(filename)
+  return filenames
+
+
+class Shard(doc.DocumentSet):
+  """A DocumentSet holding one shard of a collection, which scores its
+  documents using the statistics of the whole collection.
+
+  Until set_statistics is called, the shard's own statistics are used. After
+  it, idf and avg_length give what the unsharded collection would, so tf.idf
+  scores are identical to the unsharded engine's."""
+
+  def __init__(self, document_filename, vocabulary):
+    doc.DocumentSet.__init__(self, document_filename, vocabulary)
+    self._global_idfs = None
+
+  def statistics(self):
+    """Returns (number of documents, total length, terms, dfs), where terms
+    is every term in the shard (by id) and dfs their document frequencies."""
+
+    terms = list(self.vocabulary.terms)
+    dfs = array.array('i', [len(self.inverted_index[word])
+        for word in xrange(len(terms))])
+    return (self.number_documents, self._total_length, terms, dfs)
+
+  def set_statistics(self, number_documents, total_length, dfs):
+    """Sets the statistics of the whole collection: its number of documents
+    and total length, and the df of each of the shard's terms (by id)."""
+
+    self.avg_length = float(total_length) / number_documents
+    self._global_idfs = [math.log(float(number_documents) / df)
+        for df in dfs]
+
+  def idf(self, word):
+    if self._global_idfs is None:
+      return doc.DocumentSet.idf(self, word)
+    return self._global_idfs[word]
+
+  def add_documents(self, documents):
+    raise NotImplementedError("Shards are read-only.")
+
+
+class ShardDocument(object):
+  """A document held by one of the shards, known only by its id."""
+
+  __slots__ = ("id",)
+
+  def __init__(self, document_id):
+    self.id = document_id
+
+
+class _RankedCounter(dict):
+  """The words_counter of a query sent to a shard.
+
+  most_common() gives the words in the order the coordinator ranked them, as
+  the order each document's score is summed in can change its last bits."""
+
+  def __init__(self, ranked_words):
+    dict.__init__(self, ranked_words)
+    self._ranked_words = ranked_words
+
+  def __missing__(self, word):
+    return 0
+
+  def most_common(self):
+    return list(self._ranked_words)
+
+
+class _Query(object):
+  """A query, as scored by a shard."""
+
+  def __init__(self, query_id, ranked_words):
+    self.id = query_id
+    self.words_counter = _RankedCounter(ranked_words)
+    self.length = sum([tf_q for (_, tf_q) in ranked_words])
+
+
+def _rank(shard, tf_idf, query, top_n, engine, with_words):
+  """Scores a query against a shard, returning its top_n (or all) results as
+  (document ids, scores) arrays, best first.
+
+  Ties are broken by document id, so results merge in the same order however
+  the collection is sharded. With with_words, the words of each document are
+  returned too, as lists of (term, tf) pairs."""
+
+  if engine == "blocks" and top_n is not None:
+    results = tf_idf._top_tfidf(query, shard, top_n)
+  else:
+    results = tf_idf._tfidf(query, shard)
+
+  ranked = [(-score, document.id, document) for (_, document, score)
+      in results]
+  if top_n is None:
+    ranked.sort()
+  else:
+    ranked = heapq.nsmallest(top_n, ranked)
+
+  document_ids = array.array('i', [document_id for (_, document_id, _)
+      in ranked])
+  scores = array.array('d', [-score for (score, _, _) in ranked])
+  if not with_words:
+    return (document_ids, scores)
+
+  terms = shard.vocabulary.terms
+  words = [[(terms[word], tf) for (word, tf)
+      in document.words_counter.iteritems()] for (_, _, document) in ranked]
+  return (document_ids, scores, words)
+
+
+def _serve(connection, document_filename):
+  """Runs a shard in a worker process, answering requests from connection.
+
+  The shard's statistics are sent first, and the whole collection's are
+  received back. Then each request, a (k, queries, top_n, engine,
+  with_words) tuple, is answered with a list of _rank's results (one per
+  query), until None is received. Errors are sent back as their traceback."""
+
+  # Leave Ctrl-C to the coordinator, which shuts the shards down.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  # The shard has its own vocabulary, as terms are sent as strings.
+  shard = Shard(document_filename, ingest.Vocabulary())
+  connection.send(shard.statistics())
+  shard.set_statistics(*connection.recv())
+
+  # From here on the shard is only read, and scoring makes no reference
+  # cycles. Left running, the cycle collector walks every object in the shard
+  # (and those inherited from the coordinator) again and again, which more
+  # than doubles the time taken to score.
+  gc.collect()
+  gc.disable()
+
+  ids = shard.vocabulary.ids
+  tf_idfs = {}
+  while True:
+    request = connection.recv()
+    if request is None:
+      break
+
+    try:
+      (k, queries, top_n, engine, with_words) = request
+      if k not in tf_idfs:
+        tf_idfs[k] = tfidf.TfIdf(k)
+
+      replies = []
+      for (query_id, ranked_words) in queries:
+        # Words not in the shard can't add to any of its scores.
+        query = _Query(query_id, [(ids[term], tf_q)
+            for (term, tf_q) in ranked_words if term in ids])
+        replies.append(_rank(shard, tf_idfs[k], query, top_n, engine,
+            with_words))
+      connection.send(("ok", replies))
+    except Exception:
+      connection.send(("error", traceback.format_exc()))
+  connection.close()
+
+
+class ShardedIndex(object):
+  """A collection split into shards, each indexed by its own worker process.
+
+  The shards' statistics are exchanged once, when the index is built: the
+  coordinator (this process) sums their numbers of documents, lengths and
+  dfs, and sends each shard the totals. Every shard then scores exactly as
+  the unsharded collection would, so queries are scattered to every shard and
+  their (ranked) top results merged with a heap.
+
+  The coordinator keeps the vocabulary and dfs of the whole collection, so it
+  can give idfs (and the average length) for PRF's mega documents. Terms are
+  interned into the vocabulary it is given (by default the one the queries
+  share), so its ids agree with the queries'. They are not, in general, the
+  ids the whole file would get if loaded on its own, as the vocabulary
+  usually holds the queries' words first; nothing needs them to be, as terms
+  are sent to and from the shards as strings."""
+
+  def __init__(self, document_filename, number_shards, vocabulary=None):
+    if vocabulary is None:
+      vocabulary = doc.VOCABULARY
+    self.vocabulary = vocabulary
+
+    self._directory = tempfile.mkdtemp()
+    self._connections = []
+    self._workers = []
+    try:
+      with profiling.timer("shards: start"):
+        for filename in split(document_filename, self._directory,
+            number_shards):
+          (connection, worker_connection) = multiprocessing.Pipe()
+          worker = multiprocessing.Process(target=_serve,
+              args=(worker_connection, filename))
+          worker.daemon = True
+          worker.start()
+          self._connections.append(connection)
+          self._workers.append(worker)
+
+        self._exchange_statistics()
+    except:
+      self.close()
+      raise
+
+  def _exchange_statistics(self):
+    """Gathers the shards' statistics, and sends each shard the totals."""
+
+    shard_statistics = [connection.recv() for connection in self._connections]
+
+    intern = self.vocabulary.intern
+    # word id -> df, over every shard.
+    self._dfs = {}
+    self.number_documents = 0
+    total_length = 0
+    for (number_documents, length, terms, dfs) in shard_statistics:
+      self.number_documents += number_documents
+      total_length += length
+      for (term, df) in itertools.izip(terms, dfs):
+        word = intern(term)
+        self._dfs[word] = self._dfs.get(word, 0) + df
+    self.avg_length = float(total_length) / self.number_documents
+
+    ids = self.vocabulary.ids
+    for (connection, (_, _, terms, _)) in itertools.izip(self._connections,
+        shard_statistics):
+      connection.send((self.number_documents, total_length,
+          array.array('i', [self._dfs[ids[term]] for term in terms])))
+
+  def number_shards(self):
+    return len(self._connections)
+
+  def idf(self, word):
+    """Returns log(|C| / df_w) over the whole collection, or 0 for words not
+    in it."""
+
+    df = self._dfs.get(word)
+    if not df:
+      return 0.0
+    return math.log(float(self.number_documents) / df)
+
+  def close(self):
+    """Stops the workers, and removes the shard files."""
+
+    for connection in self._connections:
+      try:
+        connection.send(None)
+      except IOError:
+        pass
+    for worker in self._workers:
+      worker.join()
+    self._connections = []
+    self._workers = []
+    shutil.rmtree(self._directory, ignore_errors=True)
+
+  def _scatter_gather(self, k, queries, top_n, engine="loop",
+      with_words=False):
+    """Scores a list of queries on every shard at once, returning a list (one
+    per query) of the shards' _rank results."""
+
+    terms = self.vocabulary.terms
+    request = (k, [(query.id, [(terms[word], tf_q) for (word, tf_q)
+        in query.words_counter.most_common()]) for query in queries],
+        top_n, engine, with_words)
+    for connection in self._connections:
+      connection.send(request)
+
+    with profiling.timer("shards: wait"):
+      replies = []
+      for connection in self._connections:
+        (status, reply) = connection.recv()
+        if status != "ok":
+          raise RuntimeError("A shard failed:\n%s" % reply)
+        replies.append(reply)
+    profiling.count("shard requests", len(replies))
+    return zip(*replies)
+
+  def _merge(self, shard_results, top_n):
+    """Merges the shards' ranked results for a query, returning the top_n
+    (or all) as (-score, document id, shard, rank in shard), best first."""
+
+    ranked = [itertools.izip([-score for score in result[1]], result[0],
+        itertools.repeat(i), itertools.count())
+        for (i, result) in enumerate(shard_results)]
+    merged = heapq.merge(*ranked)
+    if top_n is not None:
+      merged = itertools.islice(merged, top_n)
+    return list(merged)
+
+  def rank_tfidf(self, queries_set, k, top_n=None, engine="loop"):
+    """Ranks every query in a set by tf.idf, with the 'loop' or 'blocks'
+    engine of tfidf.TfIdf.
+
+    A list of (query, document, similarity) triples is generated for each
+    query in turn, best document first, limited to the top_n (if given)."""
+
+    queries = queries_set.documents
+    for start in xrange(0, len(queries), _BATCH_QUERIES):
+      batch = queries[start:start + _BATCH_QUERIES]
+      for (query, shard_results) in zip(batch,
+          self._scatter_gather(k, batch, top_n, engine)):
+        with profiling.timer("shards: merge"):
+          yield [(query, ShardDocument(document_id), -score) for
+              (score, document_id, _, _) in self._merge(shard_results, top_n)]
+
+  def rank_prf(self, queries_set, prf, top_n=None):
+    """Ranks every query in a set with a best.PseudoRelevanceFeedback.
+
+    The first pass is scattered like rank_tfidf, keeping only each shard's
+    top n_d documents (and their words). The coordinator merges them, scores
+    the mega document and builds the expanded query, which is scattered
+    again for the second pass. Results are generated as by rank_tfidf."""
+
+    queries = queries_set.documents
+    intern_all = self.vocabulary.intern_all
+    for start in xrange(0, len(queries), _BATCH_QUERIES):
+      batch = queries[start:start + _BATCH_QUERIES]
+
+      new_queries = []
+      for (query, shard_results) in zip(batch,
+          self._scatter_gather(prf.k, batch, prf.n_d, with_words=True)):
+        selected_docs = []
+        for (_, document_id, shard, rank) in self._merge(shard_results,
+            prf.n_d):
+          words = shard_results[shard][2][rank]
+          selected_docs.append(doc.document_from_dict(document_id, dict(
+              zip(intern_all([term for (term, _) in words]),
+              [tf for (_, tf) in words]))))
+
+        word_scores = prf._mega_document_scores(query, selected_docs, self)
+        new_queries.append(prf._expanded_query(query, word_scores,
+            self.vocabulary))
+
+      for (query, shard_results) in zip(batch,
+          self._scatter_gather(prf.k, new_queries, top_n)):
+        with profiling.timer("shards: merge"):
+          yield [(query, ShardDocument(document_id), -score) for
+              (score, document_id, _, _) in self._merge(shard_results, top_n)]
@@ -0,0 +1,102 @@
+import collections
+import evaluation
+import os
+import unittest
+
+_TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "testdata")
+
+# A small truth file and .top file, and the metrics trec_eval -q -c gives for
+# them (in its usual 'measure query value' form). The results include ties
+# on similarity, which trec_eval breaks by decreasing document id, compared
+# as strings (so '9' comes before '10'), whatever order the lines are in.
+TRUTH = os.path.join(_TESTDATA, "truth.rel")
+RESULTS = os.path.join(_TESTDATA, "results.top")
+REFERENCE = os.path.join(_TESTDATA, "trec_eval.txt")
+
+# Set to a trec_eval binary to also check the reference against it.
+TREC_EVAL = os.environ.get("TREC_EVAL")
+
+_Item = collections.namedtuple("_Item", ["id"])
+
+
+def _read_reference(filename):
+  """Reads trec_eval -q output as a dictionary of query id -> {measure ->
+  value}, where the query id 'all' holds the means."""
+
+  reference = collections.defaultdict(dict)
+  with open(filename, 'r') as f:
+    for line in f:
+      (measure, query_id, value) = line.split()
+      reference[query_id][measure] = float(value)
+  return reference
+
+
+def _measure(evaluation, measure):
+  """Returns the value of a trec_eval measure from an Evaluation."""
+
+  if measure == "map":
+    return evaluation.average_precision
+  if measure == "Rprec":
+    return evaluation.r_precision
+  return evaluation.precision[int(measure[len("P_"):])]
+
+
+class EvaluatorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.evaluator = evaluation.Evaluator(TRUTH)
+    self.reference = _read_reference(REFERENCE)
+
+  def assertMatches(self, expected, actual, message):
+    # trec_eval rounds to 4 decimal places.
+    self.assertTrue(abs(expected - actual) <= 0.00005 + 1e-9,
+        "%s: expected %.4f, got %.4f" % (message, expected, actual))
+
+  def test_ties_are_broken_by_decreasing_document_id(self):
+    rankings = self.evaluator.read_rankings(RESULTS)
+    self.assertEqual(["1", "9", "10", "3", "5", "12", "11", "6"],
+        rankings["1"])
+    self.assertEqual(["2", "13", "8", "4"], rankings["2"])
+
+  def test_rankings_of_results_match_the_top_file(self):
+    results = []
+    with open(RESULTS, 'r') as f:
+      for line in f:
+        parts = line.split()
+        results.append((_Item(int(parts[0])), _Item(int(parts[2])),
+            float(parts[4])))
+
+    self.assertEqual(self.evaluator.read_rankings(RESULTS),
+        self.evaluator.rankings(results))
+
+  def test_queries_match_trec_eval(self):
+    evaluations = self.evaluator.evaluate_queries(
+        self.evaluator.read_rankings(RESULTS))
+    for (query_id, measures) in self.reference.iteritems():
+      if query_id == "all":
+        continue
+      for (measure, value) in measures.iteritems():
+        self.assertMatches(value, _measure(evaluations[query_id], measure),
+            "%s of query %s" % (measure, query_id))
+
+  def test_means_match_trec_eval(self):
+    # As with trec_eval -c, query 3 has no results but counts in the means,
+    # and query 4 has no relevance judgements so doesn't.
+    mean = self.evaluator.evaluate(self.evaluator.read_rankings(RESULTS))
+    for (measure, value) in self.reference["all"].iteritems():
+      self.assertMatches(value, _measure(mean, measure), measure)
+
+  def test_reference_matches_trec_eval(self):
+    if not TREC_EVAL:
+      return
+
+    metrics = evaluation._run_trec_eval(TREC_EVAL, TRUTH, RESULTS, 1000)
+    names = {"map": "map", "Rprec": "R-prec"}
+    for (measure, value) in self.reference["all"].iteritems():
+      name = names.get(measure, measure.replace("_", ""))
+      self.assertMatches(value, metrics[name], measure)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,62 +1,380 @@
+import array
+import cache
 import collections
 import doc
+import heapq
 import itertools
-import math
+import operator
+import optparse
 import output
+import profiling
+import shards
+
+# numpy and scipy are only needed for the 'matrix' engine.
+try:
+  import numpy
+  from scipy import sparse
+except ImportError:
+  numpy = None
+  sparse = None
 
 class TfIdf(object):
 
   # The default value for the 'k' constant in tf.idf.
   _K = 2
 
-  def __init__(self, k=None):
+  def __init__(self, k=None, cache=None):
     if k is None:
       k = TfIdf._K
     self.k = k
 
+    # An optional cache.ScoreCache, holding each term's scores.
+    self.cache = cache
+
+    # The per-document (k|D| / avg|D|) values of the last document set seen,
+    # and the version of the set they were calculated for.
+    self._squashers_set = None
+    self._squashers_version = None
+    self._squashers = None
+
   def _document_tfidf(self, word, document, doc_set):
     """Calculates the tf.idf for a document (without the tf_q term)."""
     tf_d = document.words_counter[word]
-    df = len(doc_set.inverted_index[word])
 
     # log(|C| / df_w)
-    idf = math.log(doc_set.number_documents / float(df))
+    idf = doc_set.idf(word)
 
     # (k|D| / avg|D|)
-    squasher = float(self.k * document.length) / doc_set.avg_length
+    squasher = self._squasher(document.length, doc_set)
 
     # (tf_w,D / (tf_w,D + ((k|D| / avg|D|))) * log(|C| / df_w)
     return (tf_d / (tf_d + squasher)) * idf
 
+  def _squasher(self, length, doc_set):
+    """Calculates (k|D| / avg|D|) for a document of the given length."""
+
+    return float(self.k * length) / doc_set.avg_length
+
+  def _document_squashers(self, doc_set):
+    """Returns a dictionary of document -> (k|D| / avg|D|) for a set.
+
+    The dictionary is filled in as documents are scored, and reused for as
+    long as the same document set is being queried and no documents are added
+    to it."""
+
+    version = doc_set.version
+    if self._squashers_set is not doc_set or \
+        self._squashers_version != version:
+      self._squashers = {}
+      self._squashers_set = doc_set
+      self._squashers_version = version
+    return self._squashers
+
+  def _term_scores(self, word, document_set):
+    """Calculates a word's tf.idf (without the tf_q term) for every document
+    containing it, as a list of (document, score) pairs."""
+
+    idf = document_set.idf(word)
+    squashers = self._document_squashers(document_set)
+
+    scores = []
+    for document in document_set.inverted_index[word]:
+      tf_d = document.words_counter[word]
+      squasher = squashers.get(document)
+      if squasher is None:
+        squasher = self._squasher(document.length, document_set)
+        squashers[document] = squasher
+
+      scores.append((document, (tf_d / (tf_d + squasher)) * idf))
+    return scores
+
+  @profiling.timed("tf.idf")
   def _tfidf(self, query, document_set):
     """Calculates the similarity between a query and all applicable documents.
 
-    An inverted index is used to look up the relevant documents for a query."""
+    An inverted index is used to look up the relevant documents for a query.
+    This is _document_tfidf inlined, using the cached idfs and squashers. If
+    there is a ScoreCache, each word's scores are taken from (or added to)
+    it instead."""
+
+    if self.cache is not None:
+      return self._cached_tfidf(query, document_set)
 
     document_tfidfs = collections.defaultdict(float)
+    squashers = self._document_squashers(document_set)
 
     for (word, tf_q) in query.words_counter.most_common():
       matching_documents = document_set.inverted_index[word]
+      if not matching_documents:
+        continue
+      idf = document_set.idf(word)
+      profiling.count("postings scanned", len(matching_documents))
 
       for document in matching_documents:
-        document_tfidfs[document] += tf_q * self._document_tfidf(
-            word, document, document_set)
+        tf_d = document.words_counter[word]
+        squasher = squashers.get(document)
+        if squasher is None:
+          squasher = self._squasher(document.length, document_set)
+          squashers[document] = squasher
+
+        document_tfidfs[document] += tf_q * ((tf_d / (tf_d + squasher)) * idf)
 
+    profiling.count("documents scored", len(document_tfidfs))
     return [(query, d, score) for (d, score) in document_tfidfs.items()]
 
-  def calculate_similarity(self, query_file, data_file, filename, k=None):
+  def _cached_tfidf(self, query, document_set):
+    """_tfidf, taking each word's scores from the ScoreCache."""
+
+    self.cache.validate(document_set)
+    terms = self.cache.terms
+
+    document_tfidfs = collections.defaultdict(float)
+    for (word, tf_q) in query.words_counter.most_common():
+      key = (self.k, word)
+      scores = terms.get(key)
+      if scores is None:
+        scores = self._term_scores(word, document_set)
+        terms.put(key, scores, cache.pairs_size(scores))
+
+      profiling.count("postings scanned", len(scores))
+      for (document, score) in scores:
+        document_tfidfs[document] += tf_q * score
+
+    profiling.count("documents scored", len(document_tfidfs))
+    return [(query, d, score) for (d, score) in document_tfidfs.items()]
+
+  @profiling.timed("tf.idf (block-max)")
+  def _top_tfidf(self, query, document_set, top_n):
+    """Calculates the top_n documents by tf.idf, with block-max pruning.
+
+    Words are scored in decreasing order of their best possible score, using
+    each word's blocks.BlockPostings. Once the best possible score of the
+    remaining words cannot lift a new document into the top_n, only the
+    documents that can still make it are scored - decoding only the blocks
+    holding them, and dropping them once their block's bound shows they cannot
+    make it. The top_n documents are then scored exactly as in _tfidf, so the
+    results are the same."""
+
+    squash = float(self.k) / document_set.avg_length
+
+    terms = []
+    for (word, tf_q) in query.words_counter.most_common():
+      block_postings = document_set.block_postings(word)
+      if not block_postings:
+        continue
+
+      weight = tf_q * document_set.idf(word)
+      bounds = [weight * block_postings.max_impact(i, squash)
+          for i in xrange(block_postings.number_blocks())]
+      terms.append((max(bounds), weight, bounds, block_postings))
+    terms.sort(reverse=True)
+
+    # The best possible score from terms[i:], for each i.
+    remaining = [0.0] * (len(terms) + 1)
+    for i in xrange(len(terms) - 1, -1, -1):
+      remaining[i] = remaining[i + 1] + terms[i][0]
+
+    # position -> score so far.
+    scores = {}
+    for (i, (_, weight, bounds, block_postings)) in enumerate(terms):
+      # No document scoring below the threshold can be in the top_n.
+      threshold = 0.0
+      if len(scores) >= top_n:
+        threshold = heapq.nlargest(top_n, scores.itervalues())[-1]
+
+      if remaining[i] >= threshold:
+        # A new document could still make the top_n: score every posting.
+        profiling.count("blocks decoded", block_postings.number_blocks())
+        profiling.count("postings scanned", len(block_postings))
+        for j in xrange(block_postings.number_blocks()):
+          (positions, tfs) = block_postings.decode_block(j)
+          for (position, tf_d) in itertools.izip(positions, tfs):
+            squasher = squash * document_set.documents[position].length
+            scores[position] = scores.get(position, 0.0) + \
+                weight * (tf_d / (tf_d + squasher))
+        continue
+
+      candidates = collections.defaultdict(list)
+      for (position, score) in scores.iteritems():
+        if score + remaining[i] >= threshold:
+          candidates[block_postings.find_block(position)].append(position)
+
+      pruned = {}
+      for (j, positions) in candidates.iteritems():
+        if j == block_postings.number_blocks():
+          bound = 0.0
+        else:
+          bound = bounds[j]
+        # Documents that can't make it even with this block's best score.
+        positions = [position for position in positions
+            if scores[position] + bound + remaining[i + 1] >= threshold]
+        if not positions:
+          continue
+
+        if bound:
+          profiling.count("blocks decoded")
+          block_tfs = dict(itertools.izip(*block_postings.decode_block(j)))
+        else:
+          block_tfs = {}
+        for position in positions:
+          score = scores[position]
+          tf_d = block_tfs.get(position)
+          if tf_d is not None:
+            squasher = squash * document_set.documents[position].length
+            score += weight * (tf_d / (tf_d + squasher))
+          pruned[position] = score
+      scores = pruned
+
+    top = heapq.nlargest(top_n, scores.iteritems(), key=operator.itemgetter(1))
+    profiling.count("documents scored", len(scores))
+
+    # Rescore the winners exactly as _tfidf does, word by word.
+    squashers = self._document_squashers(document_set)
+    results = []
+    for (position, _) in top:
+      document = document_set.documents[position]
+      squasher = squashers.get(document)
+      if squasher is None:
+        squasher = self._squasher(document.length, document_set)
+        squashers[document] = squasher
+
+      score = 0.0
+      for (word, tf_q) in query.words_counter.most_common():
+        tf_d = document.words_counter[word]
+        if tf_d:
+          score += tf_q * ((tf_d / (tf_d + squasher)) *
+              document_set.idf(word))
+      results.append((query, document, score))
+    return results
+
+  @profiling.timed("tf.idf (matrix)")
+  def _tfidf_matrix(self, queries_set, documents_set, top_n=None):
+    """Calculates the tf.idf of every query at once, using numpy and scipy.
+
+    The (tf_w,D / (tf_w,D + (k|D| / avg|D|))) * log(|C| / df_w) weights are
+    built into a (word x document) CSR matrix, so the similarities are its
+    product with the (query x word) matrix of tf_q. Each query's top_n (or
+    all) results are returned best first, as a list of lists of (query,
+    document, similarity) triples, one list per query."""
+
+    documents = documents_set.documents
+    lengths = numpy.array([document.length for document in documents],
+        dtype=numpy.float64)
+    squashers = self.k * lengths / documents_set.avg_length
+
+    # The word x document matrix, built a row (word) at a time.
+    word_ids = {}
+    idfs = []
+    indptr = [0]
+    indices = array.array('i')
+    tfs = array.array('i')
+    for word in documents_set.inverted_index:
+      postings = documents_set.postings(word)
+      if not postings:
+        continue
+
+      word_ids[word] = len(word_ids)
+      idfs.append(documents_set.idf(word))
+      indices.extend(postings)
+      tfs.extend([documents[position].words_counter[word]
+          for position in postings])
+      indptr.append(len(indices))
+
+    indptr = numpy.array(indptr)
+    indices = numpy.frombuffer(indices, dtype=numpy.intc)
+    tfs = numpy.frombuffer(tfs, dtype=numpy.intc).astype(numpy.float64)
+    weights = tfs / (tfs + squashers[indices]) * numpy.repeat(
+        numpy.array(idfs), numpy.diff(indptr))
+    word_documents = sparse.csr_matrix((weights, indices, indptr),
+        shape=(len(word_ids), documents_set.number_documents))
+
+    # The query x word matrix. A word in every document has an idf (and so
+    # weights) of 0, which the product leaves out - but _tfidf still gives
+    # every document a score, so those queries' rows are made dense.
+    rows = []
+    columns = []
+    data = []
+    dense_rows = set()
+    for (i, query) in enumerate(queries_set.documents):
+      for (word, tf_q) in query.words_counter.iteritems():
+        if word in word_ids:
+          rows.append(i)
+          columns.append(word_ids[word])
+          data.append(tf_q)
+          if not idfs[word_ids[word]]:
+            dense_rows.add(i)
+    query_words = sparse.csr_matrix(
+        (numpy.array(data, dtype=numpy.float64), (rows, columns)),
+        shape=(queries_set.number_documents, len(word_ids)))
+
+    similarities = query_words * word_documents
+
+    results = []
+    for (i, query) in enumerate(queries_set.documents):
+      if i in dense_rows:
+        scores = similarities[i].toarray().ravel()
+        positions = numpy.arange(len(scores))
+      else:
+        start = similarities.indptr[i]
+        end = similarities.indptr[i + 1]
+        positions = similarities.indices[start:end]
+        scores = similarities.data[start:end]
+
+      if top_n is not None and top_n < len(scores):
+        # Only sort the top_n.
+        candidates = numpy.argpartition(-scores, top_n - 1)[:top_n]
+        positions = positions[candidates]
+        scores = scores[candidates]
+
+      order = numpy.lexsort((positions, -scores))
+      results.append([(query, documents[position], float(score))
+          for (position, score) in zip(positions[order], scores[order])])
+
+    return results
+
+  def calculate_similarity(self, query_file, data_file, filename, k=None,
+      top_n=None, engine="loop", number_shards=None):
     """Calculate the similarity between a query file and a data file.
 
-    The results are written to a file named 'filename'."""
+    The results are written to a file named 'filename', ranked and limited to
+    the top_n best documents per query (if top_n is given). Each query's
+    results are written in the background while the next is scored.
+
+    With the 'blocks' engine (and a top_n), each query is scored by
+    _top_tfidf instead of _tfidf. With the 'matrix' engine, every query is
+    scored at once by _tfidf_matrix. With number_shards, the data file is
+    split into shards which are scored in parallel (see shards.py), with the
+    'loop' or 'blocks' engine."""
 
     queries_set = doc.DocumentSet(query_file)
+
+    if number_shards is not None:
+      index = shards.ShardedIndex(data_file, number_shards)
+      try:
+        # The results are already ranked.
+        output.write_output_file(filename, itertools.chain.from_iterable(
+            index.rank_tfidf(queries_set, self.k, top_n, engine)))
+      finally:
+        index.close()
+      return
+
     documents_set = doc.DocumentSet(data_file)
 
-    results = []
-    for query in queries_set.documents:
-      results.extend(self._tfidf(query, documents_set))
+    if engine == "matrix":
+      # The results are already ranked.
+      output.write_output_file(filename, itertools.chain.from_iterable(
+          self._tfidf_matrix(queries_set, documents_set, top_n)))
+      return
 
-    output.write_output_file(filename, results)
+    writer = output.ResultWriter(filename, top_n)
+    try:
+      for query in queries_set.documents:
+        if engine == "blocks" and top_n is not None:
+          writer.put(self._top_tfidf(query, documents_set, top_n))
+        else:
+          writer.put(self._tfidf(query, documents_set))
+    finally:
+      writer.close()
 
 
 def main():
@@ -64,11 +382,60 @@ def main():
 
   The results are written out to the file 'tfidf.top'."""
 
+  parser = optparse.OptionParser()
+  parser.add_option("-n", "--top-documents",
+      type="int",
+      action="store",
+      dest="top_n",
+      default=None,
+      help="The maximum number of documents to output for each query.")
+  parser.add_option("--cache",
+      action="store_true",
+      dest="use_cache",
+      default=False,
+      help="Cache the scores of each term, and report the hit rate.")
+  parser.add_option("--engine",
+      type="choice",
+      choices=["loop", "blocks", "matrix"],
+      action="store",
+      dest="engine",
+      default="loop",
+      help="How to score the documents: 'blocks' prunes with compressed "
+           "block postings, and needs -n; 'matrix' scores every query at "
+           "once as a sparse matrix product, and needs numpy and scipy.")
+  parser.add_option("-s", "--shards",
+      type="int",
+      action="store",
+      dest="number_shards",
+      default=None,
+      help="Split the documents into this many shards, each scored by its "
+           "own process.")
+  profiling.add_options(parser)
+  (options, args) = parser.parse_args()
+
+  if options.engine == "blocks" and options.top_n is None:
+    parser.error("--engine=blocks needs -n.")
+  if options.engine == "matrix" and sparse is None:
+    parser.error("The matrix engine needs numpy and scipy.")
+  if options.number_shards is not None:
+    if options.engine == "matrix":
+      parser.error("The matrix engine can't be sharded.")
+    if options.use_cache:
+      parser.error("Sharded scores can't be cached.")
+
   query_file = 'data/qrys.txt'
   data_file = 'data/docs.txt'
 
-  tf_idf = TfIdf()
-  tf_idf.calculate_similarity(query_file, data_file, 'tfidf.top')
+  score_cache = None
+  if options.use_cache:
+    score_cache = cache.ScoreCache()
+
+  tf_idf = TfIdf(cache=score_cache)
+  profiling.run(lambda: tf_idf.calculate_similarity(query_file, data_file,
+      'tfidf.top', top_n=options.top_n, engine=options.engine,
+      number_shards=options.number_shards), options)
+  if score_cache is not None:
+    print score_cache.report()
 
 if __name__ == "__main__":
   main()
\ No newline at end of file
@@ -0,0 +1,655 @@
+import cache
+import counter
+import detector
+import finn
+import hamming
+import lsh
+import minhash
+import multiprocessing
+import optparse
+import os
+import random
+import service
+import shutil
+import simhash
+import speeches
+import string
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+
+def _synthetic_speeches(directory, number_speeches, seed=0,
+    vocabulary_size=20000):
+  """Writes number_speeches synthetic speeches into directory, as
+  '<id>.txt' files laid out like the real ones.
+
+  Words are drawn from a Zipf-like distribution, and about half of the
+  speeches have a run of numbers (a plateau). One in twenty speeches copies
+  an earlier one exactly, one in twenty copies one with a few words changed,
+  and one in twenty copies an earlier speech's numbers into new text. Returns
+  the number of bytes written."""
+
+  generator = random.Random(seed)
+  words = ["w%s" % i for i in xrange(vocabulary_size)]
+
+  def random_word():
+    # Approximately Zipfian: the rank is exponential in a uniform variable.
+    return words[int(vocabulary_size ** generator.random()) - 1]
+
+  def random_numbers():
+    numbers = []
+    for _ in xrange(generator.randint(10, 60)):
+      if generator.random() < 0.2:
+        numbers.append(random_word())
+      else:
+        numbers.append("%.1f" % (generator.random() * 1000))
+    return numbers
+
+  def random_text(numbers):
+    text = [random_word() for _ in xrange(generator.randint(200, 1500))]
+    if numbers:
+      position = generator.randint(0, len(text))
+      text[position:position] = numbers
+    return text
+
+  bodies = []
+  plateaus = []
+  size = 0
+  for i in xrange(number_speeches):
+    choice = generator.random()
+    if bodies and choice < 0.05:
+      body = list(generator.choice(bodies))
+    elif bodies and choice < 0.1:
+      body = list(generator.choice(bodies))
+      for _ in xrange(generator.randint(1, 5)):
+        body[generator.randint(0, len(body) - 1)] = random_word()
+    elif plateaus and choice < 0.15:
+      body = random_text(generator.choice(plateaus))
+    else:
+      numbers = None
+      if generator.random() < 0.5:
+        numbers = random_numbers()
+        plateaus.append(numbers)
+      body = random_text(numbers)
+    bodies.append(body)
+
+    lines = ["This is a speech by speaker %s." % generator.randint(1, 500),
+        "", "On %s" % random_word()]
+    for start in xrange(0, len(body), 12):
+      line = " ".join(body[start:start + 12])
+      lines.append(line + generator.choice([",", ".", "", ";"]))
+    text = "\n".join(lines) + "\n"
+
+    with open(os.path.join(directory, "%s.txt" % i), "w") as f:
+      f.write(text)
+    size += len(text)
+
+  return size
+
+
+def _time(function, repeat=3):
+  """Returns the best of 'repeat' wall-clock timings of function(), in
+  seconds."""
+
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def _report(name, seconds, baseline=None, unit=None, count=None):
+  """Prints a single benchmark result line."""
+
+  line = "  %-30s %9.4fs" % (name, seconds)
+  if count is not None:
+    line += "  %12.0f %s/s" % (count / seconds, unit)
+  if baseline is not None:
+    line += "  (%.2fx)" % (baseline / seconds)
+  print line
+
+
+# The speech directory shared by the benchmarks.
+_directory = None
+
+
+def _speech_directory(options):
+  """Returns the directory of speeches, generating them if necessary."""
+
+  global _directory
+  if _directory is None:
+    if options.data_directory:
+      _directory = options.data_directory
+    else:
+      print "Generating %s speeches." % options.number_speeches
+      _directory = os.path.join(options.directory, "speeches")
+      os.mkdir(_directory)
+      _synthetic_speeches(_directory, options.number_speeches)
+  return _directory
+
+
+def _texts(options):
+  """Returns the (cleaned) text of each speech."""
+
+  directory = _speech_directory(options)
+  texts = []
+  for filename in os.listdir(directory):
+    if not filename.endswith('.txt'):
+      continue
+    with open(os.path.join(directory, filename), 'r') as f:
+      texts.append(speeches.SpeechSet._clean_buffer(f.read()))
+  return texts
+
+
+def _token_counters(options):
+  """Returns a Counter of the (cleaned) tokens of each speech."""
+
+  return [counter.Counter(text.split()) for text in _texts(options)]
+
+
+def benchmark_fingerprints(options):
+  """Simhash fingerprints: list columns against numpy bit matrices."""
+
+  counters = _token_counters(options)
+  for bit_size in (64, 128):
+    numpy = simhash.numpy
+    simhash.numpy = None
+    try:
+      baseline = _time(lambda: [simhash.fingerprint(token_counter, bit_size)
+          for token_counter in counters], 1)
+    finally:
+      simhash.numpy = numpy
+    _report("lists (%s bits)" % bit_size, baseline, None, "fingerprints",
+        len(counters))
+
+    if numpy is not None:
+      _report("numpy (%s bits)" % bit_size, _time(lambda: [
+          simhash.fingerprint(token_counter, bit_size)
+          for token_counter in counters]), baseline, "fingerprints",
+          len(counters))
+
+
+def benchmark_ingest(options):
+  """SpeechSet: reading and fingerprinting speeches in 1 and -p processes."""
+
+  directory = _speech_directory(options)
+  number_speeches = len([filename for filename in os.listdir(directory)
+      if filename.endswith('.txt')])
+
+  baseline = _time(lambda: speeches.SpeechSet(directory, processes=1,
+      keep_tokens=False), 1)
+  _report("1 process", baseline, None, "speeches", number_speeches)
+  if options.processes > 1:
+    _report("%s processes" % options.processes, _time(lambda:
+        speeches.SpeechSet(directory, processes=options.processes,
+        keep_tokens=False), 1), baseline, "speeches", number_speeches)
+
+
+def _line_clean_text(data):
+  """SpeechSet's cleaning as it was, a line at a time with a new translation
+  table for each."""
+
+  lines = [line.strip() for line in data.split('\n')]
+  lines = lines[2:]
+  if len(lines[0].split()) <= 7:
+    lines = lines[1:]
+  lines = filter(None, lines)
+  lines = [line.translate(string.maketrans('', ''), string.punctuation)
+      for line in lines]
+  return ' '.join(lines)
+
+
+def benchmark_cleaning(options):
+  """Cleaning and tokenizing: lines against whole buffers, in MB of text."""
+
+  directory = _speech_directory(options)
+  buffers = []
+  for filename in os.listdir(directory):
+    if filename.endswith('.txt'):
+      with open(os.path.join(directory, filename), 'r') as f:
+        buffers.append(f.read())
+  megabytes = sum(map(len, buffers)) / float(1 << 20)
+
+  baseline = _time(lambda: map(_line_clean_text, buffers))
+  _report("lines", baseline, None, "MB", megabytes)
+  _report("buffers", _time(lambda: map(speeches.SpeechSet._clean_buffer,
+      buffers)), baseline, "MB", megabytes)
+  _report("buffers and token counts", _time(lambda: [
+      counter.Counter(speeches.SpeechSet._clean_buffer(data).split())
+      for data in buffers]), baseline, "MB", megabytes)
+
+  # The manual adler32 (--no-zlib) of the cleaned texts.
+  texts = map(speeches.SpeechSet._clean_buffer, buffers)
+  megabytes = sum(map(len, texts)) / float(1 << 20)
+  adler_32 = speeches.Speech._adler_32.im_func
+  numpy = speeches.numpy
+  speeches.numpy = None
+  try:
+    baseline = _time(lambda: [adler_32(None, text, False) for text in texts],
+        1)
+  finally:
+    speeches.numpy = numpy
+  _report("manual adler32, characters", baseline, None, "MB", megabytes)
+  if numpy is not None:
+    _report("manual adler32, numpy", _time(lambda: [adler_32(None, text,
+        False) for text in texts]), baseline, "MB", megabytes)
+
+
+def benchmark_token_hashes(options):
+  """Token hashes: md5 with and without its cache, and the fast hash."""
+
+  directory = _speech_directory(options)
+  counters = _token_counters(options)
+  number_speeches = len(counters)
+
+  baseline = None
+  baseline_set = None
+  try:
+    for (name, cache_size) in (("md5", 0), ("md5", 1 << 18), ("fast", 0)):
+      label = name
+      if name == "md5":
+        label += " (cached)" if cache_size else " (uncached)"
+
+      simhash.set_token_hash(name, cache_size)
+      seconds = _time(lambda: [simhash.fingerprint(token_counter, 128)
+          for token_counter in counters])
+      _report("fingerprints, %s" % label, seconds, baseline, "speeches",
+          number_speeches)
+      if baseline is None:
+        baseline = seconds
+
+      simhash.set_token_hash(name, cache_size)
+      seconds = _time(lambda: speeches.SpeechSet(directory, processes=1,
+          keep_tokens=False), 1)
+      _report("SpeechSet, %s" % label, seconds, baseline_set, "speeches",
+          number_speeches)
+      if baseline_set is None:
+        baseline_set = seconds
+  finally:
+    simhash.set_token_hash()
+
+
+def benchmark_cache(options):
+  """Fingerprint cache: a first run, a rerun, and a rerun after additions."""
+
+  directory = os.path.join(options.directory, "cached")
+  shutil.copytree(_speech_directory(options), directory)
+  filenames = [filename for filename in os.listdir(directory)
+      if filename.endswith('.txt')]
+  cache_filename = os.path.join(options.directory, "fingerprints.cache")
+
+  def run(use_groups=True):
+    fingerprint_cache = cache.FingerprintCache(cache_filename, 128, True)
+    speeches.SpeechSet(directory, use_groups=use_groups,
+        processes=options.processes, keep_tokens=False,
+        cache=fingerprint_cache)
+
+  baseline = _time(run, 1)
+  _report("first run", baseline, None, "speeches", len(filenames))
+  _report("rerun", _time(run), baseline, "speeches", len(filenames))
+  _report("rerun (no groups)", _time(lambda: run(False)), baseline,
+      "speeches", len(filenames))
+
+  # Add copies of 1% of the speeches.
+  for filename in filenames[:max(1, len(filenames) / 100)]:
+    shutil.copy(os.path.join(directory, filename),
+        os.path.join(directory, "copy%s" % filename))
+  _report("rerun after 1% more", _time(run, 1), baseline, "speeches",
+      len(filenames))
+
+
+def _percentile(values, percent):
+  """Returns the value at a percentile of a sorted list of numbers."""
+
+  return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _report_latencies(name, latencies):
+  """Prints the median and 99th percentile of a list of latencies."""
+
+  latencies = sorted(latencies)
+  print "  %-30s p50 %.2fms, p99 %.2fms" % (name,
+      _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000)
+
+
+def benchmark_service(options):
+  """Online detection: checking speeches one at a time, and over HTTP."""
+
+  directory = _speech_directory(options)
+  texts = []
+  for filename in os.listdir(directory):
+    if filename.endswith('.txt'):
+      with open(os.path.join(directory, filename), 'r') as f:
+        texts.append((filename[:-len('.txt')], f.read()))
+
+  index = service.DuplicateIndex()
+  latencies = []
+  start = time.time()
+  for (speech_id, text) in texts:
+    check_start = time.time()
+    index.check(speech_id, text)
+    latencies.append(time.time() - check_start)
+  _report("DuplicateIndex.check", time.time() - start, None, "speeches",
+      len(texts))
+  _report_latencies("latency", latencies)
+
+  server = service.DuplicateServer(("127.0.0.1", 0), service.DuplicateIndex())
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  url = "http://127.0.0.1:%s/check" % server.server_address[1]
+  try:
+    latencies = []
+    start = time.time()
+    for (speech_id, text) in texts:
+      check_start = time.time()
+      urllib2.urlopen("%s?id=%s" % (url, speech_id), text).read()
+      latencies.append(time.time() - check_start)
+    _report("POST /check", time.time() - start, None, "speeches", len(texts))
+    _report_latencies("latency over HTTP", latencies)
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def _quadratic_best_runs(runs, words_before, tags_before, tags_after,
+    inverse_slope):
+  """finn._best_runs as it was, trying every pair of runs."""
+
+  best_score = 0
+  best_a = 0
+  best_b = len(runs) - 1
+  for a in xrange(len(runs) - 1):
+    if runs[a] > 0:
+      continue
+    for b in xrange(a, len(runs) - 1):
+      if runs[b] > 0:
+        continue
+      tokens_between = ((words_before[b] - tags_before[b]) -
+          (words_before[a] - tags_before[a]))
+      score = tags_before[a] + inverse_slope * tokens_between + tags_after[b]
+      if score > best_score:
+        best_score = score
+        best_a = a
+        best_b = b
+  return (best_a, best_b)
+
+
+def _float_is_token(word):
+  """finn._is_token as it was, with a float() cast."""
+
+  try :
+    float(word)
+  except ValueError:
+    return False
+  return True
+
+
+def benchmark_plateau(options):
+  """Finn plateaus: the pairwise search against one pass, on long texts."""
+
+  generator = random.Random(0)
+  for size in (1000, 4000, 16000, 256000):
+    # Half of the words are numbers, so there are about size / 2 runs.
+    words = [str(generator.randint(0, 999)) if generator.random() < 0.5
+        else "w%s" % generator.randint(0, 999) for _ in xrange(size)]
+    print " %s words:" % size
+
+    baseline = None
+    if size <= options.quadratic_limit:
+      best_runs = finn._best_runs
+      is_token = finn._is_token
+      finn._best_runs = _quadratic_best_runs
+      finn._is_token = _float_is_token
+      try:
+        baseline = _time(lambda: finn.find_plateau(words), 1)
+      finally:
+        finn._best_runs = best_runs
+        finn._is_token = is_token
+      _report("pairwise", baseline, None, "words", size)
+    _report("one pass", _time(lambda: finn.find_plateau(words)), baseline,
+        "words", size)
+
+  words = [word for text in _texts(options) for word in text.split()]
+  baseline = _time(lambda: [_float_is_token(word) for word in words])
+  _report("_is_token with float()", baseline, None, "words", len(words))
+  _report("_is_token with a regex", _time(lambda: [finn._is_token(word)
+      for word in words]), baseline, "words", len(words))
+
+
+def benchmark_hamming(options):
+  """Hamming distances: bit lists against int and numpy popcounts."""
+
+  bit_size = 128
+  generator = random.Random(0)
+  for size in options.fingerprint_sizes:
+    fingerprints = [generator.getrandbits(bit_size) for _ in xrange(size)]
+    print " %s fingerprints:" % size
+
+    # One against all. The bit lists are too slow to do all of them.
+    query = fingerprints[0]
+    sample = fingerprints[:10000]
+    query_bits = simhash.to_bits(query, bit_size)
+    sample_bits = [simhash.to_bits(fingerprint, bit_size)
+        for fingerprint in sample]
+    baseline = _time(lambda: [detector.hamming_distance(query_bits, bits)
+        for bits in sample_bits], 1) / len(sample) * size
+    _report("one-vs-all lists", baseline, None, "pairs", size)
+    ints = _time(lambda: [hamming.distance(query, fingerprint)
+        for fingerprint in fingerprints], 1)
+    _report("one-vs-all ints", ints, baseline, "pairs", size)
+    if hamming.numpy is None:
+      continue
+    matrix = hamming.pack(fingerprints, bit_size)
+    row = matrix[0]
+    _report("one-vs-all numpy", _time(lambda: hamming.distances(matrix, row)),
+        baseline, "pairs", size)
+
+    # All pairs, at a distance of 3. Without numpy this takes as long as size
+    # one-vs-all searches, so that is not run.
+    if size > options.all_pairs_limit:
+      continue
+    number_pairs = size * (size - 1) / 2
+    baseline = ints / size * number_pairs
+    _report("all pairs ints (estimated)", baseline, None, "pairs",
+        number_pairs)
+    _report("all pairs numpy (1 process)", _time(lambda:
+        hamming.pairs_within(fingerprints, bit_size, 3, 1), 1), baseline,
+        "pairs", number_pairs)
+    if options.processes > 1:
+      _report("all pairs numpy (%s processes)" % options.processes,
+          _time(lambda: hamming.pairs_within(fingerprints, bit_size, 3,
+          options.processes), 1), baseline, "pairs", number_pairs)
+
+
+def benchmark_lsh(options):
+  """LSH index: recall and throughput against the all-pairs search."""
+
+  bit_size = 128
+  max_distance = 4
+  generator = random.Random(0)
+
+  # One in ten fingerprints is a copy of an earlier one, with up to twice
+  # max_distance of its bits flipped.
+  fingerprints = []
+  for _ in xrange(options.lsh_fingerprints):
+    if fingerprints and generator.random() < 0.1:
+      fingerprint = generator.choice(fingerprints)
+      for bit in generator.sample(xrange(bit_size),
+          generator.randint(0, 2 * max_distance)):
+        fingerprint ^= 1 << bit
+    else:
+      fingerprint = generator.getrandbits(bit_size)
+    fingerprints.append(fingerprint)
+
+  pairs = [None]
+  def all_pairs():
+    pairs[0] = set(hamming.pairs_within(fingerprints, bit_size, max_distance,
+        options.processes))
+  baseline = _time(all_pairs, 1)
+  expected = pairs[0]
+  _report("all pairs (%s pairs)" % len(expected), baseline, None,
+      "fingerprints", len(fingerprints))
+
+  for (number_tables, band_bits) in ((1, None), (1, 32), (2, 32), (4, 32),
+      (8, 32)):
+    index = [None]
+    def build():
+      index[0] = lsh.LSHIndex(bit_size, max_distance, number_tables,
+          band_bits)
+      for fingerprint in fingerprints:
+        index[0].add(fingerprint)
+      pairs[0] = index[0].pairs()
+    seconds = _time(build, 1)
+    recall = 100.0 * len(set(pairs[0]) & expected) / max(len(expected), 1)
+    _report("%s x %s bits, %.1f%% recall" % (number_tables,
+        index[0].band_bits, recall), seconds, baseline, "fingerprints",
+        len(fingerprints))
+
+
+def benchmark_shingles(options):
+  """MinHash shingle signatures: throughput and memory against simhash."""
+
+  if minhash.numpy is None:
+    print "  (needs numpy)"
+    return
+
+  token_lists = [text.split() for text in _texts(options)]
+  number_speeches = len(token_lists)
+  number_tokens = sum(map(len, token_lists))
+
+  fingerprints = [None]
+  def simhashes():
+    fingerprints[0] = [simhash.fingerprint(counter.Counter(tokens), 128)
+        for tokens in token_lists]
+  baseline = _time(simhashes, 1)
+  _report("simhash (128 bits)", baseline, None, "speeches", number_speeches)
+
+  signatures = [None]
+  for shingle_size in (1, 5, 9):
+    def signing():
+      signatures[0] = [minhash.signature(tokens, shingle_size)
+          for tokens in token_lists]
+    _report("minhash (%s-word shingles)" % shingle_size, _time(signing, 1),
+        baseline, "speeches", number_speeches)
+  print "  %-30s %9.1f tokens per speech" % ("", float(number_tokens) /
+      max(number_speeches, 1))
+
+  near_fingerprints = [fingerprint for fingerprint in fingerprints[0]
+      if fingerprint is not None]
+  signatures = [signature for signature in signatures[0]
+      if signature is not None]
+
+  def simhash_pairs():
+    index = lsh.LSHIndex(simhash.hash_bits(128), 4)
+    for fingerprint in near_fingerprints:
+      index.add(fingerprint)
+    return index.pairs()
+  baseline = _time(simhash_pairs, 1)
+  _report("simhash LSH pairs", baseline, None, "speeches",
+      len(near_fingerprints))
+  for bands in (16, 32):
+    _report("minhash pairs (%s bands)" % bands, _time(lambda:
+        minhash.pairs_within(signatures, 0.5, bands), 1), baseline,
+        "speeches", len(signatures))
+
+  simhash_bytes = sum(map(sys.getsizeof, near_fingerprints))
+  minhash_bytes = sum([signature.nbytes for signature in signatures])
+  for (name, size, count) in (("simhash", simhash_bytes,
+      len(near_fingerprints)), ("minhash", minhash_bytes, len(signatures))):
+    print "  %-30s %9.2fMB  %12.0f bytes/speech" % (name + " memory",
+        size / float(1 << 20), float(size) / max(count, 1))
+
+
+_BENCHMARKS = [
+  ("fingerprints", benchmark_fingerprints),
+  ("cleaning", benchmark_cleaning),
+  ("ingest", benchmark_ingest),
+  ("hashes", benchmark_token_hashes),
+  ("cache", benchmark_cache),
+  ("plateau", benchmark_plateau),
+  ("hamming", benchmark_hamming),
+  ("lsh", benchmark_lsh),
+  ("shingles", benchmark_shingles),
+  ("service", benchmark_service),
+]
+
+
+def main():
+  """Runs the named benchmarks (or all of them), printing the timings."""
+
+  parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+  parser.add_option("--data",
+      action="store",
+      dest="data_directory",
+      default=None,
+      metavar="DIRECTORY",
+      help="Use the speeches in this directory instead of synthetic ones.")
+  parser.add_option("-n", "--speeches",
+      type="int",
+      action="store",
+      dest="number_speeches",
+      default=2000,
+      help="The number of synthetic speeches.")
+  parser.add_option("--quadratic-limit",
+      type="int",
+      action="store",
+      dest="quadratic_limit",
+      default=16000,
+      help="Only time the pairwise plateau search on texts of at most this "
+           "many words.")
+  parser.add_option("--fingerprints",
+      action="store",
+      dest="fingerprints",
+      default="10000,100000,1000000",
+      metavar="SIZES",
+      help="The comma separated numbers of random fingerprints to compare.")
+  parser.add_option("--all-pairs-limit",
+      type="int",
+      action="store",
+      dest="all_pairs_limit",
+      default=20000,
+      help="Only compare all pairs of at most this many fingerprints.")
+  parser.add_option("--lsh-fingerprints",
+      type="int",
+      action="store",
+      dest="lsh_fingerprints",
+      default=20000,
+      help="The number of fingerprints to index with LSH.")
+  parser.add_option("-p", "--processes",
+      type="int",
+      action="store",
+      dest="processes",
+      default=multiprocessing.cpu_count(),
+      help="The number of processes to read speeches and compare "
+           "fingerprints with.")
+  (options, args) = parser.parse_args()
+  options.fingerprint_sizes = [int(size)
+      for size in options.fingerprints.split(",")]
+
+  names = [name for (name, _) in _BENCHMARKS]
+  for name in args:
+    if name not in names:
+      parser.error("Unknown benchmark %s (choose from %s)." %
+          (name, ", ".join(names)))
+
+  options.directory = tempfile.mkdtemp()
+  try:
+    for (name, benchmark) in _BENCHMARKS:
+      if args and name not in args:
+        continue
+
+      print "%s: %s" % (name, benchmark.__doc__)
+      benchmark(options)
+  finally:
+    shutil.rmtree(options.directory)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import tempfile
+
+# The first line of a cache file, which records the settings its fingerprints
+# were made with.
+_HEADER = "# speech fingerprints: bit_size %s, use_zlib %s, token_hash %s\n"
+
+# The fast token hash is built on Python's hash(), which differs between 32
+# and 64 bit Pythons (and with hash randomization), so its caches also record
+# the hash of this string.
+_HASH_PROBE = "simhash"
+
+
+def file_digest(filename):
+  """Returns the md5 hex digest of a file's contents."""
+
+  with open(filename, 'rb') as f:
+    return hashlib.md5(f.read()).hexdigest()
+
+
+def _format_fingerprint(fingerprint):
+  return '-' if fingerprint is None else '%x' % fingerprint
+
+
+def _parse_fingerprint(text):
+  return None if text == '-' else int(text, 16)
+
+
+class FingerprintCache(object):
+  """A file of the fingerprints of speech files, so that they are only
+  computed again when the files change.
+
+  Each file's (exact, near, plateau) fingerprints are kept with its
+  modification time, size and the md5 digest of its contents. A file is
+  unchanged if its time and size are the same; if only its time has changed
+  (it was touched, or copied), its digest is checked. The fingerprints depend
+  on the bit size, use_zlib and the token hash (see simhash.set_token_hash),
+  so a cache made with others is ignored - as is one made with the fast token
+  hash by a Python whose hash() differs.
+
+  The cache file is a line of settings and then a line for each speech file:
+    <mtime> <size> <md5> <exact> <near> <plateau> <filename>
+  with the fingerprints in hex, or '-' for None."""
+
+  def __init__(self, filename, bit_size, use_zlib, token_hash="md5"):
+    """Loads a cache file, if there is one."""
+
+    self.filename = filename
+    if token_hash == "fast":
+      token_hash = "%s (hash %s)" % (token_hash, hash(_HASH_PROBE))
+    self._header = _HEADER % (bit_size, use_zlib, token_hash)
+
+    # filename -> (mtime, size, digest, fingerprints)
+    self._entries = {}
+    self._changed = False
+    self.hits = 0
+    self.misses = 0
+
+    if not os.path.exists(filename):
+      return
+
+    with open(filename, 'r') as f:
+      if f.readline() != self._header:
+        # Made with other settings, so none of it can be used.
+        self._changed = True
+        return
+
+      for line in f:
+        (mtime, size, digest, exact, near, plateau, speech_file) = \
+            line.rstrip('\n').split(' ', 6)
+        self._entries[speech_file] = (float(mtime), int(size), digest,
+            (int(exact, 16), _parse_fingerprint(near),
+            _parse_fingerprint(plateau)))
+
+  def __len__(self):
+    return len(self._entries)
+
+  def lookup(self, speech_file, mtime, size):
+    """Returns the (exact, near, plateau) fingerprints of a file with the
+    given modification time and size, or None if they are not cached (or the
+    file has changed)."""
+
+    entry = self._entries.get(speech_file)
+    if entry is not None and entry[1] == size:
+      if entry[0] == mtime:
+        self.hits += 1
+        return entry[3]
+
+      if entry[2] == file_digest(speech_file):
+        self.hits += 1
+        self._entries[speech_file] = (mtime,) + entry[1:]
+        self._changed = True
+        return entry[3]
+
+    self.misses += 1
+    return None
+
+  def add(self, speech_file, mtime, size, digest, fingerprints):
+    """Caches the (exact, near, plateau) fingerprints of a file."""
+
+    self._entries[speech_file] = (mtime, size, digest, fingerprints)
+    self._changed = True
+
+  def prune(self, directory, speech_files):
+    """Forgets the files in a directory other than the given ones (which
+    are all that are left)."""
+
+    speech_files = set(speech_files)
+    for speech_file in self._entries.keys():
+      if os.path.dirname(speech_file) == directory and \
+          speech_file not in speech_files:
+        del self._entries[speech_file]
+        self._changed = True
+
+  def save(self):
+    """Writes the cache file, if anything has changed.
+
+    The file is written under another name and then renamed, so a cache file
+    is never left half written."""
+
+    if not self._changed:
+      return
+
+    directory = os.path.dirname(os.path.abspath(self.filename))
+    (handle, temporary_filename) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as f:
+      f.write(self._header)
+      for (speech_file, (mtime, size, digest, (exact, near, plateau))) in \
+          self._entries.iteritems():
+        f.write("%r %s %s %x %s %s %s\n" % (mtime, size, digest, exact,
+            _format_fingerprint(near), _format_fingerprint(plateau),
+            speech_file))
+    os.rename(temporary_filename, self.filename)
+    self._changed = False
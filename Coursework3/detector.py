@@ -1,6 +1,11 @@
+import cache
 import counter
+import hamming
 import itertools 
+import lsh
+import minhash
 import optparse
+import simhash
 import speeches
 
 
@@ -72,7 +77,11 @@ def exact_detection(speech_set, use_exact_overlap):
 def hamming_distance(number1, number2):
   """Calculate the Hamming distance between two binary numbers.
 
-  The numbers can be given as any iterable."""
+  The numbers can be given as ints (such as simhash fingerprints), or as any
+  iterable."""
+
+  if isinstance(number1, (int, long)) and isinstance(number2, (int, long)):
+    return hamming.distance(number1, number2)
 
   pairs = zip(number1, number2)
   non_equal_pairs = filter(lambda (a, b) : a != b, pairs)
@@ -80,13 +89,39 @@ def hamming_distance(number1, number2):
   return len(non_equal_pairs)
 
 
-def near_detection(speech_set, use_groups, similarity_distance):
+def _close_pairs(speeches, fingerprints, bit_size, similarity_distance,
+    processes, lsh_tables, band_bits):
+  """Finds the (id, id) pairs of speeches whose (int) fingerprints are within
+  similarity_distance of each other.
+
+  If lsh_tables is set, candidate pairs are looked up in an LSH index of that
+  many tables (see lsh.py). Otherwise every pair is compared (see
+  hamming.py)."""
+
+  if lsh_tables:
+    index = lsh.LSHIndex(simhash.hash_bits(bit_size), similarity_distance,
+        lsh_tables, band_bits)
+    for fingerprint in fingerprints:
+      index.add(fingerprint)
+    pairs = index.pairs()
+  else:
+    pairs = hamming.pairs_within(fingerprints, bit_size, similarity_distance,
+        processes)
+
+  return set([(speeches[i].id, speeches[j].id) for (i, j) in pairs])
+
+
+def near_detection(speech_set, use_groups, similarity_distance,
+    processes=None, lsh_tables=0, band_bits=None):
   """Performs near duplicate detection.
 
   The similarity_distance variable sets the distance to accept matches at. If
   use_groups is set, then this is the maximum number of non-matching groups for
   two speeches to be found equal. Otherwise, it's the maximum Hamming distance
-  between two speeches for them to be found equal."""
+  between two speeches for them to be found equal. The pairs are found with
+  an LSH index of lsh_tables tables if that is set (see _close_pairs), or
+  else by comparing every pair, spread over 'processes' processes (by
+  default, one per CPU)."""
 
   overlapping_speeches = set()
   if use_groups:
@@ -102,7 +137,7 @@ def near_detection(speech_set, use_groups, similarity_distance):
       for bucket in speech.near_fingerprint_buckets:
         match_counter.update(bucket)
 
-      for (match, count) in match_counter.most_common():
+      for (match, count) in match_counter.iter_most_common():
         # Don't want to match ourself!
         if speech == match:
           continue
@@ -117,17 +152,31 @@ def near_detection(speech_set, use_groups, similarity_distance):
         else:
           overlapping_speeches.add((match.id, speech.id))
   else:
-    # Brute force search of the speeches.
-    pairs = itertools.combinations(speech_set.speeches, 2)
-    for (a, b) in pairs:
-      distance = hamming_distance(a.near_fingerprint, b.near_fingerprint)
-      if distance <= similarity_distance:
-        overlapping_speeches.add((a.id, b.id))
+    # Search of the speeches by Hamming distance.
+    fingerprinted = [speech for speech in speech_set.speeches
+        if speech.near_fingerprint is not None]
+    overlapping_speeches = _close_pairs(fingerprinted,
+        [speech.near_fingerprint for speech in fingerprinted],
+        speech_set.bit_size, similarity_distance, processes, lsh_tables,
+        band_bits)
+
+    # A speech of only stopwords has an empty simhash, which is at a distance
+    # of 0 from every other (as the bits were compared with zip). Pairs are
+    # ordered as the speeches are.
+    for (i, a) in enumerate(speech_set.speeches):
+      if a.near_fingerprint is not None:
+        continue
+      for (j, b) in enumerate(speech_set.speeches):
+        if i < j:
+          overlapping_speeches.add((a.id, b.id))
+        elif b.near_fingerprint is not None:
+          overlapping_speeches.add((b.id, a.id))
 
   return overlapping_speeches
 
 
-def finn_detection(speech_set, use_groups, similarity_distance):
+def finn_detection(speech_set, use_groups, similarity_distance,
+    processes=None, lsh_tables=0, band_bits=None):
   """Performs a finn duplicate detection.
 
   The finn duplicate detection operates across plateaus in the texts,
@@ -136,7 +185,8 @@ def finn_detection(speech_set, use_groups, similarity_distance):
   The similarity_distance variable sets the distance to accept matches at. If
   use_groups is set, then this is the maximum number of non-matching groups for
   two plateaus to be found equal. Otherwise, it's the maximum Hamming distance
-  between two plateaus for them to be found equal."""
+  between two plateaus for them to be found equal, found as in
+  near_detection."""
 
   overlapping_speeches = set()
 
@@ -157,7 +207,7 @@ def finn_detection(speech_set, use_groups, similarity_distance):
       for bucket in speech.plateau_fingerprint_buckets:
         match_counter.update(bucket)
 
-      for (match, count) in match_counter.most_common():
+      for (match, count) in match_counter.iter_most_common():
         # Don't want to match ourself!
         if speech == match:
           continue
@@ -172,19 +222,35 @@ def finn_detection(speech_set, use_groups, similarity_distance):
         else:
           overlapping_speeches.add((match.id, speech.id))
   else:
-    # Brute force search of the plateaus.
-    pairs = itertools.combinations(speech_set.speeches, 2)
-    for (a, b) in pairs:
-      if a.plateau_fingerprint is None or b.plateau_fingerprint is None:
-        continue
-
-      distance = hamming_distance(a.plateau_fingerprint, b.plateau_fingerprint)
-      if distance <= similarity_distance:
-        overlapping_speeches.add((a.id, b.id))
+    # Search of the plateaus by Hamming distance.
+    with_plateaus = [speech for speech in speech_set.speeches
+        if speech.plateau_fingerprint is not None]
+    overlapping_speeches = _close_pairs(with_plateaus,
+        [speech.plateau_fingerprint for speech in with_plateaus],
+        speech_set.bit_size, similarity_distance, processes, lsh_tables,
+        band_bits)
 
   return overlapping_speeches
 
 
+def shingle_detection(speech_set, jaccard, bands):
+  """Performs a shingle duplicate detection.
+
+  Unlike near_detection, which compares the bags of words of two speeches,
+  this compares their sets of shingles (runs of words), so it finds speeches
+  that share long passages. The speeches' MinHash signatures are split into
+  'bands' bands, and pairs sharing a band are found equal if their
+  estimated Jaccard similarity is at least jaccard (see
+  minhash.pairs_within)."""
+
+  signed = [speech for speech in speech_set.speeches
+      if speech.shingle_signature is not None]
+  pairs = minhash.pairs_within([speech.shingle_signature for speech in signed],
+      jaccard, bands)
+
+  return set([(signed[i].id, signed[j].id) for (i, j) in pairs])
+
+
 def main():
   parser = optparse.OptionParser()
   parser.add_option("-e", "--exact",
@@ -221,6 +287,14 @@ def main():
       dest="bit_size",
       metavar="SIZE",
       help="The bit size used in the simhash generation.")
+  parser.add_option("--token_hash",
+      type="choice",
+      choices=simhash.TOKEN_HASHES,
+      action="store",
+      default="md5",
+      dest="token_hash",
+      help="The hash of each token in the simhash: md5 (the default, cached) "
+           "or fast (quicker, but not cryptographic or portable).")
   parser.add_option("--no-groups",
       action="store_false",
       # Note that by default the variable 'use_groups' is *true* - that is,
@@ -228,19 +302,102 @@ def main():
       default=True,
       dest="use_groups",
       help="Do not use L groups of k bits for near duplicate detection.")
-
+  parser.add_option("-p", "--processes",
+      action="store",
+      type="int",
+      default=None,
+      dest="processes",
+      help="The number of processes to read the speeches with (and to "
+           "compare fingerprints with, if --no-groups is set). Defaults to "
+           "one per CPU.")
+  parser.add_option("--lsh_tables",
+      action="store",
+      type="int",
+      default=0,
+      dest="lsh_tables",
+      metavar="TABLES",
+      help="Find near duplicates with an LSH index of this many permuted "
+           "tables, by Hamming distance (as with --no-groups).")
+  parser.add_option("--band_bits",
+      action="store",
+      type="int",
+      default=None,
+      dest="band_bits",
+      metavar="BITS",
+      help="The number of bits in each band of the LSH tables. By default, "
+           "bands are as wide as they can be while finding every pair "
+           "within the similarity distance.")
+
+  parser.add_option("--shingles",
+      action="store",
+      type="int",
+      default=0,
+      dest="shingle_size",
+      metavar="SIZE",
+      help="Also find speeches sharing many shingles of SIZE words, by "
+           "MinHash, writing them to shingle.txt. Needs numpy.")
+  parser.add_option("--jaccard",
+      action="store",
+      type="float",
+      default=0.5,
+      dest="jaccard",
+      help="The minimum (estimated) Jaccard similarity of the shingles of "
+           "two shingle duplicates.")
+  parser.add_option("--minhash_bands",
+      action="store",
+      type="int",
+      default=32,
+      dest="minhash_bands",
+      metavar="BANDS",
+      help="The number of bands the MinHash signatures are split into. Must "
+           "divide %s. More bands find more pairs, but are slower."
+           % minhash.NUM_PERM)
+
+  parser.add_option("--cache",
+      action="store",
+      default=None,
+      dest="cache_filename",
+      metavar="FILE",
+      help="Keep the fingerprints of the speeches in this file, and only "
+           "fingerprint new or changed speeches. Not used with -e or "
+           "--shingles.")
   (options, _) = parser.parse_args()
 
+  if options.shingle_size:
+    if minhash.numpy is None:
+      parser.error("--shingles needs numpy.")
+    if options.minhash_bands <= 0 or \
+        minhash.NUM_PERM % options.minhash_bands != 0:
+      parser.error("--minhash_bands must divide %s." % minhash.NUM_PERM)
+
+  # An LSH index replaces the groups.
+  if options.lsh_tables:
+    options.use_groups = False
+
   folder_name = "data"
   if options.use_training_data:
     folder_name = "train"
 
+  simhash.set_token_hash(options.token_hash)
+
+  fingerprint_cache = None
+  if options.cache_filename is not None:
+    fingerprint_cache = cache.FingerprintCache(options.cache_filename,
+        options.bit_size, options.use_zlib, options.token_hash)
+
   print "Processing speeches from the %s directory." % folder_name
   the_speeches = speeches.SpeechSet(
       folder_name,
       use_zlib=options.use_zlib,
       bit_size=options.bit_size,
-      use_groups=options.use_groups)
+      use_groups=options.use_groups,
+      processes=options.processes,
+      keep_tokens=options.use_exact_overlap,
+      cache=fingerprint_cache,
+      shingle_size=options.shingle_size)
+  if fingerprint_cache is not None:
+    print "Took %s of %s fingerprints from the cache." % (
+        fingerprint_cache.hits, len(the_speeches.speeches))
 
   print "Checking for exact duplication."
   exact_matches = exact_detection(the_speeches, options.use_exact_overlap)
@@ -248,14 +405,22 @@ def main():
 
   print "Checking for near duplication."
   near_matches = near_detection(the_speeches, options.use_groups,
-      options.similarity_distance)
+      options.similarity_distance, options.processes, options.lsh_tables,
+      options.band_bits)
   output(near_matches, "near.txt")
 
   print "Checking for near duplication in plateaus."
   finn_matches = finn_detection(the_speeches, options.use_groups,
-      options.similarity_distance)
+      options.similarity_distance, options.processes, options.lsh_tables,
+      options.band_bits)
   output(finn_matches, "finn.txt")
 
+  if options.shingle_size:
+    print "Checking for shared shingles."
+    shingle_matches = shingle_detection(the_speeches, options.jaccard,
+        options.minhash_bands)
+    output(shingle_matches, "shingle.txt")
+
   print "Done!"
 
 
@@ -1,3 +1,10 @@
+import re
+
+# The strings float() accepts.
+_NUMBER = re.compile(r"\s*[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?"
+    r"|inf(?:inity)?|nan)\s*\Z", re.IGNORECASE)
+
+
 def find_plateau(words, inverse_slope=100):
   """Returns the largest plateau in the given text.
 
@@ -13,34 +20,8 @@ def find_plateau(words, inverse_slope=100):
   # Analyze X for useful information.
   (runs, words_before, tags_before, tags_after) = _get_info(x_vector)
 
-  # The best plateau starts as the entire document.
-  best_score = 0
-  best_a = 0
-  best_b = len(runs) - 1
-
-  for (a, run_a) in _enum(runs, end=len(runs) -1):
-    # There is never any reason to start in tag space.
-    if run_a > 0:
-      continue
-
-    for (b, run_b) in _enum(runs, start=a, end=len(runs) - 1):
-      # Nor any reason to end in tag space.
-      if run_b > 0:
-        continue
-
-      # Calculate the number of tokens between a and b, aka
-      # sum_{i=a}^{b} (1 - x_i).
-      tokens_before_a = words_before[a] - tags_before[a]
-      tokens_before_b = words_before[b] - tags_before[b]
-      tokens_between = tokens_before_b - tokens_before_a
-
-      # Calculate the total score.
-      score = tags_before[a] + inverse_slope * tokens_between + tags_after[b]
-
-      if score > best_score:
-        best_score = score
-        best_a = a
-        best_b = b
+  (best_a, best_b) = _best_runs(runs, words_before, tags_before, tags_after,
+      inverse_slope)
 
   # The starting index is the total number of words that occured before
   # best_a, and similarly for the ending index.
@@ -56,6 +37,45 @@ def find_plateau(words, inverse_slope=100):
   return plateau_words
 
 
+def _best_runs(runs, words_before, tags_before, tags_after, inverse_slope):
+  """Returns the runs (a, b) that the best plateau starts and ends at.
+
+  Both must be token runs, and the score is
+    tags_before[a] + inverse_slope * (tokens before b - tokens before a)
+        + tags_after[b]
+  which is a part depending only on a plus a part depending only on b. So
+  for each b, the best a is the best seen so far, and one pass over the runs
+  is enough. Of equal scores, the first (a, b) is kept, and a plateau must
+  score more than 0 - otherwise it is the entire document."""
+
+  best_score = 0
+  best_a = 0
+  best_b = len(runs) - 1
+
+  best_a_score = None
+  a = None
+  for b in xrange(len(runs) - 1):
+    # There is never any reason to start or end in tag space.
+    if runs[b] > 0:
+      continue
+
+    tokens_before = words_before[b] - tags_before[b]
+
+    # The part of the score from starting at b.
+    a_score = tags_before[b] - inverse_slope * tokens_before
+    if best_a_score is None or a_score > best_a_score:
+      best_a_score = a_score
+      a = b
+
+    score = best_a_score + inverse_slope * tokens_before + tags_after[b]
+    if score > best_score:
+      best_score = score
+      best_a = a
+      best_b = b
+
+  return (best_a, best_b)
+
+
 def _convert_word(word):
   """Returns the X vector value for a word - 1 if it is a tag, 0 elsewise."""
 
@@ -71,18 +91,13 @@ def _is_tag(word):
 def _is_token(word):
   """Determines if a word is a 'token', i.e. if it is a number."""
 
-  # Any string representation of a number can be cast to a float. If the cast
-  # fails, it's not a number.
-  try :
-    float(word)
-  except ValueError:
-    return False
-
-  return True
+  # Any string representation of a number can be cast to a float, which
+  # _NUMBER matches the syntax of.
+  return _NUMBER.match(word) is not None
 
 
 def _get_info(x_vector):
-  """Calculates the necessary information to find plateaus in O(n^2).
+  """Calculates the necessary information to find plateaus in O(n).
 
   The first step is to compress the x_vector. It's clear that only 'runs' of
   tags/tokens are interesting, because we would never start or stop our
@@ -136,16 +151,4 @@ def _run_changed(run, digit):
   if run == 0:
     return digit == 1
   else:
-    return digit == 0
-
-
-def _enum(seq, start=0, end=-1):
-  """Version of enumerate that handles start/end indices."""
-
-  if end < 0:
-    end = len(seq)
-  for (i, element) in enumerate(seq[start:]):
-    adjusted_index = i + start
-    if adjusted_index >= end:
-      return
-    yield (adjusted_index, element)
\ No newline at end of file
+    return digit == 0
\ No newline at end of file
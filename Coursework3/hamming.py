@@ -0,0 +1,149 @@
+import itertools
+import multiprocessing
+
+# numpy is optional - without it, pairs are compared one at a time.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Pairs are compared in square tiles of this many fingerprints a side. Each
+# tile takes two (_TILE x _TILE) arrays of uint64s, 16MB in all.
+_TILE = 1024
+
+# The masks used to count bits in parallel.
+if numpy is not None:
+  _M1 = numpy.uint64(0x5555555555555555)
+  _M2 = numpy.uint64(0x3333333333333333)
+  _M4 = numpy.uint64(0x0f0f0f0f0f0f0f0f)
+  _H01 = numpy.uint64(0x0101010101010101)
+
+
+def distance(number1, number2):
+  """Returns the Hamming distance between two int fingerprints."""
+
+  return bin(number1 ^ number2).count('1')
+
+
+def pack(fingerprints, bit_size):
+  """Packs a list of int fingerprints into a (fingerprint x word) numpy
+  matrix of uint64s, most significant word first."""
+
+  number_words = max(1, (bit_size + 63) / 64)
+  matrix = numpy.empty((len(fingerprints), number_words), dtype=numpy.uint64)
+  mask = (1 << 64) - 1
+  for word in xrange(number_words):
+    shift = 64 * (number_words - 1 - word)
+    matrix[:, word] = [(fingerprint >> shift) & mask
+        for fingerprint in fingerprints]
+  return matrix
+
+
+def _popcount(words):
+  """Returns the number of bits set in each of an array of uint64s.
+
+  This is the usual parallel bit count: each step adds neighbouring groups of
+  bits, which are twice as wide each time, and the multiply sums the bytes.
+  The array is overwritten."""
+
+  scratch = numpy.right_shift(words, 1)
+  scratch &= _M1
+  words -= scratch
+
+  numpy.right_shift(words, 2, out=scratch)
+  scratch &= _M2
+  words &= _M2
+  words += scratch
+
+  numpy.right_shift(words, 4, out=scratch)
+  words += scratch
+  words &= _M4
+
+  words *= _H01
+  words >>= numpy.uint64(56)
+  return words
+
+
+def distances(matrix, row):
+  """Returns the Hamming distances between one packed fingerprint (a row of
+  words) and every fingerprint in a packed matrix."""
+
+  return _popcount(matrix ^ row).sum(axis=1)
+
+
+# The packed fingerprints and maximum distance of _tile_pairs, set in each
+# worker process by _initialize_worker.
+_matrix = None
+_max_distance = None
+
+
+def _initialize_worker(matrix, max_distance):
+  global _matrix, _max_distance
+  _matrix = matrix
+  _max_distance = max_distance
+
+
+def _tile_pairs((start1, start2)):
+  """Returns the (i, j) pairs, i < j, within _max_distance of each other in
+  the tile of rows starting at start1 against rows starting at start2.
+
+  The last word (which always holds hash bits) is compared across the whole
+  tile first. A pair can only be close if that word is, so the other words
+  are only compared for the few pairs that are."""
+
+  rows1 = _matrix[start1:start1 + _TILE]
+  rows2 = _matrix[start2:start2 + _TILE]
+
+  tile = numpy.bitwise_xor(rows1[:, -1][:, numpy.newaxis],
+      rows2[:, -1][numpy.newaxis, :])
+  (indices1, indices2) = numpy.nonzero(_popcount(tile) <= _max_distance)
+  if start1 == start2:
+    upper = indices1 < indices2
+    indices1 = indices1[upper]
+    indices2 = indices2[upper]
+
+  if rows1.shape[1] > 1 and len(indices1):
+    pair_distances = _popcount(rows1[indices1] ^ rows2[indices2]).sum(axis=1)
+    close = pair_distances <= _max_distance
+    indices1 = indices1[close]
+    indices2 = indices2[close]
+
+  return zip((indices1 + start1).tolist(), (indices2 + start2).tolist())
+
+
+def pairs_within(fingerprints, bit_size, max_distance, processes=None):
+  """Finds every pair of int fingerprints within max_distance of each other,
+  returning a list of (i, j) index pairs, i < j.
+
+  With numpy, the fingerprints are packed into a matrix and compared a tile
+  of pairs at a time with XOR and a bit count, which bounds the memory used.
+  The tiles are spread over a pool of processes (one per CPU, by default)."""
+
+  if numpy is None or len(fingerprints) <= _TILE:
+    return [(i, j) for ((i, fingerprint1), (j, fingerprint2))
+        in itertools.combinations(enumerate(fingerprints), 2)
+        if distance(fingerprint1, fingerprint2) <= max_distance]
+
+  matrix = pack(fingerprints, bit_size)
+  tiles = [(start1, start2) for start1 in xrange(0, len(fingerprints), _TILE)
+      for start2 in xrange(start1, len(fingerprints), _TILE)]
+
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+
+  pairs = []
+  if processes <= 1:
+    _initialize_worker(matrix, max_distance)
+    for tile in tiles:
+      pairs.extend(_tile_pairs(tile))
+    return pairs
+
+  pool = multiprocessing.Pool(processes, _initialize_worker,
+      (matrix, max_distance))
+  try:
+    for tile_pairs in pool.imap_unordered(_tile_pairs, tiles, 4):
+      pairs.extend(tile_pairs)
+  finally:
+    pool.terminate()
+    pool.join()
+  return pairs
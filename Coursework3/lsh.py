@@ -0,0 +1,147 @@
+import hamming
+from itertools import imap
+import operator
+import random
+
+
+class LSHIndex(object):
+  """A locality sensitive hashing index of int fingerprints, for finding
+  those within a Hamming distance of each other.
+
+  Each of the index's tables permutes the bits of a fingerprint and splits
+  them into bands, and keeps an inverted index from each band's value to the
+  fingerprints with it. Fingerprints that share a band in some table are
+  candidates, and are checked with an exact popcount (hamming.distance).
+
+  Two fingerprints within max_distance of each other differ in at most
+  max_distance bands, so if a table has more bands than that they are certain
+  to share one (and the recall is 100%). Wider bands give smaller buckets and
+  so fewer candidates, but when there are max_distance or fewer of them a
+  close pair can be missed. More tables, each with its own permutation, then
+  make that less likely."""
+
+  def __init__(self, bit_size, max_distance, number_tables=1, band_bits=None,
+      seed=0):
+    """Creates an empty index.
+
+    By default, bands are as wide as they can be for a guaranteed recall
+    (there are max_distance + 1 of them). The bits of the first table are not
+    permuted."""
+
+    self.bit_size = bit_size
+    self.max_distance = max_distance
+
+    if band_bits is None:
+      number_bands = min(max_distance + 1, bit_size)
+    else:
+      number_bands = max(1, min(-(-bit_size // band_bits), bit_size))
+
+    # Split the bits into number_bands bands, whose widths differ by at most
+    # one, as (shift, mask) from the least significant band up.
+    self._bands = []
+    shift = 0
+    for band in xrange(number_bands):
+      width = (bit_size + band) // number_bands
+      self._bands.append((shift, (1 << width) - 1))
+      shift += width
+    self.band_bits = -(-bit_size // number_bands)
+
+    generator = random.Random(seed)
+    self._permutations = [None]
+    for _ in xrange(number_tables - 1):
+      permutation = range(bit_size)
+      generator.shuffle(permutation)
+      self._permutations.append(permutation)
+
+    # For each table and band, band value -> list of fingerprint indices.
+    self._tables = [[{} for _ in self._bands] for _ in self._permutations]
+    self.fingerprints = []
+
+    # The band values of each fingerprint, for every table and band in turn.
+    self._fingerprint_keys = []
+
+  def guaranteed(self):
+    """Returns whether every pair within max_distance is certain to be
+    found."""
+
+    return len(self._bands) > self.max_distance
+
+  def _permute(self, fingerprint, permutation):
+    """Returns a fingerprint with its bits reordered by a permutation (a list
+    of bit positions, most significant first)."""
+
+    if permutation is None:
+      return fingerprint
+    bits = bin(fingerprint)[2:].zfill(self.bit_size)
+    return int(''.join([bits[position] for position in permutation]), 2)
+
+  def _keys(self, fingerprint):
+    """Yields (buckets, band value) for each table and band of a fingerprint,
+    where buckets is the band's inverted index."""
+
+    for (permutation, table) in zip(self._permutations, self._tables):
+      permuted = self._permute(fingerprint, permutation)
+      for ((shift, mask), buckets) in zip(self._bands, table):
+        yield (buckets, (permuted >> shift) & mask)
+
+  def add(self, fingerprint):
+    """Adds a fingerprint to the index, returning its index."""
+
+    index = len(self.fingerprints)
+    self.fingerprints.append(fingerprint)
+    keys = []
+    for (buckets, key) in self._keys(fingerprint):
+      keys.append(key)
+      bucket = buckets.get(key)
+      if bucket is None:
+        buckets[key] = [index]
+      else:
+        bucket.append(index)
+    self._fingerprint_keys.append(keys)
+    return index
+
+  def query(self, fingerprint):
+    """Returns the (index, distance) of each fingerprint in the index within
+    max_distance of the given one, by index."""
+
+    candidates = set()
+    for (buckets, key) in self._keys(fingerprint):
+      candidates.update(buckets.get(key, ()))
+
+    matches = []
+    for index in sorted(candidates):
+      distance = hamming.distance(fingerprint, self.fingerprints[index])
+      if distance <= self.max_distance:
+        matches.append((index, distance))
+    return matches
+
+  def pairs(self):
+    """Returns the (i, j) index pairs, i < j, of the fingerprints in the
+    index within max_distance of each other.
+
+    Each candidate pair is only checked once, however many buckets it
+    shares: in the first table and band the two fingerprints agree in. So
+    nothing is kept between buckets, other than the pairs found."""
+
+    fingerprints = self.fingerprints
+    fingerprint_keys = self._fingerprint_keys
+    max_distance = self.max_distance
+    pairs = []
+    band = 0
+    for table in self._tables:
+      for buckets in table:
+        for bucket in buckets.itervalues():
+          if len(bucket) < 2:
+            continue
+          # Indices are added in order, so each bucket is sorted.
+          for (position, i) in enumerate(bucket):
+            fingerprint = fingerprints[i]
+            keys = fingerprint_keys[i][:band]
+            for j in bucket[position + 1:]:
+              if any(imap(operator.eq, keys, fingerprint_keys[j])):
+                # Checked in an earlier band.
+                continue
+              if hamming.distance(fingerprint, fingerprints[j]) <= max_distance:
+                pairs.append((i, j))
+        band += 1
+    return pairs
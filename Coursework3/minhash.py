@@ -0,0 +1,134 @@
+import __builtin__
+
+# numpy is needed for shingle (MinHash) detection.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# The number of hash functions (and so the length of a signature).
+NUM_PERM = 128
+
+# Shingles are hashed this many at a time, so each step takes a (NUM_PERM x
+# _CHUNK) array of uint64s, 4MB in all.
+_CHUNK = 4096
+
+# The constants of the splitmix64 mixing function.
+if numpy is not None:
+  _GOLDEN_GAMMA = numpy.uint64(0x9e3779b97f4a7c15)
+  _MIX1 = numpy.uint64(0xbf58476d1ce4e5b9)
+  _MIX2 = numpy.uint64(0x94d049bb133111eb)
+
+  # The seed of each hash function (one per row), and the multiplier of the
+  # rolling shingle hash.
+  _SEEDS = (numpy.arange(1, NUM_PERM + 1, dtype=numpy.uint64) *
+      _GOLDEN_GAMMA)[:, numpy.newaxis]
+  _SHINGLE_BASE = numpy.uint64(1000003)
+
+
+def _mix(numbers):
+  """The splitmix64 finalizer, which scrambles the bits of an array of
+  uint64s."""
+
+  numbers = (numbers ^ (numbers >> numpy.uint64(30))) * _MIX1
+  numbers = (numbers ^ (numbers >> numpy.uint64(27))) * _MIX2
+  return numbers ^ (numbers >> numpy.uint64(31))
+
+
+def shingles(tokens, shingle_size):
+  """Returns the distinct hashes of the shingles (runs of shingle_size
+  tokens) of a list of tokens, as an array of uint64s.
+
+  Each token is hashed with Python's hash() (so the hashes only make sense
+  within one Python), and each shingle's hash is a polynomial of its tokens'
+  hashes, worked out for every shingle at once. A text shorter than a shingle
+  is a single shingle."""
+
+  hashes = numpy.array(map(__builtin__.hash, tokens),
+      dtype=numpy.int64).view(numpy.uint64)
+  number_shingles = max(1, len(tokens) - shingle_size + 1)
+
+  shingle_hashes = numpy.zeros(number_shingles, dtype=numpy.uint64)
+  for i in xrange(min(shingle_size, len(tokens))):
+    shingle_hashes *= _SHINGLE_BASE
+    shingle_hashes += hashes[i:i + number_shingles]
+  return numpy.unique(shingle_hashes)
+
+
+def signature(tokens, shingle_size):
+  """Returns the MinHash signature of a list of tokens' shingles: the
+  smallest value of each of NUM_PERM hash functions over them, as an array
+  of uint64s. Returns None if there are no tokens.
+
+  The fraction of the places two signatures agree in estimates the Jaccard
+  similarity of the two sets of shingles."""
+
+  if not tokens:
+    return None
+
+  # Each hash function XORs the (mixed) shingle hashes with its seed and
+  # multiplies them by an odd constant, which is as good as mixing them again
+  # for each function, and far quicker.
+  hashes = _mix(shingles(tokens, shingle_size))
+  signature = None
+  for start in xrange(0, len(hashes), _CHUNK):
+    chunk = hashes[numpy.newaxis, start:start + _CHUNK] ^ _SEEDS
+    chunk *= _MIX2
+    smallest = chunk.min(axis=1)
+    if signature is None:
+      signature = smallest
+    else:
+      numpy.minimum(signature, smallest, out=signature)
+  return signature
+
+
+def similarity(signature1, signature2):
+  """Returns the estimated Jaccard similarity of two signatures."""
+
+  return numpy.count_nonzero(signature1 == signature2) / float(NUM_PERM)
+
+
+def pairs_within(signatures, threshold, bands=32):
+  """Finds the pairs of signatures with an estimated Jaccard similarity of
+  at least threshold, returning a list of (i, j) index pairs, i < j.
+
+  The signatures are split into 'bands' bands, and the pairs of signatures
+  that are equal in any band are candidates, which are then checked. A pair
+  with a Jaccard similarity s is a candidate with probability
+  1 - (1 - s^r)^bands, where r = NUM_PERM / bands, so fewer bands (of more
+  rows) find fewer dissimilar pairs, but can miss some similar ones."""
+
+  if len(signatures) < 2:
+    return []
+
+  matrix = numpy.vstack(signatures)
+  rows = NUM_PERM // bands
+
+  candidates = set()
+  for band in xrange(bands):
+    # Hash each signature's band down to a single key.
+    keys = numpy.zeros(len(signatures), dtype=numpy.uint64)
+    for column in xrange(band * rows, (band + 1) * rows):
+      keys = _mix(keys ^ matrix[:, column])
+
+    # The runs of equal keys are the buckets.
+    order = numpy.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True],
+        sorted_keys[1:] != sorted_keys[:-1], [True])))
+    for (start, end) in zip(starts[:-1], starts[1:]):
+      if end - start < 2:
+        continue
+      bucket = sorted(order[start:end].tolist())
+      for (position, i) in enumerate(bucket):
+        for j in bucket[position + 1:]:
+          candidates.add((i, j))
+
+  if not candidates:
+    return []
+
+  candidates = sorted(candidates)
+  (first, second) = numpy.array(candidates).T
+  agreements = numpy.count_nonzero(matrix[first] == matrix[second], axis=1)
+  close = agreements >= threshold * NUM_PERM
+  return [candidates[i] for i in numpy.flatnonzero(close)]
@@ -0,0 +1,243 @@
+import BaseHTTPServer
+import json
+import lsh
+import optparse
+import simhash
+import SocketServer
+import speeches
+import threading
+import time
+import urlparse
+
+
+class DuplicateIndex(object):
+  """Finds the duplicates of speeches one at a time, as they arrive.
+
+  Exact duplicates are found by their adler32 fingerprint, and near and
+  plateau (finn) duplicates by an LSH index of their simhashes (see
+  lsh.LSHIndex) - so, as with detector.py --lsh_tables, the similarity
+  distance is a Hamming distance. A speech with an empty simhash (only
+  stopwords) has no near duplicates here.
+
+  Nothing is locked, so only one thread should use an index at a time."""
+
+  def __init__(self, similarity_distance=4, bit_size=128, use_zlib=True,
+      lsh_tables=1, band_bits=None):
+    self.similarity_distance = similarity_distance
+    self.bit_size = bit_size
+    self.use_zlib = use_zlib
+
+    # exact fingerprint -> list of speech ids.
+    self.exact_fingerprints = {}
+
+    # The ids of the speeches in each LSH index, by their index there.
+    hash_bits = simhash.hash_bits(bit_size)
+    self.near_index = lsh.LSHIndex(hash_bits, similarity_distance,
+        lsh_tables, band_bits)
+    self.near_ids = []
+    self.plateau_index = lsh.LSHIndex(hash_bits, similarity_distance,
+        lsh_tables, band_bits)
+    self.plateau_ids = []
+
+    self.number_speeches = 0
+
+  def add_speech_set(self, speech_set):
+    """Adds the speeches of a SpeechSet (which must have the same bit size
+    and use_zlib), without checking them."""
+
+    for s in speech_set.speeches:
+      self.add(s)
+
+  def check(self, speech_id, text, insert=True):
+    """Finds the duplicates of a speech, given as the text of its file.
+
+    Returns a dictionary of the ids of its exact duplicates, and the (id,
+    Hamming distance) of its near and plateau duplicates. Unless insert is
+    false, the speech is then added to the index."""
+
+    s = speeches.Speech(speech_id, speeches.SpeechSet._clean_buffer(text),
+        self.use_zlib, self.bit_size)
+
+    exact_matches = self.exact_fingerprints.get(s.exact_fingerprint, [])
+    matches = {"exact": list(exact_matches),
+        "near": self._near_matches(self.near_index, self.near_ids,
+            s.near_fingerprint),
+        "finn": self._near_matches(self.plateau_index, self.plateau_ids,
+            s.plateau_fingerprint)}
+
+    if insert:
+      self.add(s)
+    return matches
+
+  def _near_matches(self, index, ids, fingerprint):
+    if fingerprint is None:
+      return []
+    return [(ids[i], distance) for (i, distance) in index.query(fingerprint)]
+
+  def add(self, s):
+    """Adds a (fingerprinted) Speech to the index."""
+
+    self.exact_fingerprints.setdefault(s.exact_fingerprint, []).append(s.id)
+    if s.near_fingerprint is not None:
+      self.near_index.add(s.near_fingerprint)
+      self.near_ids.append(s.id)
+    if s.plateau_fingerprint is not None:
+      self.plateau_index.add(s.plateau_fingerprint)
+      self.plateau_ids.append(s.id)
+    self.number_speeches += 1
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handles POST /check?id=...[&insert=0], with the speech's text as the
+  body, and GET /stats."""
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    if url.path == "/stats":
+      self._respond(200, self.server.stats())
+    else:
+      self._respond(404, {"error": "Unknown path '%s'." % url.path})
+
+  def do_POST(self):
+    url = urlparse.urlparse(self.path)
+    parameters = urlparse.parse_qs(url.query)
+
+    if url.path != "/check":
+      self._respond(404, {"error": "Unknown path '%s'." % url.path})
+      return
+
+    if "id" not in parameters:
+      self._respond(400, {"error": "No speech id given."})
+      return
+
+    speech_id = parameters["id"][0]
+    insert = parameters.get("insert", ["1"])[0] != "0"
+    text = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+
+    start = time.time()
+    try:
+      matches = self.server.check(speech_id, text, insert)
+    except IndexError:
+      # _clean_buffer needs the speech's header lines.
+      self._respond(400, {"error": "Too few lines in the speech."})
+      return
+
+    matches["id"] = speech_id
+    matches["ms"] = (time.time() - start) * 1000
+    self._respond(200, matches)
+
+  def _respond(self, status, body):
+    text = json.dumps(body)
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(text)))
+    self.end_headers()
+    self.wfile.write(text)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class DuplicateServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """An HTTP server checking speeches against a DuplicateIndex, one at a
+  time."""
+
+  daemon_threads = True
+  request_queue_size = 128
+
+  def __init__(self, address, index, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.index = index
+    self.verbose = verbose
+    self.checks = 0
+    self._lock = threading.Lock()
+
+  def check(self, speech_id, text, insert):
+    with self._lock:
+      self.checks += 1
+      return self.index.check(speech_id, text, insert)
+
+  def stats(self):
+    return {"speeches": self.index.number_speeches,
+        "checks": self.checks}
+
+
+def main():
+  """Loads a directory of speeches, then checks new ones for duplicates over
+  HTTP until killed."""
+
+  parser = optparse.OptionParser()
+  parser.add_option("--host",
+      action="store",
+      dest="host",
+      default="127.0.0.1",
+      help="The address to listen on.")
+  parser.add_option("--port",
+      type="int",
+      action="store",
+      dest="port",
+      default=8001,
+      help="The port to listen on.")
+  parser.add_option("--data",
+      action="store",
+      dest="data_directory",
+      default="data",
+      metavar="DIRECTORY",
+      help="The directory of speeches to start with (or '' for none).")
+  parser.add_option("-s", "--similarity_distance",
+      action="store",
+      type="int",
+      default=4,
+      dest="similarity_distance",
+      metavar="DISTANCE",
+      help="The maximum Hamming distance between two near duplicates.")
+  parser.add_option("-b", "--bit_size",
+      action="store",
+      type="int",
+      default=128,
+      dest="bit_size",
+      metavar="SIZE",
+      help="The bit size used in the simhash generation.")
+  parser.add_option("--lsh_tables",
+      action="store",
+      type="int",
+      default=1,
+      dest="lsh_tables",
+      metavar="TABLES",
+      help="The number of (permuted) LSH tables.")
+  parser.add_option("--band_bits",
+      action="store",
+      type="int",
+      default=None,
+      dest="band_bits",
+      metavar="BITS",
+      help="The number of bits in each band of the LSH tables. By default, "
+           "bands are as wide as they can be while finding every near "
+           "duplicate.")
+  parser.add_option("-v", "--verbose",
+      action="store_true",
+      dest="verbose",
+      default=False,
+      help="Log every request.")
+  (options, args) = parser.parse_args()
+
+  index = DuplicateIndex(options.similarity_distance, options.bit_size,
+      lsh_tables=options.lsh_tables, band_bits=options.band_bits)
+  if options.data_directory:
+    print "Loading speeches from the %s directory." % options.data_directory
+    index.add_speech_set(speeches.SpeechSet(options.data_directory,
+        bit_size=options.bit_size, use_groups=False, keep_tokens=False))
+
+  server = DuplicateServer((options.host, options.port), index,
+      options.verbose)
+
+  print "Listening on http://%s:%s/check" % (options.host, options.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -1,16 +1,91 @@
+import __builtin__
+import binascii
 import hashlib
 from nltk.corpus import stopwords
+import struct
 import warnings
 
+# numpy is optional - without it, fingerprints are summed a token at a time.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 # The DICE version of nltk is old and has a deprecation warning. Ignore it.
 with warnings.catch_warnings():
   warnings.filterwarnings("ignore", category=DeprecationWarning)
   _stopwords = set(stopwords.words('english'))
 
+# The number of bits in an md5 hash (and in the digests of every token hash).
+_MD5_BITS = 128
+
+# The token hashes set_token_hash can choose from.
+TOKEN_HASHES = ("md5", "fast")
+
+# The token hash in use, and the cache of token -> md5 digest. The cache has
+# two generations: once the newer one holds _cache_size tokens it becomes the
+# older one (and the previous older one is dropped), and a token found only in
+# the older one is moved back to the newer. So, as with LRU eviction, at least
+# the _cache_size most recently used tokens are always kept, but a hit costs
+# no more than a dict lookup.
+_token_hash = "md5"
+_cache_size = 1 << 18
+_md5_digests = {}
+_old_md5_digests = {}
+
+# The constants of the splitmix64 mixing function, for the fast hash.
+_GOLDEN_GAMMA = 0x9e3779b97f4a7c15
+_MIX1 = 0xbf58476d1ce4e5b9
+_MIX2 = 0x94d049bb133111eb
+_MASK64 = (1 << 64) - 1
+if numpy is not None:
+  _NUMPY_GOLDEN_GAMMA = numpy.uint64(_GOLDEN_GAMMA)
+  _NUMPY_MIX1 = numpy.uint64(_MIX1)
+  _NUMPY_MIX2 = numpy.uint64(_MIX2)
+
+
+def set_token_hash(name="md5", cache_size=1 << 18):
+  """Chooses the hash each token is given, from TOKEN_HASHES.
+
+    * md5 (the default): a token's md5 digest. Digests are cached, for up to
+      twice cache_size tokens (0 turns the cache off).
+    * fast: Python's hash() of a token, mixed up to 128 bits by splitmix64.
+      This is much quicker, but isn't cryptographic, and differs between 32
+      and 64 bit Pythons - so the fingerprints it gives can only be compared
+      with others made by the same Python."""
+
+  global _token_hash, _cache_size
+  if name not in TOKEN_HASHES:
+    raise ValueError("Unknown token hash '%s'." % name)
+
+  _token_hash = name
+  _cache_size = cache_size
+  _md5_digests.clear()
+  _old_md5_digests.clear()
+
+
+def token_hash():
+  """Returns the name of the token hash in use."""
+
+  return _token_hash
+
 
 def hash(token_counter, bit_size):
-  """Compute the simhash of the tokens in token_counter.
+  """Compute the simhash of the tokens in token_counter, as a list of bits.
+
+  This is a list view of fingerprint(...) - see to_bits. If given, bit size
+  must be a power of 2."""
+
+  return to_bits(fingerprint(token_counter, bit_size), bit_size)
+
+
+def fingerprint(token_counter, bit_size):
+  """Compute the simhash of the tokens in token_counter, as an int.
+
+  Bit i of the int (counting from the most significant of bit_size bits) is
+  element i of the list hash(...) returns. If there are no tokens (other
+  than stopwords) the simhash is empty, and None is returned.
 
   If given, bit size must be a power of 2."""
 
@@ -18,20 +93,142 @@ def hash(token_counter, bit_size):
   if not(_is_power_of_two(bit_size)):
     raise ValueError("bit_size is not a power of 2!")
 
-  hashed_tokens = [_simhash_binary_md5(token, token_counter, bit_size)
-      for token in token_counter if token not in _stopwords]
+  tokens = [token for token in token_counter if token not in _stopwords]
+  if not tokens:
+    return None
+
+  if numpy is None:
+    hashed_tokens = [_simhash_binary_md5(token, token_counter, bit_size)
+        for token in tokens]
+    summed_columns = [sum(x) for x in zip(*hashed_tokens)]
+    return from_bits([1 if column > 0 else 0 for column in summed_columns])
+
+  return _numpy_fingerprint(tokens, token_counter, bit_size)
+
+
+def _numpy_fingerprint(tokens, token_counter, bit_size):
+  """fingerprint(...), summing the columns of every token at once.
+
+  The token hashes are unpacked into a (token x bit) matrix. As in
+  _simhash_binary_md5, a 1 bit counts +frequency and a 0 bit -frequency -
+  except for the leading 0s of each truncated hash, which count nothing."""
+
+  number_bits = hash_bits(bit_size)
+  if _token_hash == "fast":
+    digests = _numpy_fast_digests(tokens)
+  else:
+    digests = numpy.frombuffer("".join(_cached_md5_digests(tokens)),
+        dtype=numpy.uint8)
+  bits = numpy.unpackbits(digests).reshape(len(tokens), _MD5_BITS)[
+      :, :number_bits]
+  # 1 from each token's first 1 bit onwards. A hash of 0 is still written
+  # as one '0' bit by bin(), so the last bit always counts.
+  counted = numpy.maximum.accumulate(bits, axis=1)
+  counted[:, -1] = 1
+
+  frequencies = numpy.array([token_counter[token] for token in tokens],
+      dtype=numpy.int64)
+  summed_columns = numpy.dot(frequencies, 2 * bits.astype(numpy.int64) -
+      counted)
+
+  # The hash sits in the low number_bits bits (as the list is padded with 0s
+  # at the front), and packbits pads it to whole bytes at the end.
+  packed = numpy.packbits(summed_columns > 0).tostring()
+  return int(binascii.hexlify(packed), 16) >> (len(packed) * 8 - number_bits)
+
+
+def _cached_md5_digests(tokens):
+  """Returns the list of the md5 digests of tokens, from (and adding to) the
+  cache."""
+
+  global _md5_digests, _old_md5_digests
+
+  digests = map(_md5_digests.get, tokens)
+  if None in digests:
+    for (i, token) in enumerate(tokens):
+      if digests[i] is None:
+        digest = _old_md5_digests.get(token)
+        if digest is None:
+          digest = hashlib.md5(token).digest()
+        if _cache_size > 0:
+          if len(_md5_digests) >= _cache_size:
+            _old_md5_digests = _md5_digests
+            _md5_digests = {}
+          _md5_digests[token] = digest
+        digests[i] = digest
+  return digests
+
+
+def _token_digest(token):
+  """Returns the 16 byte digest of a token, from the token hash in use."""
+
+  if _token_hash == "fast":
+    hashed = __builtin__.hash(token) & _MASK64
+    return struct.pack(">QQ", _mix(hashed),
+        _mix((hashed + _GOLDEN_GAMMA) & _MASK64))
+  return _cached_md5_digests([token])[0]
+
+
+def _mix(number):
+  """The splitmix64 finalizer, which scrambles the bits of a 64 bit int."""
+
+  number = ((number ^ (number >> 30)) * _MIX1) & _MASK64
+  number = ((number ^ (number >> 27)) * _MIX2) & _MASK64
+  return number ^ (number >> 31)
+
+
+def _numpy_fast_digests(tokens):
+  """Returns the fast hash of each token, as a flat array of the bytes of
+  their 16 byte digests (see _token_digest)."""
+
+  hashed = numpy.array(map(__builtin__.hash, tokens),
+      dtype=numpy.int64).view(numpy.uint64)
+  words = numpy.empty((len(tokens), 2), dtype=">u8")
+  words[:, 0] = _numpy_mix(hashed)
+  words[:, 1] = _numpy_mix(hashed + _NUMPY_GOLDEN_GAMMA)
+  return words.view(numpy.uint8).ravel()
+
+
+def _numpy_mix(numbers):
+  """_mix, for an array of uint64s."""
+
+  numbers = (numbers ^ (numbers >> numpy.uint64(30))) * _NUMPY_MIX1
+  numbers = (numbers ^ (numbers >> numpy.uint64(27))) * _NUMPY_MIX2
+  return numbers ^ (numbers >> numpy.uint64(31))
+
+
+def hash_bits(bit_size):
+  """Returns the number of (low) bits of a bit_size fingerprint that can be
+  set. The hashes are truncated to bit_size bits, or padded with leading 0s
+  if that is more than they have."""
+
+  return min(bit_size, _MD5_BITS)
+
+
+def to_bits(fingerprint, bit_size):
+  """Returns the list of 0/1 bits of an int fingerprint, most significant
+  first (or [], for the empty fingerprint None)."""
+
+  if fingerprint is None:
+    return []
+  return [int(bit) for bit in bin(fingerprint)[2:].zfill(bit_size)]
+
 
-  summed_columns = [sum(x) for x in zip(*hashed_tokens)]
-  simhash = [1 if column > 0 else 0 for column in summed_columns]
+def from_bits(bits):
+  """Returns the int fingerprint of a list of 0/1 bits, most significant
+  first (or None, for the empty list)."""
 
-  return simhash
+  if not bits:
+    return None
+  return int("".join(map(str, bits)), 2)
 
 
 def _simhash_binary_md5(token, token_counter, bit_size):
   """Returns the sim-hash binary version of a md5 hash of an input token.
 
-  This is created by hashing with md5, converting to binary, replacing all
-  '0's with '-1', and multiplying through by token_counter.
+  This is created by hashing with md5 (or the token hash set by
+  set_token_hash), converting to binary, replacing all '0's with '-1', and
+  multiplying through by token_counter.
 
   The hash is truncuated to bit_size bits. Truncuating to less than 128 will
   cause an increase in collisions, but so would using a smaller hash! If
@@ -39,8 +236,7 @@ def _simhash_binary_md5(token, token_counter, bit_size):
 
   The returned value is a list of integers."""
 
-  hashed_word = hashlib.md5(token)
-  hex_digest = hashed_word.hexdigest()[:bit_size / 4]
+  hex_digest = binascii.hexlify(_token_digest(token))[:bit_size / 4]
   binary_string = bin(int(hex_digest, base=16))
 
   # Slice off the '0b'.
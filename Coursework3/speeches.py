@@ -1,12 +1,21 @@
 import collections
 import counter
 import finn
-from itertools import izip_longest
+import hashlib
+from itertools import imap, izip_longest
+import minhash
+import multiprocessing
 import os
 import simhash
 import string
 import zlib
 
+# numpy is optional - without it, the manual adler32 is summed in Python.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 def grouper(n, iterable, padvalue=None):
   """Chunks an iterable into 'n' sized chunks, with padding if necessary.
@@ -18,29 +27,99 @@ def grouper(n, iterable, padvalue=None):
   return izip_longest(*[iter(iterable)]*n, fillvalue=padvalue)
 
 
-class Speech:
+# The bits of each hex digit, for _group_keys.
+_DIGIT_BITS = dict([('%x' % i, bin(i)[2:].zfill(4)) for i in xrange(16)])
+
+
+def _group_keys(fingerprint, bit_size):
+  """Returns the bucket keys of the groups of 4 bits of an int fingerprint.
+
+  These are the same as grouping simhash.to_bits(fingerprint, bit_size), but
+  each group is a hex digit of the fingerprint, so they are much quicker to
+  make."""
+
+  if fingerprint is None:
+    return []
+  if bit_size % 4 != 0:
+    return ["%s%s" % (i, ''.join(map(str, chunk))) for (i, chunk)
+        in enumerate(grouper(4, simhash.to_bits(fingerprint, bit_size)))]
+
+  digits = '%0*x' % (bit_size / 4, fingerprint)
+  return ["%s%s" % (i, _DIGIT_BITS[digit]) for (i, digit)
+      in enumerate(digits)]
+
+
+def _read_speech((speech_file, use_zlib, bit_size, keep_tokens,
+    shingle_size)):
+  """Reads, cleans and fingerprints a single speech file, returning
+  (speech_file, md5 digest of the file, Speech).
+
+  This is run in SpeechSet's worker processes, so the Speech is returned
+  without its tokens (unless keep_tokens is set) to keep what is sent back to
+  the parent small."""
+
+  with open(speech_file, 'r') as f:
+    data = f.read()
+  digest = hashlib.md5(data).hexdigest()
+
+  speech_id = SpeechSet._get_id(os.path.basename(speech_file))
+  text = SpeechSet._clean_buffer(data)
+
+  s = Speech(speech_id, text, use_zlib, bit_size, shingle_size=shingle_size)
+  if not keep_tokens:
+    s.tokens = None
+  return (speech_file, digest, s)
+
+
+class Speech(object):
   """Represents a single speech."""
 
   # Used in the calculation of adler32.
   _LARGE_PRIME = 65521
 
-  def __init__(self, file_id, text, use_zlib, bit_size):
+  def __init__(self, file_id, text, use_zlib, bit_size, fingerprints=None,
+      shingle_size=None):
+    """Fingerprints a speech's (cleaned) text.
+
+    If fingerprints is given, as (exact, near, plateau) fingerprints (from a
+    cache.FingerprintCache), they are used instead and the text isn't
+    needed. If shingle_size is set, the MinHash signature of the text's
+    shingles of that many words is kept too (see minhash.signature)."""
+
     self.id = file_id
+    self.near_fingerprint_buckets = []
+    self.plateau_fingerprint_buckets = []
+    self.shingle_signature = None
+
+    if fingerprints is not None:
+      self.tokens = None
+      (self.exact_fingerprint, self.near_fingerprint,
+          self.plateau_fingerprint) = fingerprints
+      return
 
     self.tokens = text.split()
     token_counter = counter.Counter(self.tokens)
 
     self.exact_fingerprint = self._adler_32(text, use_zlib)
 
-    self.near_fingerprint = simhash.hash(token_counter, bit_size)
-    self.near_fingerprint_buckets = []
+    # The fingerprints are ints (see simhash.fingerprint).
+    self.near_fingerprint = simhash.fingerprint(token_counter, bit_size)
 
     self.plateau_fingerprint = None
-    self.plateau_fingerprint_buckets = []
     plateau = finn.find_plateau(self.tokens)
     if plateau is not None:
       plateau_counter = counter.Counter(plateau)
-      self.plateau_fingerprint = simhash.hash(plateau_counter, bit_size)
+      self.plateau_fingerprint = simhash.fingerprint(plateau_counter,
+          bit_size)
+
+    if shingle_size:
+      self.shingle_signature = minhash.signature(self.tokens, shingle_size)
+
+  def fingerprints(self):
+    """Returns the (exact, near, plateau) fingerprints of the speech."""
+
+    return (self.exact_fingerprint, self.near_fingerprint,
+        self.plateau_fingerprint)
 
   def _adler_32(self, text, use_zlib):
     """Compute the adler32 checksum of a block of text.
@@ -50,6 +129,17 @@ class Speech:
 
     if use_zlib:
       return zlib.adler32(text)
+    elif numpy is not None:
+      # The same sums as below, over all the (non-space) characters at once:
+      # b is their sum, and a adds each character once for every character
+      # from it to the end.
+      characters = numpy.frombuffer(text, dtype=numpy.uint8)
+      characters = characters[characters != ord(' ')].astype(numpy.int64)
+      b = int(characters.sum())
+      a = int(numpy.dot(characters,
+          numpy.arange(len(characters), 0, -1, dtype=numpy.int64)))
+
+      return ((a % Speech._LARGE_PRIME) << 16) | (b % Speech._LARGE_PRIME)
     else:
       # It was noted on the forums by Dr Lavrenko that we did not need to
       # implement adler32, so using zlib's version should be fine. However,
@@ -67,19 +157,40 @@ class Speech:
       return ((a % Speech._LARGE_PRIME) << 16) | (b % Speech._LARGE_PRIME)
 
 
-class SpeechSet:
+class SpeechSet(object):
   """Represents a set of speeches."""
 
   def __init__(self, folder_name, use_zlib=True, bit_size=128,
-      use_groups=True):
+      use_groups=True, processes=None, keep_tokens=True, cache=None,
+      shingle_size=None):
     """Parses a directory of speeches.
 
     If use_zlib is set to false, the 'exact' hash will be calculated manually
-    instead of via zlib.adler32(...)."""
+    instead of via zlib.adler32(...).
+
+    The speeches are read and fingerprinted by a pool of 'processes'
+    processes (by default, one per CPU), and the buckets are built from them
+    here. Unless keep_tokens is set, the speeches' tokens are dropped once
+    they are fingerprinted. If shingle_size is set, each speech also gets a
+    MinHash signature of its shingles of that many words.
+
+    If a cache.FingerprintCache is given, speeches whose files haven't changed
+    take their fingerprints from it, and it is saved with those of the others
+    (it is only read from if keep_tokens and shingle_size aren't set, as it
+    has no tokens or signatures)."""
 
     if not os.path.isabs(folder_name):
       folder_name = os.path.abspath(folder_name)
 
+    self.folder_name = folder_name
+    self.use_zlib = use_zlib
+    self.bit_size = bit_size
+    self.use_groups = use_groups
+    self.processes = processes
+    self.keep_tokens = keep_tokens
+    self.cache = cache
+    self.shingle_size = shingle_size
+
     self.speeches = set()
     self.exact_fingerprints = collections.defaultdict(set)
 
@@ -89,52 +200,137 @@ class SpeechSet:
     self.near_fingerprints = collections.defaultdict(set)
     self.plateau_fingerprints = collections.defaultdict(set)
 
-    # Parse the speeches.
-    files = os.listdir(folder_name)
-    for filename in files:
-      speech_file = os.path.join(folder_name, filename)
+    # speech file -> (mtime, size), and speech file -> Speech.
+    self._stamps = {}
+    self._files = {}
 
-      # Skip non-text files.
-      if not filename.endswith('.txt'):
-        continue
+    self.update()
+
+  def update(self):
+    """Brings the set up to date with its directory, fingerprinting only the
+    speech files that are new or have changed since the last update (or that
+    aren't in the cache), and removing those that are gone.
 
-      with open(speech_file, 'r') as f:
-        lines = [line.strip() for line in f]
-
-      speech_id = self._get_id(filename)
-      cleaned_lines = self._clean_text(lines)
-      text = ' '.join(cleaned_lines)
-
-      s = Speech(speech_id, text, use_zlib, bit_size)
-      self.speeches.add(s)
-
-      # Keep inverted index of exact fingerprints to speeches.
-      self.exact_fingerprints[s.exact_fingerprint].add(s)
-
-      # Add each chunk of the near and plateau fingerprints to the
-      # appropriate group.
-      if use_groups:
-        chunked_near_fingerprint = grouper(4, s.near_fingerprint)
-        for (i, chunk) in enumerate(chunked_near_fingerprint):
-          key = "%s%s" % (i, ''.join(map(str, chunk)))
-          self.near_fingerprints[key].add(s)
-          s.near_fingerprint_buckets.append(self.near_fingerprints[key])
-
-        if s.plateau_fingerprint is not None:
-          chunked_plateau_fingerprint = grouper(4, s.plateau_fingerprint)
-          for (i, chunk) in enumerate(chunked_plateau_fingerprint):
-            key = "%s%s" % (i, ''.join(map(str, chunk)))
-            self.plateau_fingerprints[key].add(s)
-            s.plateau_fingerprint_buckets.append(
-                self.plateau_fingerprints[key])
-
-  def _get_id(self, name):
+    Returns the number of speech files fingerprinted."""
+
+    # Parse the speeches, skipping non-text files.
+    speech_files = [os.path.join(self.folder_name, filename)
+        for filename in os.listdir(self.folder_name)
+        if filename.endswith('.txt')]
+
+    for speech_file in set(self._files).difference(speech_files):
+      self._remove_speech(speech_file)
+
+    use_cache = (self.cache is not None and not self.keep_tokens and
+        not self.shingle_size)
+    jobs = []
+    stamps = {}
+    for speech_file in speech_files:
+      stat = os.stat(speech_file)
+      stamp = (stat.st_mtime, stat.st_size)
+      if self._stamps.get(speech_file) == stamp:
+        continue
+      if speech_file in self._files:
+        self._remove_speech(speech_file)
+
+      fingerprints = None
+      if use_cache:
+        fingerprints = self.cache.lookup(speech_file, *stamp)
+      if fingerprints is not None:
+        s = Speech(self._get_id(os.path.basename(speech_file)), None,
+            self.use_zlib, self.bit_size, fingerprints)
+        self._add_speech(speech_file, stamp, s)
+      else:
+        jobs.append((speech_file, self.use_zlib, self.bit_size,
+            self.keep_tokens, self.shingle_size))
+        stamps[speech_file] = stamp
+
+    processes = self.processes
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+
+    pool = None
+    if processes > 1 and len(jobs) > 1:
+      pool = multiprocessing.Pool(processes)
+      parsed_speeches = pool.imap_unordered(_read_speech, jobs, 16)
+    else:
+      parsed_speeches = imap(_read_speech, jobs)
+
+    try:
+      for (speech_file, digest, s) in parsed_speeches:
+        stamp = stamps[speech_file]
+        self._add_speech(speech_file, stamp, s)
+        if self.cache is not None:
+          self.cache.add(speech_file, stamp[0], stamp[1], digest,
+              s.fingerprints())
+    finally:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+
+    if self.cache is not None:
+      self.cache.prune(self.folder_name, speech_files)
+      self.cache.save()
+
+    return len(jobs)
+
+  def _add_speech(self, speech_file, stamp, s):
+    """Adds a (fingerprinted) speech to the set and its buckets."""
+
+    bit_size = self.bit_size
+    self._stamps[speech_file] = stamp
+    self._files[speech_file] = s
+    self.speeches.add(s)
+
+    # Keep inverted index of exact fingerprints to speeches.
+    self.exact_fingerprints[s.exact_fingerprint].add(s)
+
+    # Add each chunk of the near and plateau fingerprints to the
+    # appropriate group.
+    if self.use_groups:
+      for key in _group_keys(s.near_fingerprint, bit_size):
+        bucket = self.near_fingerprints[key]
+        bucket.add(s)
+        s.near_fingerprint_buckets.append(bucket)
+
+      for key in _group_keys(s.plateau_fingerprint, bit_size):
+        bucket = self.plateau_fingerprints[key]
+        bucket.add(s)
+        s.plateau_fingerprint_buckets.append(bucket)
+
+  def _remove_speech(self, speech_file):
+    """Removes the speech of a file from the set and its buckets."""
+
+    del self._stamps[speech_file]
+    s = self._files.pop(speech_file)
+    self.speeches.discard(s)
+
+    exact_bucket = self.exact_fingerprints[s.exact_fingerprint]
+    exact_bucket.discard(s)
+    if not exact_bucket:
+      del self.exact_fingerprints[s.exact_fingerprint]
+
+    # The buckets are found again by their keys, so that emptied ones can be
+    # deleted.
+    if self.use_groups:
+      for (buckets, fingerprint) in (
+          (self.near_fingerprints, s.near_fingerprint),
+          (self.plateau_fingerprints, s.plateau_fingerprint)):
+        for key in _group_keys(fingerprint, self.bit_size):
+          bucket = buckets[key]
+          bucket.discard(s)
+          if not bucket:
+            del buckets[key]
+
+  @staticmethod
+  def _get_id(name):
     """Extracts the id from a filename."""
 
     parts = name.split('.')
     return '.'.join(parts[:-1])
 
-  def _clean_text(self, lines):
+  @staticmethod
+  def _clean_text(lines):
     """Cleans the text of a speech.
 
     The text should be given as a list of lines. The cleaning operations that
@@ -158,11 +354,40 @@ class SpeechSet:
     lines = filter(None, lines)
 
     # Remove punctuation.
-    lines = [self._strip_punctuation(line) for line in lines]
+    lines = [SpeechSet._strip_punctuation(line) for line in lines]
 
     return lines
 
-  def _strip_punctuation(self, text):
+  @staticmethod
+  def _clean_buffer(data):
+    """Cleans the text of a speech, given as the contents of its file, and
+    returns it as a single line.
+
+    This is the same as joining the lines of _clean_text with spaces, but
+    the header lines are skipped in the buffer, the lines are split, stripped
+    and joined by str methods without a Python loop, and punctuation is then
+    deleted from the whole text with one translate. Raises IndexError if the
+    speech doesn't have its two header lines."""
+
+    # Skip the 'This is a...' line and the blank line that follows.
+    parts = data.split('\n', 2)
+    if len(parts) < 3:
+      raise IndexError("Too few lines in the speech.")
+    text = parts[2]
+
+    # Try and detect the 'I am a' lines. They're generally short.
+    end = text.find('\n')
+    if end < 0:
+      end = len(text)
+    if len(text[:end].split()) <= 7:
+      text = text[end + 1:]
+
+    # Join the lines, dropping empty ones, and remove punctuation.
+    lines = filter(None, map(str.strip, text.split('\n')))
+    return ' '.join(lines).translate(None, string.punctuation)
+
+  @staticmethod
+  def _strip_punctuation(text):
     """Strips punctuation from a string."""
 
-    return text.translate(string.maketrans('', ''), string.punctuation)
\ No newline at end of file
+    return text.translate(None, string.punctuation)
\ No newline at end of file